@@ -0,0 +1,82 @@
+"""
+Benchmark of the component selection in QMeasureDMClassifEig.
+
+Compares the previous full argsort selection against top-k selection,
+first on the selection step alone and then on a multilayer model built
+by stacking several QMeasureDMClassifEig layers.
+"""
+import sys
+sys.path.insert(0, "../")
+
+import time
+import numpy as np
+import tensorflow as tf
+from qmc.tf import layers
+
+BATCH_SIZE = 256
+DIM = 32
+NUM_EIG = 32
+EIG_OUT = 16
+NUM_LAYERS = 6
+REPEATS = 20
+
+
+def timeit(fn, *args):
+    fn(*args) # trace and warm up
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        out = fn(*args)
+    _ = out.numpy()
+    return (time.perf_counter() - start) / REPEATS
+
+
+@tf.function
+def select_argsort(out_w, eig_vec_y):
+    ind = tf.argsort(out_w, direction='DESCENDING', axis=1)[:, :EIG_OUT]
+    out_w = tf.gather(out_w, ind, axis=-1, batch_dims=1)
+    eig_vec_y = tf.gather(eig_vec_y, ind, axis=-1, batch_dims=1)
+    return tf.concat((tf.expand_dims(out_w, axis=1), eig_vec_y), 1)
+
+
+@tf.function
+def select_top_k(out_w, eig_vec_y):
+    out_w, ind = tf.math.top_k(out_w, EIG_OUT)
+    eig_vec_y = tf.gather(eig_vec_y, ind, axis=-1, batch_dims=1)
+    return tf.concat((tf.expand_dims(out_w, axis=1), eig_vec_y), 1)
+
+
+def build_model(approx_top_k=False):
+    inputs = tf.keras.Input(shape=(DIM + 1, 1))
+    rho = inputs
+    for _ in range(NUM_LAYERS):
+        rho = layers.QMeasureDMClassifEig(
+            dim_x=DIM, dim_y=DIM, eig_out=EIG_OUT, num_eig=NUM_EIG,
+            approx_top_k=approx_top_k)(rho)
+    return tf.keras.Model(inputs=inputs, outputs=rho)
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(0)
+    print('Selection step, batch size', BATCH_SIZE)
+    for eig_in in [16, 64, 256]:
+        n = NUM_EIG * eig_in
+        out_w = tf.constant(rng.rand(BATCH_SIZE, n).astype(np.float32))
+        eig_vec_y = tf.constant(
+            rng.randn(BATCH_SIZE, DIM, n).astype(np.float32))
+        t_sort = timeit(select_argsort, out_w, eig_vec_y)
+        t_top_k = timeit(select_top_k, out_w, eig_vec_y)
+        print(f'  n={n:6d}  argsort {t_sort * 1e3:8.2f} ms'
+              f'  top_k {t_top_k * 1e3:8.2f} ms'
+              f'  speedup {t_sort / t_top_k:5.2f}x')
+
+    psi = rng.randn(BATCH_SIZE, DIM).astype(np.float32)
+    psi /= np.linalg.norm(psi, axis=1, keepdims=True)
+    x = tf.constant(np.concatenate(
+        (np.ones((BATCH_SIZE, 1), np.float32), psi), axis=1)[:, :, None])
+    print(f'{NUM_LAYERS}-layer QMeasureDMClassifEig stack')
+    model = build_model()
+    t_exact = timeit(tf.function(model), x)
+    print(f'  top_k        {t_exact * 1e3:8.2f} ms per batch')
+    model_xla = build_model(approx_top_k=True)
+    t_approx = timeit(tf.function(model_xla, jit_compile=True), x)
+    print(f'  approx (XLA) {t_approx * 1e3:8.2f} ms per batch')
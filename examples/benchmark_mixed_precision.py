@@ -0,0 +1,86 @@
+"""
+Benchmark of mixed precision execution.
+
+Trains a QMClassifierSGD model and fits a closed-form QMClassifier on a
+synthetic classification problem under the float32, mixed_bfloat16 and
+mixed_float16 policies, and reports the prediction throughput and the
+test accuracy for each of them. Half precision only pays off on hardware
+with fast bfloat16/float16 kernels (recent GPUs/TPUs, CPUs with AMX or
+AVX512-BF16); elsewhere it mostly measures the cost of the casts.
+"""
+import sys
+sys.path.insert(0, "../")
+
+import time
+import numpy as np
+import tensorflow as tf
+from sklearn.datasets import make_classification
+from sklearn.model_selection import train_test_split
+from qmc.tf import layers, models
+
+INPUT_DIM = 64
+DIM_X = 512
+NUM_CLASSES = 4
+NUM_EIG = 32
+GAMMA = 2. ** -6
+BATCH_SIZE = 512
+EPOCHS = 3
+REPEATS = 10
+POLICIES = ['float32', 'mixed_bfloat16', 'mixed_float16']
+
+
+def timeit(fn, x):
+    fn(x) # trace and warm up
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        out = fn(x)
+    _ = out.numpy()
+    return (time.perf_counter() - start) / REPEATS
+
+
+def accuracy(model, x, y):
+    probs = np.asarray(model.predict(x, batch_size=BATCH_SIZE, verbose=0),
+                       dtype=np.float32)
+    return np.mean(np.argmax(probs, axis=1) == y)
+
+
+if __name__ == '__main__':
+    X, y = make_classification(n_samples=20000, n_features=INPUT_DIM,
+                               n_informative=INPUT_DIM // 2,
+                               n_classes=NUM_CLASSES, random_state=0)
+    X = X.astype(np.float32)
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, y, test_size=0.25, random_state=0)
+    y_train_oh = tf.keras.utils.to_categorical(y_train, NUM_CLASSES)
+    x_batch = tf.constant(X_test[:BATCH_SIZE])
+    print(f'input_dim={INPUT_DIM}, dim_x={DIM_X}, batch_size={BATCH_SIZE}')
+    for policy in POLICIES:
+        tf.keras.mixed_precision.set_global_policy(policy)
+        qmc_sgd = models.QMClassifierSGD(
+            input_dim=INPUT_DIM, dim_x=DIM_X, dim_y=NUM_CLASSES,
+            num_eig=NUM_EIG, gamma=GAMMA, random_state=0)
+        qmc_sgd.compile(tf.keras.optimizers.Adam(learning_rate=0.005),
+                        loss=tf.keras.losses.CategoricalCrossentropy())
+        start = time.perf_counter()
+        qmc_sgd.fit(X_train, y_train_oh, epochs=EPOCHS,
+                    batch_size=BATCH_SIZE, verbose=0)
+        t_train = time.perf_counter() - start
+        t_pred = timeit(tf.function(qmc_sgd), x_batch)
+        acc = accuracy(qmc_sgd, X_test, y_test)
+        print(f'  {policy:15s} QMClassifierSGD  train {t_train:6.2f} s'
+              f'  predict {t_pred * 1e3:7.2f} ms/batch  acc {acc:.4f}')
+
+        fm_x = layers.QFeatureMapRFF(INPUT_DIM, dim=DIM_X, gamma=GAMMA,
+                                     random_state=0)
+        fm_y = layers.QFeatureMapOneHot(num_classes=NUM_CLASSES)
+        qmc = models.QMClassifier(fm_x=fm_x, fm_y=fm_y, dim_x=DIM_X,
+                                  dim_y=NUM_CLASSES)
+        qmc.compile()
+        start = time.perf_counter()
+        qmc.fit(X_train, y_train, epochs=1, batch_size=BATCH_SIZE,
+                verbose=0)
+        t_train = time.perf_counter() - start
+        t_pred = timeit(tf.function(qmc), x_batch)
+        acc = accuracy(qmc, X_test, y_test)
+        print(f'  {policy:15s} QMClassifier     fit   {t_train:6.2f} s'
+              f'  predict {t_pred * 1e3:7.2f} ms/batch  acc {acc:.4f}')
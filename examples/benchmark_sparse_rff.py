@@ -0,0 +1,47 @@
+"""
+Benchmark of sparse inputs in QFeatureMapRFF.
+
+Compares the dense path (densifying the batch and using a dense matmul)
+against passing a tf.SparseTensor, which uses a sparse-dense matmul, at
+several sparsity levels of high-dimensional inputs.
+"""
+import sys
+sys.path.insert(0, "../")
+
+import time
+import numpy as np
+import scipy.sparse as sp
+import tensorflow as tf
+from qmc.tf import layers
+
+INPUT_DIM = 100000
+DIM = 1024
+BATCH_SIZE = 256
+REPEATS = 10
+
+
+def timeit(fn, x):
+    fn(x) # trace and warm up
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        out = fn(x)
+    _ = out.numpy()
+    return (time.perf_counter() - start) / REPEATS
+
+
+if __name__ == '__main__':
+    fm_x = layers.QFeatureMapRFF(INPUT_DIM, dim=DIM, gamma=0.5,
+                                 random_state=0)
+    dense_fn = tf.function(lambda x: fm_x(tf.sparse.to_dense(x)))
+    sparse_fn = tf.function(fm_x)
+    print(f'input_dim={INPUT_DIM}, dim={DIM}, batch_size={BATCH_SIZE}')
+    for density in [1e-2, 1e-3, 1e-4]:
+        x = sp.random(BATCH_SIZE, INPUT_DIM, density=density, format='csr',
+                      dtype=np.float32, random_state=0)
+        x = layers._sparse_from_scipy(x)
+        t_dense = timeit(dense_fn, x)
+        t_sparse = timeit(sparse_fn, x)
+        diff = np.abs(dense_fn(x).numpy() - sparse_fn(x).numpy()).max()
+        print(f'  density {density:7.0e}  dense {t_dense * 1e3:8.2f} ms'
+              f'  sparse {t_sparse * 1e3:8.2f} ms'
+              f'  speedup {t_dense / t_sparse:6.2f}x  max diff {diff:.1e}')
@@ -1,6 +1,7 @@
 """
 Class for RBF Sampler with Orthogonal Random Features
 """
+import os
 import warnings
 
 import numpy as np
@@ -39,6 +40,11 @@ class RBFSamplerORF(TransformerMixin, BaseEstimator):
         Pass an int for reproducible output across multiple function calls.
         See :term:`Glossary <random_state>`.
 
+    cache_dir : str or None, optional (default=None)
+        Directory where the generated weights are cached. The cache is
+        keyed by (n_features, n_components, gamma, random_state) and is
+        only used when random_state is an int.
+
     Attributes
     ----------
     random_offset_ : ndarray of shape (n_components,), dtype=float64
@@ -73,10 +79,12 @@ class RBFSamplerORF(TransformerMixin, BaseEstimator):
     (https://arxiv.org/pdf/1610.09072)
     """
     @_deprecate_positional_args
-    def __init__(self, *, gamma=1., n_components=100, random_state=None):
+    def __init__(self, *, gamma=1., n_components=100, random_state=None,
+                 cache_dir=None):
         self.gamma = gamma
         self.n_components = n_components
         self.random_state = random_state
+        self.cache_dir = cache_dir
 
     def fit(self, X, y=None):
         """Fit the model with X.
@@ -96,26 +104,49 @@ class RBFSamplerORF(TransformerMixin, BaseEstimator):
         """
 
         #X = self._validate_data(X, accept_sparse='csr')
-        random_state = check_random_state(self.random_state)
         n_features = X.shape[1]
+        cache_path = self._cache_path(n_features)
+        if cache_path is not None and os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                self.random_weights_ = cached['random_weights']
+                self.random_offset_ = cached['random_offset']
+            return self
 
-        stack_random_weights = []
-        for i in range(round(self.n_components / n_features)+1):
-            random_gaussian_weights_ = random_state.normal(size=(n_features, n_features))
-            q, _ = np.linalg.qr(random_gaussian_weights_, mode='reduced')
-            random_chi_weights = random_state.chisquare(df=n_features, size=(n_features))
-            random_chi_weights = np.sqrt(random_chi_weights)
-
-            random_chi_weights = np.diag(random_chi_weights)
-
-            random_weights_ = np.dot(random_chi_weights, q)
-            stack_random_weights.append(random_weights_)
-
-        self.random_weights_ = np.sqrt(2 * self.gamma) * np.hstack(stack_random_weights)[:n_features, :self.n_components]
+        random_state = check_random_state(self.random_state)
+        n_blocks = round(self.n_components / n_features) + 1
+        # the draws are interleaved as in a per-block loop so that a given
+        # seed keeps producing the same weights
+        gaussian_weights = np.empty((n_blocks, n_features, n_features))
+        chi_weights = np.empty((n_blocks, n_features))
+        for i in range(n_blocks):
+            gaussian_weights[i] = random_state.normal(size=(n_features, n_features))
+            chi_weights[i] = random_state.chisquare(df=n_features, size=(n_features))
+        if np.lib.NumpyVersion(np.__version__) >= '1.22.0':
+            q, _ = np.linalg.qr(gaussian_weights, mode='reduced')
+        else:
+            q = np.stack([np.linalg.qr(w, mode='reduced')[0]
+                          for w in gaussian_weights])
+        random_weights_ = np.sqrt(chi_weights)[:, :, np.newaxis] * q
+
+        self.random_weights_ = np.sqrt(2 * self.gamma) * np.hstack(random_weights_)[:n_features, :self.n_components]
         self.random_offset_ = random_state.uniform(0, 2 * np.pi, size=self.n_components)
 
+        if cache_path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp.npz'
+            np.savez(tmp_path, random_weights=self.random_weights_,
+                     random_offset=self.random_offset_)
+            os.replace(tmp_path, cache_path)
         return self
 
+    def _cache_path(self, n_features):
+        if (self.cache_dir is None or
+                not isinstance(self.random_state, (int, np.integer))):
+            return None
+        name = (f'orf_{n_features}_{self.n_components}_'
+                f'{float(self.gamma)!r}_{int(self.random_state)}.npz')
+        return os.path.join(self.cache_dir, name)
+
     def transform(self, X):
         """Apply the approximate feature map to X.
 
@@ -3,15 +3,70 @@ Layers implementing quantum feature maps, measurements and
 utilities.
 """
 
+import warnings
 import numpy as np
 import tensorflow as tf
 from sklearn.kernel_approximation import RBFSampler
+from sklearn.utils import check_random_state
 from . import _RBFSamplerORF
 
 
 
 ##### Quantum Feature Map Layers
 
+def _high_precision(x):
+    """
+    Casts half precision tensors to float32. Used for the numerically
+    sensitive parts (normalizations, phases) when the layers run with a
+    mixed precision policy.
+    """
+    x = tf.convert_to_tensor(x)
+    if x.dtype in (tf.float16, tf.bfloat16):
+        return tf.cast(x, tf.float32)
+    return x
+
+def _complex_dtype(dtype):
+    """
+    Returns the complex dtype used for a layer with the given float dtype.
+    There are no half precision complex types, so complex64 is used for
+    float16, bfloat16 and float32.
+    """
+    if tf.as_dtype(dtype) == tf.float64:
+        return tf.complex128
+    return tf.complex64
+
+def _split_complex(z, dtype):
+    """
+    Returns the real and imaginary parts of a tensor cast to dtype. Real
+    tensors have a zero imaginary part. Used by the complex layers with
+    `real_blocks=True`.
+    """
+    z = tf.convert_to_tensor(z)
+    if z.dtype.is_complex:
+        return tf.cast(tf.math.real(z), dtype), tf.cast(tf.math.imag(z), dtype)
+    z = tf.cast(z, dtype)
+    return z, tf.zeros_like(z)
+
+def _sparse_from_scipy(value):
+    """Converts a scipy sparse matrix to a `tf.SparseTensor`."""
+    coo = value.tocoo()
+    indices = np.stack((coo.row, coo.col), axis=1).astype(np.int64)
+    sparse = tf.SparseTensor(indices, coo.data, coo.shape)
+    return tf.sparse.reorder(sparse)
+
+def _input_matmul(inputs, weights):
+    """
+    Computes `inputs @ weights` for dense inputs, `tf.SparseTensor` inputs
+    or scipy sparse inputs. Sparse inputs use a sparse-dense product and
+    are never densified.
+    """
+    if hasattr(inputs, 'tocoo'):
+        inputs = _sparse_from_scipy(inputs)
+    if isinstance(inputs, tf.SparseTensor):
+        inputs = tf.cast(inputs, weights.dtype)
+        return tf.sparse.sparse_dense_matmul(inputs, weights)
+    return tf.matmul(inputs, weights)
+
 
 class QFeatureMapSmp(tf.keras.layers.Layer):
     """Quantum feature map using soft max probabilities.
@@ -20,21 +75,26 @@ class QFeatureMapSmp(tf.keras.layers.Layer):
     Input shape:
         (batch_size, dim1)
     Output shape:
-        (batch_size, dim ** dim1)
+        (batch_size, dim ** dim1), or (batch_size, dim1, dim) if factored
     Arguments:
         dim: int. Number of dimensions to represent each value
         beta: parameter beta of the softmax function
+        factored: bool. If True the product state is returned as the
+            per-feature amplitude vectors instead of the full tensor
+            product, see `QMeasureClassifCP`
     """
 
     def __init__(
             self,
             dim: int = 2,
             beta: float = 4,
+            factored: bool = False,
             **kwargs
     ):
         super().__init__(**kwargs)
         self.dim = dim
         self.beta = beta
+        self.factored = factored
 
 
     def build(self, input_shape):
@@ -46,12 +106,15 @@ class QFeatureMapSmp(tf.keras.layers.Layer):
         self.built = True
 
     def call(self, inputs):
-        vals = tf.expand_dims(inputs, axis=-1) # shape (..., n, 1)
-        dists = (self.points - vals) ** 2 # shape (..., n, dim)
+        vals = tf.expand_dims(_high_precision(inputs), axis=-1) # shape (..., n, 1)
+        points = tf.cast(self.points, vals.dtype)
+        dists = (points - vals) ** 2 # shape (..., n, dim)
         sm = tf.exp(-dists * self.beta) # shape (..., n, dim)
         sums = tf.math.reduce_sum(sm, axis=-1) # shape (..., n)
         sm = sm / tf.expand_dims(sums, axis=-1) # shape (..., n, dim)
-        amp = tf.sqrt(sm) # shape (..., n, dim)
+        amp = tf.cast(tf.sqrt(sm), inputs.dtype) # shape (..., n, dim)
+        if self.factored:
+            return amp
         b_size = tf.shape(amp)[0]
         t_psi = amp[:, 0, :]
         for i in range(1, amp.shape[1]):
@@ -62,12 +125,15 @@ class QFeatureMapSmp(tf.keras.layers.Layer):
     def get_config(self):
         config = {
             "dim": self.dim,
-            "beta": self.beta
+            "beta": self.beta,
+            "factored": self.factored
         }
         base_config = super().get_config()
         return {**base_config, **config}
 
     def compute_output_shape(self, input_shape):
+        if self.factored:
+            return (input_shape[0], input_shape[1], self.dim)
         return (input_shape[0], self.dim ** input_shape[1])
 
 class QFeatureMapOneHot(tf.keras.layers.Layer):
@@ -77,18 +143,32 @@ class QFeatureMapOneHot(tf.keras.layers.Layer):
     Input shape:
         (batch_size, dim)
     Output shape:
-        (batch_size, num_classes ** dim)
+        (batch_size, num_classes ** dim), (batch_size, dim, num_classes)
+        if factored, or (batch_size,) if output_index
     Arguments:
         num_classes: int. Number of dimensions to represent each value
+        factored: bool. If True the product state is returned as the
+            per-feature one-hot vectors instead of the full tensor
+            product, see `QMeasureClassifCP`
+        output_index: bool. If True returns the index of the non-zero
+            entry of the tensor product state, with the first column as
+            the most significant digit, see `QMeasureClassifTable`
     """
 
     def __init__(
             self,
             num_classes: int = 2,
+            factored: bool = False,
+            output_index: bool = False,
             **kwargs
     ):
         super().__init__(**kwargs)
+        if factored and output_index:
+            raise ValueError(
+                'factored and output_index cannot be used together')
         self.num_classes = num_classes
+        self.factored = factored
+        self.output_index = output_index
 
     def build(self, input_shape):
         if len(input_shape) != 2:
@@ -100,8 +180,17 @@ class QFeatureMapOneHot(tf.keras.layers.Layer):
         self.built = True
 
     def call(self, inputs):
+        if self.output_index:
+            num_cols = inputs.shape[1]
+            radix = tf.constant(
+                [self.num_classes ** (num_cols - 1 - i)
+                 for i in range(num_cols)], dtype=tf.int64)
+            return tf.reduce_sum(tf.cast(inputs, tf.int64) * radix, axis=-1)
         out = tf.one_hot(tf.cast(inputs, tf.int32),
-                         self.num_classes, on_value=1., off_value=0.)
+                         self.num_classes, on_value=1., off_value=0.,
+                         dtype=self.compute_dtype)
+        if self.factored:
+            return out
         b_size = tf.shape(out)[0]
         t_psi = out[:, 0, :]
         for i in range(1, out.shape[1]):
@@ -111,12 +200,18 @@ class QFeatureMapOneHot(tf.keras.layers.Layer):
 
     def get_config(self):
         config = {
-            "num_classes": self.num_classes
+            "num_classes": self.num_classes,
+            "factored": self.factored,
+            "output_index": self.output_index
         }
         base_config = super().get_config()
         return {**base_config, **config}
 
     def compute_output_shape(self, input_shape):
+        if self.output_index:
+            return (input_shape[0],)
+        if self.factored:
+            return (input_shape[0], input_shape[1], self.num_classes)
         return (input_shape[0], self.num_classes ** input_shape[1])
 
 class QFeatureMapRFF(tf.keras.layers.Layer):
@@ -125,7 +220,7 @@ class QFeatureMapRFF(tf.keras.layers.Layer):
     random Fourier features.
 
     Input shape:
-        (batch_size, dim_in)
+        (batch_size, dim_in), dense, `tf.SparseTensor` or scipy sparse
     Output shape:
         (batch_size, dim)
     Arguments:
@@ -159,23 +254,25 @@ class QFeatureMapRFF(tf.keras.layers.Layer):
         rbf_sampler.fit(x)
         self.rff_weights = tf.Variable(
             initial_value=rbf_sampler.random_weights_,
-            dtype=tf.float32,
+            dtype=self.variable_dtype,
             trainable=True,
             name="rff_weights")
         self.offset = tf.Variable(
             initial_value=rbf_sampler.random_offset_,
-            dtype=tf.float32,
+            dtype=self.variable_dtype,
             trainable=True,
             name="offset")
         self.built = True
 
     def call(self, inputs):
-        vals = tf.matmul(inputs, self.rff_weights) + self.offset
+        rff_weights = tf.cast(self.rff_weights, self.compute_dtype)
+        vals = _high_precision(_input_matmul(inputs, rff_weights))
+        vals = vals + tf.cast(self.offset, vals.dtype)
         vals = tf.cos(vals)
         vals = vals * tf.sqrt(2. / self.dim)
         norms = tf.linalg.norm(vals, axis=-1)
         psi = vals / tf.expand_dims(norms, axis=-1)
-        return psi
+        return tf.cast(psi, self.compute_dtype)
 
     def get_config(self):
         config = {
@@ -196,7 +293,7 @@ class QFeatureMapORF(tf.keras.layers.Layer):
     random Fourier features.
 
     Input shape:
-        (batch_size, dim_in)
+        (batch_size, dim_in), dense, `tf.SparseTensor` or scipy sparse
     Output shape:
         (batch_size, dim)
     Arguments:
@@ -204,6 +301,8 @@ class QFeatureMapORF(tf.keras.layers.Layer):
         dim: int. Number of dimensions to represent a sample.
         gamma: float. Gamma parameter of the RBF kernel to be approximated.
         random_state: random number generator seed.
+        cache_dir: directory where the random weights are cached, see
+            `RBFSamplerORF`.
     """
 
     def __init__(
@@ -212,6 +311,7 @@ class QFeatureMapORF(tf.keras.layers.Layer):
             dim: int = 100,
             gamma: float = 1,
             random_state=None,
+            cache_dir=None,
             **kwargs
     ):
         super().__init__(**kwargs)
@@ -219,41 +319,46 @@ class QFeatureMapORF(tf.keras.layers.Layer):
         self.dim = dim
         self.gamma = gamma
         self.random_state = random_state
+        self.cache_dir = cache_dir
 
 
     def build(self, input_shape):
         rbf_sampler = _RBFSamplerORF.RBFSamplerORF(
             gamma=self.gamma,
             n_components=self.dim,
-            random_state=self.random_state)
+            random_state=self.random_state,
+            cache_dir=self.cache_dir)
         x = np.zeros(shape=(1, self.input_dim))
         rbf_sampler.fit(x)
         self.rff_weights = tf.Variable(
             initial_value=rbf_sampler.random_weights_,
-            dtype=tf.float32,
+            dtype=self.variable_dtype,
             trainable=True,
             name="rff_weights")
         self.offset = tf.Variable(
             initial_value=rbf_sampler.random_offset_,
-            dtype=tf.float32,
+            dtype=self.variable_dtype,
             trainable=True,
             name="offset")
         self.built = True
 
     def call(self, inputs):
-        vals = tf.matmul(inputs, self.rff_weights) + self.offset
+        rff_weights = tf.cast(self.rff_weights, self.compute_dtype)
+        vals = _high_precision(_input_matmul(inputs, rff_weights))
+        vals = vals + tf.cast(self.offset, vals.dtype)
         vals = tf.cos(vals)
         vals = vals * tf.sqrt(2. / self.dim)
         norms = tf.linalg.norm(vals, axis=1)
         psi = vals / tf.expand_dims(norms, axis=-1)
-        return psi
+        return tf.cast(psi, self.compute_dtype)
 
     def get_config(self):
         config = {
             "input_dim": self.input_dim,
             "dim": self.dim,
             "gamma": self.gamma,
-            "random_state": self.random_state
+            "random_state": self.random_state,
+            "cache_dir": self.cache_dir
         }
         base_config = super().get_config()
         return {**base_config, **config}
@@ -263,13 +368,120 @@ class QFeatureMapORF(tf.keras.layers.Layer):
 
 
 
+class QFeatureMapSORF(tf.keras.layers.Layer):
+    """Quantum feature map using Structured Orthogonal Random Features.
+    Approximates an RBF kernel replacing the random projection matrix by
+    products of normalized Hadamard and random sign diagonal matrices,
+    `sqrt(2 * gamma) * sqrt(d) * H D1 H D2 H D3`, which are applied with a
+    fast Walsh-Hadamard transform in O(dim log input_dim) time and stored
+    with O(dim) parameters. The input is zero padded to the next power of
+    two d, and ceil(dim / d) independent blocks are stacked.
+
+    Input shape:
+        (batch_size, dim_in)
+    Output shape:
+        (batch_size, dim)
+    Arguments:
+        input_dim: dimension of the input
+        dim: int. Number of dimensions to represent a sample.
+        gamma: float. Gamma parameter of the RBF kernel to be approximated.
+        random_state: random number generator seed.
+
+    See "Orthogonal Random Features" by Felix, X et al.
+    (https://arxiv.org/pdf/1610.09072)
+    """
+
+    def __init__(
+            self,
+            input_dim: int,
+            dim: int = 100,
+            gamma: float = 1,
+            random_state=None,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.input_dim = input_dim
+        self.dim = dim
+        self.gamma = gamma
+        self.random_state = random_state
+
+    def build(self, input_shape):
+        rng = check_random_state(self.random_state)
+        self.dim_pad = 1 << max(self.input_dim - 1, 0).bit_length()
+        self.num_blocks = -(-self.dim // self.dim_pad)
+        signs = rng.choice(
+            [-1., 1.], size=(3, self.num_blocks, self.dim_pad))
+        offset = rng.uniform(0, 2 * np.pi, size=self.dim)
+        log_d = self.dim_pad.bit_length() - 1
+        self.hadamard_factors = []
+        for bits in [6] * (log_d // 6) + ([log_d % 6] if log_d % 6 else []):
+            h_f = np.ones((1, 1))
+            for _ in range(bits):
+                h_f = np.kron(h_f, [[1., 1.], [1., -1.]])
+            self.hadamard_factors.append(
+                tf.constant(h_f / np.sqrt(2 ** bits), dtype=self.compute_dtype))
+        self.diags = tf.Variable(
+            initial_value=signs,
+            dtype=self.variable_dtype,
+            trainable=True,
+            name="diags")
+        self.offset = tf.Variable(
+            initial_value=offset,
+            dtype=self.variable_dtype,
+            trainable=True,
+            name="offset")
+        self.built = True
+
+    def _fwht(self, x):
+        """Normalized Walsh-Hadamard transform along the last axis.
+        Uses H_d = H_f1 x ... x H_fk (Kronecker product) with small dense
+        factors; each step contracts the leading factor axis and moves it
+        last, so after k steps the axes are back in their original order.
+        """
+        shape = tf.shape(x)
+        for h_f in self.hadamard_factors:
+            f = h_f.shape[0]
+            x = tf.reshape(x, (-1, f, self.dim_pad // f))
+            x = tf.einsum('nfr,fg->nrg', x, h_f)
+        return tf.reshape(x, shape)
+
+    def call(self, inputs):
+        diags = tf.cast(self.diags, self.compute_dtype)
+        x = tf.pad(inputs, [[0, 0], [0, self.dim_pad - self.input_dim]])
+        x = tf.expand_dims(x, axis=1) * diags[2] # shape (b, nb, d)
+        x = self._fwht(x) * diags[1]
+        x = self._fwht(x) * diags[0]
+        x = self._fwht(x)
+        x = tf.reshape(x, (-1, self.num_blocks * self.dim_pad))[:, :self.dim]
+        x = _high_precision(x)
+        vals = (np.sqrt(2 * self.gamma * self.dim_pad) * x +
+                tf.cast(self.offset, x.dtype))
+        vals = tf.cos(vals)
+        vals = vals * tf.sqrt(2. / self.dim)
+        norms = tf.linalg.norm(vals, axis=-1)
+        psi = vals / tf.expand_dims(norms, axis=-1)
+        return tf.cast(psi, self.compute_dtype)
+
+    def get_config(self):
+        config = {
+            "input_dim": self.input_dim,
+            "dim": self.dim,
+            "gamma": self.gamma,
+            "random_state": self.random_state
+        }
+        base_config = super().get_config()
+        return {**base_config, **config}
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0], self.dim)
+
 class QFeatureMapComplexRFF(tf.keras.layers.Layer):
     """Quantum feature map including the complex part of random Fourier Features.
     Uses `RBFSampler` from sklearn to approximate an RBF kernel using
     complex random Fourier features.
 
     Input shape:
-        (batch_size, dim_in)
+        (batch_size, dim_in), dense, `tf.SparseTensor` or scipy sparse
     Output shape:
         (batch_size, dim)
     Arguments:
@@ -305,15 +517,16 @@ class QFeatureMapComplexRFF(tf.keras.layers.Layer):
         rbf_sampler.fit(x)
         self.rff_weights = tf.Variable(
             initial_value=rbf_sampler.random_weights_,
-            dtype=tf.float32,
+            dtype=self.variable_dtype,
             trainable=self.train_ffs,
             name="rff_weights")
         self.built = True
 
     def call(self, inputs):
-        vals = tf.matmul(inputs, self.rff_weights)
+        rff_weights = tf.cast(self.rff_weights, self.compute_dtype)
+        vals = _high_precision(_input_matmul(inputs, rff_weights))
         vals = tf.complex(tf.cos(vals), tf.sin(vals))
-        vals = vals * tf.cast(tf.sqrt(1. / self.dim), tf.complex64)
+        vals = vals * tf.cast(tf.sqrt(1. / self.dim), vals.dtype)
         norms = tf.linalg.norm(vals, axis=1)
         psi = vals / tf.expand_dims(norms, axis=-1)
         return psi
@@ -333,6 +546,383 @@ class QFeatureMapComplexRFF(tf.keras.layers.Layer):
 
 ##### Quantum Measurement layers
 
+def randomized_eigh(a, k, tol=1e-4, oversample=10, max_iter=30, seed=None):
+    """
+    Approximates the k largest eigenpairs of a Hermitian positive
+    semidefinite matrix, or a batch of them, using randomized subspace
+    iteration with a Rayleigh-Ritz projection. It iterates until the
+    largest change of the k leading Ritz values, relative to the largest
+    one, is below tol, or for max_iter iterations, warning in eager mode
+    if it did not converge. The loop is a `tf.while_loop`, so it can run
+    inside a `tf.function`.
+
+    Arguments:
+        a: tensor of shape (..., n, n)
+        k: int. number of eigenpairs
+        tol: float. tolerance on the relative change of the eigenvalues
+        oversample: int. extra dimensions of the iterated subspace
+        max_iter: int. maximum number of iterations
+        seed: int. seed of the random starting subspace
+    Returns:
+        e: eigenvalues in non-decreasing order, shape (..., k)
+        v: eigenvectors, shape (..., n, k)
+    """
+    a = tf.convert_to_tensor(a)
+    n = a.shape[-1]
+    dim_sub = min(k + oversample, n)
+    if dim_sub >= n:
+        e, v = tf.linalg.eigh(a)
+        return e[..., -k:], v[..., -k:]
+    real_dtype = a.dtype.real_dtype
+    tiny = np.finfo(real_dtype.as_numpy_dtype).tiny
+    omega = tf.random.normal(a.shape[:-1] + (dim_sub,), seed=seed,
+                             dtype=real_dtype)
+    q, _ = tf.linalg.qr(tf.matmul(a, tf.cast(omega, a.dtype)))
+
+    def rayleigh_ritz(q):
+        z = tf.matmul(a, q)
+        e, w = tf.linalg.eigh(tf.matmul(q, z, adjoint_a=True))
+        return z, e, w
+
+    def cond(i, q, z, e, w, change):
+        return tf.logical_and(i < max_iter, change >= tol)
+
+    def body(i, q, z, e, w, change):
+        q, _ = tf.linalg.qr(z)
+        z, e_new, w = rayleigh_ritz(q)
+        scale = tf.maximum(tf.reduce_max(tf.abs(e_new)), tiny)
+        change = tf.reduce_max(tf.abs(e_new[..., -k:] - e[..., -k:])) / scale
+        return i + 1, q, z, e_new, w, change
+
+    z, e, w = rayleigh_ritz(q)
+    _, q, _, e, w, change = tf.while_loop(
+        cond, body,
+        (tf.constant(1), q, z, e, w, tf.constant(np.inf, real_dtype)))
+    # w is the Ritz basis of the last q
+    v = tf.matmul(q, w[..., -k:])
+    if tf.executing_eagerly() and change >= tol:
+        warnings.warn(
+            f'randomized_eigh did not converge in {max_iter} iterations, '
+            f'the relative change of the eigenvalues is {float(change):.2g}')
+    return e[..., -k:], v
+
+def nystrom_eigh(sketch, omega, k, eps=None):
+    """
+    Approximates the k largest eigenpairs of a Hermitian positive
+    semidefinite matrix a from its sketch a omega, where omega has
+    orthonormal columns, using the stabilized Nystrom approximation
+    a ~ (a omega) (omega^H a omega)^+ (a omega)^H. The sketch is linear
+    in a, so it can be summed over a stream of samples, see `GramSketch`,
+    without forming a.
+
+    Arguments:
+        sketch: tensor of shape (n, l), the product a omega
+        omega: tensor of shape (n, l) with orthonormal columns
+        k: int. number of eigenpairs, at most l
+        eps: float. relative shift that keeps the Cholesky factorization
+            stable. Defaults to the machine epsilon of the sketch dtype.
+    Returns:
+        e: eigenvalues in non-decreasing order, shape (k,)
+        v: eigenvectors, shape (n, k)
+    """
+    sketch = tf.convert_to_tensor(sketch)
+    omega = tf.cast(omega, sketch.dtype)
+    if eps is None:
+        eps = np.finfo(sketch.dtype.real_dtype.as_numpy_dtype).eps
+    nu = eps * tf.linalg.norm(sketch)
+    sketch = sketch + tf.cast(nu, sketch.dtype) * omega
+    b = tf.matmul(omega, sketch, adjoint_a=True)
+    c = tf.linalg.cholesky((b + tf.linalg.adjoint(b)) / 2)
+    # sketch c^-H, whose left singular vectors are the eigenvectors
+    f = tf.linalg.adjoint(tf.linalg.triangular_solve(
+        c, tf.linalg.adjoint(sketch), lower=True))
+    s, u, _ = tf.linalg.svd(f)
+    e = tf.nn.relu(tf.square(s[:k]) - nu)
+    return tf.reverse(e, [0]), tf.reverse(u[:, :k], [1])
+
+def eigh_update(factor, psi, weight, k):
+    """
+    Truncated rank-k update of a density matrix given by a factor,
+    factor factor^H. Returns the top k eigenpairs of
+
+        (1 - weight) factor factor^H + weight mean_i psi_i psi_i^H
+
+    from the thin SVD of [sqrt(1 - weight) factor, sqrt(weight / b) psi^T],
+    with O(n (m + b)^2) cost instead of the O(n^3) of an eigendecomposition
+    of the dense matrix.
+
+    Arguments:
+        factor: tensor of shape (n, m)
+        psi: tensor of shape (b, n)
+        weight: float in [0, 1]
+        k: int. number of eigenpairs, at most m + b
+    Returns:
+        e: eigenvalues in non-decreasing order, shape (k,)
+        v: eigenvectors, shape (n, k)
+    """
+    factor = tf.convert_to_tensor(factor)
+    psi = tf.cast(psi, factor.dtype)
+    real_dtype = factor.dtype.real_dtype
+    weight = tf.cast(weight, real_dtype)
+    num_samples = tf.cast(tf.shape(psi)[0], real_dtype)
+    a = tf.concat(
+        (factor * tf.cast(tf.sqrt(1. - weight), factor.dtype),
+         tf.transpose(psi) * tf.cast(tf.sqrt(weight / num_samples),
+                                     factor.dtype)),
+        axis=1) # shape (n, m + b)
+    s, u, _ = tf.linalg.svd(a)
+    return tf.reverse(tf.square(s[:k]), [0]), tf.reverse(u[:, :k], [1])
+
+def _eigh(a, k, method, tol):
+    if method == 'eigh':
+        return tf.linalg.eigh(a)
+    if method == 'randomized':
+        return randomized_eigh(a, k, tol=tol)
+    raise ValueError(
+        f"method must be 'eigh' or 'randomized' but it is {method}")
+
+class _FactorCache:
+    """
+    Holds the frozen factors of a layer. It is not trackable, so its
+    variables are neither layer weights nor saved in checkpoints.
+    """
+
+    def __init__(self, factors):
+        self.valid = tf.Variable(False, trainable=False)
+        self.factors = [tf.Variable(factor, trainable=False)
+                        for factor in factors]
+
+
+class _FrozenFactors:
+    """
+    Mixin for measurement layers whose call starts with a preprocessing
+    that only depends on the weights (column norms, normalization of
+    eig_val, ...). The layer implements `_factors`, which returns a tuple
+    with the preprocessed tensors, and calls `_build_factor_cache` at the
+    end of `build`.
+
+    `freeze` computes the factors once and makes `call` use them instead
+    of recomputing them on every batch, e.g. for inference. The
+    `set_rho*`, `set_eig`, `update_rho` and `set_weights` methods of the
+    layer recompute them. After assigning the weights directly or
+    through `Model.set_weights`, call `freeze` again.
+    """
+
+    def _build_factor_cache(self):
+        self._factor_cache = _FactorCache(self._factors())
+
+    def _current_factors(self):
+        cache = self._factor_cache
+        return tuple(tf.cond(
+            cache.valid,
+            lambda: [factor.read_value() for factor in cache.factors],
+            lambda: list(self._factors())))
+
+    def freeze(self):
+        """
+        Precomputes the factors used by `call` and sets `trainable` to
+        False, since no gradients flow through the frozen factors.
+        """
+        if not self.built:
+            raise ValueError('The layer must be built before freezing it')
+        for factor, value in zip(self._factor_cache.factors,
+                                 self._factors()):
+            factor.assign(value)
+        self._factor_cache.valid.assign(True)
+        self.trainable = False
+
+    def unfreeze(self):
+        """
+        Makes `call` compute the factors from the weights again and sets
+        `trainable` to True.
+        """
+        if self.built:
+            self._factor_cache.valid.assign(False)
+        self.trainable = True
+
+    def _refresh_factor_cache(self):
+        if self.built and self._factor_cache.valid:
+            for factor, value in zip(self._factor_cache.factors,
+                                     self._factors()):
+                factor.assign(value)
+
+    def set_weights(self, weights):
+        super().set_weights(weights)
+        self._refresh_factor_cache()
+
+def _num_blocks(dim_x, block_size):
+    return -(-dim_x // block_size)
+
+def packed_shape(dim_x, dim_y, block_size):
+    """
+    Returns the shape of the packed form of `pack_hermitian` of a
+    (dim_x, dim_x) matrix, if dim_y is None, or of a
+    (dim_x, dim_y, dim_x, dim_y) one.
+    """
+    block_size = min(block_size, dim_x)
+    nb = _num_blocks(dim_x, block_size)
+    if dim_y is None:
+        return (nb * (nb + 1) // 2, block_size, block_size)
+    return (nb * (nb + 1) // 2, block_size, dim_y, block_size, dim_y)
+
+def pack_hermitian(rho, block_size):
+    """
+    Packs a Hermitian matrix in blocked upper triangular form. The x axis
+    is split in blocks of block_size indices, the last one padded with
+    zeros, and only the blocks (I, J) with I <= J are kept, in row-major
+    order. The blocks below the diagonal are the adjoints of the stored
+    ones.
+
+    Arguments:
+        rho: tensor of shape (dim_x, dim_x) or (dim_x, dim_y, dim_x, dim_y)
+        block_size: int. number of x indices per block
+    Returns:
+        packed: tensor of shape (nb (nb + 1) / 2, bs, bs) or
+            (nb (nb + 1) / 2, bs, dim_y, bs, dim_y), where
+            bs = min(block_size, dim_x) and nb = ceil(dim_x / bs)
+    """
+    rho = tf.convert_to_tensor(rho)
+    matrix = len(rho.shape) == 2
+    if matrix:
+        rho = rho[:, tf.newaxis, :, tf.newaxis]
+    dim_x, dim_y = rho.shape[0], rho.shape[1]
+    block_size = min(block_size, dim_x)
+    nb = _num_blocks(dim_x, block_size)
+    pad = nb * block_size - dim_x
+    rho = tf.pad(rho, [[0, pad], [0, 0], [0, pad], [0, 0]])
+    rows = []
+    for i in range(nb):
+        row = rho[i * block_size:(i + 1) * block_size, :, i * block_size:]
+        row = tf.reshape(row, (block_size, dim_y, nb - i, block_size, dim_y))
+        rows.append(tf.transpose(row, (2, 0, 1, 3, 4)))
+    packed = tf.concat(rows, axis=0)
+    if matrix:
+        packed = packed[:, :, 0, :, 0]
+    return packed
+
+def unpack_hermitian(packed, dim_x):
+    """
+    Inverse of `pack_hermitian`.
+
+    Arguments:
+        packed: tensor of shape (num_blocks, bs, bs) or
+            (num_blocks, bs, dim_y, bs, dim_y)
+        dim_x: int. the dimension of the unpacked x axis
+    Returns:
+        rho: tensor of shape (dim_x, dim_x) or (dim_x, dim_y, dim_x, dim_y)
+    """
+    packed = tf.convert_to_tensor(packed)
+    matrix = len(packed.shape) == 3
+    if matrix:
+        packed = packed[:, :, tf.newaxis, :, tf.newaxis]
+    block_size, dim_y = packed.shape[1], packed.shape[2]
+    nb = _num_blocks(dim_x, block_size)
+    upper, upper_off = [], []
+    start = 0
+    for i in range(nb):
+        row = packed[start:start + nb - i] # shape (nb - i, bs, ny, bs, ny)
+        start += nb - i
+        row_off = tf.concat((tf.zeros_like(row[:1]), row[1:]), axis=0)
+        left = tf.zeros((i,) + tuple(row.shape[1:]), dtype=packed.dtype)
+        for blocks, rows in ((row, upper), (row_off, upper_off)):
+            blocks = tf.transpose(tf.concat((left, blocks), axis=0),
+                                  (1, 2, 0, 3, 4))
+            rows.append(tf.reshape(
+                blocks, (block_size, dim_y, nb * block_size, dim_y)))
+    upper = tf.concat(upper, axis=0)
+    upper_off = tf.concat(upper_off, axis=0)
+    rho = upper + tf.math.conj(tf.transpose(upper_off, (2, 3, 0, 1)))
+    rho = rho[:dim_x, :, :dim_x, :]
+    if matrix:
+        rho = rho[:, 0, :, 0]
+    return rho
+
+def packed_gram(psi, block_size):
+    """
+    Calculates sum_i psi_i psi_i^H over the batch in the packed form of
+    `pack_hermitian`. Only the upper triangular blocks are computed, one
+    matrix product per block row, so it takes about half the flops and
+    memory of the dense product.
+
+    Arguments:
+        psi: tensor of shape (batch_size, dim_x) or
+            (batch_size, dim_x, dim_y), with static dim_x and dim_y
+        block_size: int. number of x indices per block
+    Returns:
+        packed: tensor of shape (num_blocks, bs, bs) or
+            (num_blocks, bs, dim_y, bs, dim_y)
+    """
+    psi = tf.convert_to_tensor(psi)
+    vector = len(psi.shape) == 2
+    if vector:
+        psi = psi[:, :, tf.newaxis]
+    dim_x, dim_y = psi.shape[1], psi.shape[2]
+    block_size = min(block_size, dim_x)
+    nb = _num_blocks(dim_x, block_size)
+    psi = tf.pad(psi, [[0, 0], [0, nb * block_size - dim_x], [0, 0]])
+    m = block_size * dim_y
+    psi = tf.reshape(psi, (-1, nb * m))
+    rows = []
+    for i in range(nb):
+        row = tf.matmul(psi[:, i * m:(i + 1) * m], tf.math.conj(psi[:, i * m:]),
+                        transpose_a=True) # shape (bs ny, (nb - i) bs ny)
+        row = tf.reshape(row, (block_size, dim_y, nb - i, block_size, dim_y))
+        rows.append(tf.transpose(row, (2, 0, 1, 3, 4)))
+    packed = tf.concat(rows, axis=0)
+    if vector:
+        packed = packed[:, :, 0, :, 0]
+    return packed
+
+def _packed_measure(psi, packed, dim_x, output_dist=False):
+    """
+    Calculates rho_y[j, k] = sum_im conj(psi_i) rho[i, j, m, k] psi_m,
+    or only its diagonal if output_dist, reading the upper triangular
+    blocks of rho from its packed form. Each stored block (I, J) with
+    I < J also accounts for its mirrored block (J, I), whose contribution
+    is the adjoint of its own.
+
+    Arguments:
+        psi: tensor of shape (batch_size, dim_x)
+        packed: tensor of shape (num_blocks, bs, dim_y, bs, dim_y)
+        dim_x: int. the dimension of the input state
+        output_dist: bool
+    Returns:
+        rho_y: tensor of shape (batch_size, dim_y, dim_y), or
+            (batch_size, dim_y) if output_dist
+    """
+    block_size, dim_y = packed.shape[1], packed.shape[2]
+    nb = _num_blocks(dim_x, block_size)
+    psi = tf.pad(psi, [[0, 0], [0, nb * block_size - dim_x]])
+    rho_y = None
+    start = 0
+    for i in range(nb):
+        n_j = nb - i
+        row = packed[start:start + n_j] # shape (n_j, bs, ny, bs, ny)
+        start += n_j
+        psi_i = tf.math.conj(psi[:, i * block_size:(i + 1) * block_size])
+        psi_j = psi[:, i * block_size:]
+        if output_dist:
+            row = tf.einsum('kijmj->ijkm', row) # shape (bs, ny, n_j, bs)
+            row = tf.reshape(row, (block_size, dim_y * n_j * block_size))
+            row_h = tf.reshape(tf.matmul(psi_i, row),
+                               (-1, dim_y, n_j * block_size))
+            contract, adjoint = '...jm,...m->...j', tf.math.conj
+        else:
+            row = tf.transpose(row, (1, 2, 0, 3, 4)) # shape (bs, ny, n_j, bs, ny)
+            row = tf.reshape(
+                row, (block_size, dim_y * n_j * block_size * dim_y))
+            row_h = tf.reshape(tf.matmul(psi_i, row),
+                               (-1, dim_y, n_j * block_size, dim_y))
+            contract, adjoint = '...jmk,...m->...jk', tf.linalg.adjoint
+        res = tf.einsum(contract, row_h[:, :, :block_size],
+                        psi_j[:, :block_size], optimize='optimal')
+        if n_j > 1:
+            res_off = tf.einsum(contract, row_h[:, :, block_size:],
+                                psi_j[:, block_size:], optimize='optimal')
+            res = res + res_off + adjoint(res_off)
+        rho_y = res if rho_y is None else rho_y + res
+    return rho_y
+
 class QMeasureClassif(tf.keras.layers.Layer):
     """Quantum measurement layer for classification.
 
@@ -342,36 +932,80 @@ class QMeasureClassif(tf.keras.layers.Layer):
     Output shape:
         (batch_size, dim_y, dim_y)
         where dim_y is the dimension of the output state
+        or, if output_dist is True,
+        (batch_size, dim_y)
     Arguments:
         dim_x: int. the dimension of the input  state
         dim_y: int. the dimension of the output state
+        contraction: str. 'fused' computes rho_y directly as
+            psi^H rho psi with O(b nx^2 ny^2) cost. 'outer' builds
+            the (b, nx, ny, nx, ny) projected density matrix and
+            traces it out.
+        output_dist: bool. If True, returns only the diagonal of rho_y,
+            i.e. the probability distribution over the output states.
+        packed: bool. If True only the upper triangular blocks of rho are
+            stored, in the weight rho_packed, see `pack_hermitian`, and
+            the measurement reads them directly. contraction is ignored.
+        block_size: int. number of x indices per block of the packed
+            form
     """
 
     def __init__(
             self,
             dim_x: int,
             dim_y: int = 2,
+            contraction: str = 'fused',
+            output_dist: bool = False,
+            packed: bool = False,
+            block_size: int = 256,
             **kwargs
     ):
         super().__init__(**kwargs)
+        if contraction not in ('fused', 'outer'):
+            raise ValueError(
+                f"contraction must be 'fused' or 'outer' but it is"
+                f" '{contraction}'")
         self.dim_x = dim_x
         self.dim_y = dim_y
+        self.contraction = contraction
+        self.output_dist = output_dist
+        self.packed = packed
+        self.block_size = block_size
 
     def build(self, input_shape):
         if (not input_shape[1] is None) and input_shape[1] != self.dim_x:
             raise ValueError(
                 f'Input dimension must be (batch_size, {self.dim_x})')
-        self.rho = self.add_weight(
-            "rho",
-            shape=(self.dim_x, self.dim_y, self.dim_x, self.dim_y),
-            initializer=tf.keras.initializers.Zeros(),
-            trainable=True)
+        if self.packed:
+            self.rho_packed = self.add_weight(
+                "rho_packed",
+                shape=packed_shape(self.dim_x, self.dim_y, self.block_size),
+                initializer=tf.keras.initializers.Zeros(),
+                trainable=True)
+        else:
+            self.rho = self.add_weight(
+                "rho",
+                shape=(self.dim_x, self.dim_y, self.dim_x, self.dim_y),
+                initializer=tf.keras.initializers.Zeros(),
+                trainable=True)
         axes = {i: input_shape[i] for i in range(1, len(input_shape))}
         self.input_spec = tf.keras.layers.InputSpec(
             ndim=len(input_shape), axes=axes)
         self.built = True
 
     def call(self, inputs):
+        if self.packed:
+            return self._call_packed(inputs)
+        if self.contraction == 'outer':
+            rho_y = self._call_outer(inputs)
+            if self.output_dist:
+                return tf.einsum('...ii->...i', rho_y, optimize='optimal')
+            return rho_y
+        if self.output_dist:
+            return self._call_fused_dist(inputs)
+        return self._call_fused(inputs)
+
+    def _call_outer(self, inputs):
         oper = tf.einsum(
             '...i,...j->...ij',
             inputs, tf.math.conj(inputs),
@@ -380,6 +1014,7 @@ class QMeasureClassif(tf.keras.layers.Layer):
             '...ik, klmn, ...mo -> ...ilon',
             oper, self.rho, oper,
             optimize='optimal')  # shape (b, nx, ny, ny, nx)
+        rho_res = _high_precision(rho_res)
         trace_val = tf.einsum('...ijij->...', rho_res, optimize='optimal') # shape (b)
         trace_val = tf.expand_dims(trace_val, axis=-1)
         trace_val = tf.expand_dims(trace_val, axis=-1)
@@ -387,26 +1022,112 @@ class QMeasureClassif(tf.keras.layers.Layer):
         trace_val = tf.expand_dims(trace_val, axis=-1)
         rho_res = rho_res / trace_val
         rho_y = tf.einsum('...ijik->...jk', rho_res, optimize='optimal') # shape (b, ny, ny)
-        return rho_y
+        return tf.cast(rho_y, inputs.dtype)
+
+    def _call_fused(self, inputs):
+        rho = tf.reshape(
+            self.rho,
+            (self.dim_x, self.dim_y * self.dim_x * self.dim_y))
+        rho_h = tf.matmul(tf.math.conj(inputs), rho) # shape (b, ny * nx * ny)
+        rho_h = tf.reshape(rho_h, (-1, self.dim_y, self.dim_x, self.dim_y))
+        rho_y = tf.einsum('...jmk,...m->...jk', rho_h, inputs,
+                          optimize='optimal') # shape (b, ny, ny)
+        rho_y = _high_precision(rho_y)
+        trace_val = tf.einsum('...jj->...', rho_y, optimize='optimal') # shape (b)
+        trace_val = tf.expand_dims(trace_val, axis=-1)
+        trace_val = tf.expand_dims(trace_val, axis=-1)
+        rho_y = rho_y / trace_val
+        return tf.cast(rho_y, inputs.dtype)
+
+    def _call_fused_dist(self, inputs):
+        rho_d = tf.einsum('ijkj->ikj', self.rho) # shape (nx, nx, ny)
+        rho_d = tf.reshape(rho_d, (self.dim_x, self.dim_x * self.dim_y))
+        rho_h = tf.matmul(tf.math.conj(inputs), rho_d) # shape (b, nx * ny)
+        rho_h = tf.reshape(rho_h, (-1, self.dim_x, self.dim_y))
+        dist = tf.einsum('...kj,...k->...j', rho_h, inputs,
+                         optimize='optimal') # shape (b, ny)
+        dist = _high_precision(dist)
+        trace_val = tf.reduce_sum(dist, axis=-1, keepdims=True)
+        dist = dist / trace_val
+        return tf.cast(dist, inputs.dtype)
+
+    def _call_packed(self, inputs):
+        rho_y = _packed_measure(inputs, self.rho_packed, self.dim_x,
+                                self.output_dist)
+        rho_y = _high_precision(rho_y)
+        if self.output_dist:
+            trace_val = tf.reduce_sum(rho_y, axis=-1, keepdims=True)
+        else:
+            trace_val = tf.einsum('...jj->...', rho_y, optimize='optimal') # shape (b)
+            trace_val = tf.expand_dims(trace_val, axis=-1)
+            trace_val = tf.expand_dims(trace_val, axis=-1)
+        rho_y = rho_y / trace_val
+        return tf.cast(rho_y, inputs.dtype)
+
+    def set_rho(self, rho):
+        """
+        Sets the density matrix, packing it if the layer is packed.
+
+        Arguments:
+            rho: a tensor of shape (dim_x, dim_y, dim_x, dim_y)
+        """
+        if not self.built:
+            self.build((None, self.dim_x))
+        if self.packed:
+            self.rho_packed.assign(
+                pack_hermitian(tf.cast(rho, self.rho_packed.dtype),
+                               self.block_size))
+        else:
+            self.rho.assign(tf.cast(rho, self.rho.dtype))
+
+    def set_rho_packed(self, rho_packed):
+        """
+        Sets the density matrix from its packed form, see
+        `pack_hermitian`.
+        """
+        if not self.built:
+            self.build((None, self.dim_x))
+        if self.packed:
+            self.rho_packed.assign(
+                tf.cast(rho_packed, self.rho_packed.dtype))
+        else:
+            self.rho.assign(unpack_hermitian(
+                tf.cast(rho_packed, self.rho.dtype), self.dim_x))
+
+    def get_rho(self):
+        """
+        Returns the density matrix, a tensor of shape
+        (dim_x, dim_y, dim_x, dim_y).
+        """
+        if self.packed:
+            return unpack_hermitian(self.rho_packed, self.dim_x)
+        return tf.convert_to_tensor(self.rho)
 
     def get_config(self):
         config = {
             "dim_x": self.dim_x,
-            "dim_y": self.dim_y
+            "dim_y": self.dim_y,
+            "contraction": self.contraction,
+            "output_dist": self.output_dist,
+            "packed": self.packed,
+            "block_size": self.block_size
         }
         base_config = super().get_config()
         return {**base_config, **config}
 
     def compute_output_shape(self, input_shape):
+        if self.output_dist:
+            return (self.dim_y,)
         return (self.dim_y, self.dim_y)
 
-class QMeasureClassifEig(tf.keras.layers.Layer):
+class QMeasureClassifEig(_FrozenFactors, tf.keras.layers.Layer):
     """Quantum measurement layer for classification.
     Represents the density matrix using a factorization:
 
     `dm = tf.matmul(V, tf.transpose(V, conjugate=True))`
 
     This rerpesentation is ameanable to gradient-based learning.
+    The normalized factor can be precomputed with `freeze`.
 
     Input shape:
         (batch_size, dim_x)
@@ -414,10 +1135,15 @@ class QMeasureClassifEig(tf.keras.layers.Layer):
     Output shape:
         (batch_size, dim_y, dim_y)
         where dim_y is the dimension of the output state
+        or, if output_dist is True,
+        (batch_size, dim_y)
     Arguments:
         dim_x: int. the dimension of the input state
         dim_y: int. the dimension of the output state
         num_eig: Number of eigenvectors used to represent the density matrix
+        output_dist: bool. If True, returns only the diagonal of rho_y,
+            i.e. the probability distribution over the output states,
+            without computing the off-diagonal terms.
     """
 
     def __init__(
@@ -425,6 +1151,7 @@ class QMeasureClassifEig(tf.keras.layers.Layer):
             dim_x: int,
             dim_y: int = 2,
             num_eig: int = 0,
+            output_dist: bool = False,
             **kwargs
     ):
         super().__init__(**kwargs)
@@ -433,6 +1160,7 @@ class QMeasureClassifEig(tf.keras.layers.Layer):
         if num_eig < 1:
             num_eig = dim_x * dim_y
         self.num_eig = num_eig
+        self.output_dist = output_dist
 
     def build(self, input_shape):
         if input_shape[1] != self.dim_x:
@@ -447,36 +1175,53 @@ class QMeasureClassifEig(tf.keras.layers.Layer):
             "eig_val",
             shape=(self.num_eig,),
             initializer=tf.keras.initializers.random_normal(),
-            trainable=True)
+            trainable=True,
+            experimental_autocast=False)
         axes = {i: input_shape[i] for i in range(1, len(input_shape))}
         self.input_spec = tf.keras.layers.InputSpec(
             ndim=len(input_shape), axes=axes)
+        self._build_factor_cache()
         self.built = True
 
-    def call(self, inputs):
-        norms = tf.expand_dims(tf.linalg.norm(self.eig_vec, axis=0), axis=0)
-        eig_vec = self.eig_vec / norms
+    def _factors(self):
+        eig_vec = _high_precision(self.eig_vec)
+        norms = tf.expand_dims(tf.linalg.norm(eig_vec, axis=0), axis=0)
         eig_val = tf.keras.activations.relu(self.eig_val)
         eig_val = eig_val / tf.reduce_sum(eig_val)
-        eig_vec = tf.reshape(eig_vec, (self.dim_x, self.dim_y, self.num_eig))
-        eig_vec_y = tf.einsum('...i,ijk->...jk', inputs,eig_vec, optimize='optimal') # shape (b, ny, ne)
-        eig_val_sr = tf.sqrt(eig_val)
-        eig_val_sr = tf.expand_dims(eig_val_sr, axis=0)
-        eig_val_sr = tf.expand_dims(eig_val_sr, axis=0)
-        eig_vec_y = eig_vec_y * eig_val_sr
+        rho_h = eig_vec / norms * tf.expand_dims(tf.sqrt(eig_val), axis=0)
+        rho_h = tf.reshape(rho_h, (self.dim_x, self.dim_y, self.num_eig))
+        return (rho_h,)
+
+    def call(self, inputs):
+        rho_h, = self._current_factors()
+        rho_h = tf.cast(rho_h, inputs.dtype)
+        eig_vec_y = tf.einsum('...i,ijk->...jk', inputs, rho_h, optimize='optimal') # shape (b, ny, ne)
+        if self.output_dist:
+            eig_vec_y = _high_precision(eig_vec_y)
+            dist = tf.reduce_sum(tf.square(eig_vec_y), axis=-1) # shape (b, ny)
+            dist = dist / tf.reduce_sum(dist, axis=-1, keepdims=True)
+            return tf.cast(dist, inputs.dtype)
         rho_y = tf.matmul(eig_vec_y, eig_vec_y, adjoint_b=True)
+        rho_y = _high_precision(rho_y)
         trace_val = tf.einsum('...jj->...', rho_y, optimize='optimal') # shape (b)
         trace_val = tf.expand_dims(trace_val, axis=-1)
         trace_val = tf.expand_dims(trace_val, axis=-1)
         rho_y = rho_y / trace_val
-        return rho_y
+        return tf.cast(rho_y, inputs.dtype)
 
-    def set_rho(self, rho):
+    def set_rho(self, rho, method='eigh', tol=1e-4):
         """
         Sets the value of self.rho_h using an eigendecomposition.
 
         Arguments:
             rho: a tensor of shape (dim_x, dim_y, dim_x, dim_y)
+            method: 'eigh' for a full eigendecomposition or 'randomized'
+                for an approximation of the top num_eig eigenpairs, see
+                `randomized_eigh`
+            tol: tolerance of the 'randomized' method
+        Returns:
+            e: eigenvalues in non-decreasing order, only the top num_eig
+               for the 'randomized' method
         """
         if (len(rho.shape.as_list()) != 4 or
                 rho.shape[0] != self.dim_x or
@@ -491,20 +1236,67 @@ class QMeasureClassifEig(tf.keras.layers.Layer):
         rho_prime = tf.reshape(
             rho,
             (self.dim_x * self.dim_y, self.dim_x * self.dim_y,))
-        e, v = tf.linalg.eigh(rho_prime)
+        e, v = _eigh(rho_prime, self.num_eig, method, tol)
         self.eig_vec.assign(v[:, -self.num_eig:])
         self.eig_val.assign(e[-self.num_eig:])
+        self._refresh_factor_cache()
+        return e
+
+    def set_eig(self, eig_vec, eig_val):
+        """
+        Sets the factorization from num_eig eigenpairs of the density
+        matrix, e.g. the ones computed by `nystrom_eigh`.
+
+        Arguments:
+            eig_vec: a tensor of shape (dim_x * dim_y, num_eig)
+            eig_val: a tensor of shape (num_eig,)
+        """
+        if not self.built:
+            self.build((None, self.dim_x))
+        self.eig_vec.assign(tf.cast(eig_vec, self.eig_vec.dtype))
+        self.eig_val.assign(tf.cast(eig_val, self.eig_val.dtype))
+        self._refresh_factor_cache()
+
+    def update_rho(self, psi, weight):
+        """
+        Folds a batch of states into the density matrix with a truncated
+        rank num_eig update, see `eigh_update`:
+
+            rho <- (1 - weight) rho + weight mean_i psi_i psi_i^H
+
+        A constant weight forgets the past batches exponentially, with
+        factor 1 - weight per batch. weight = b / (n + b), where n is the
+        number of samples already folded in, keeps their mean instead.
+        Use weight = 1 for the first batch.
+
+        Arguments:
+            psi: a tensor of shape (batch_size, dim_x, dim_y), the
+                joint input-output states, e.g. the output of `CrossProduct`
+            weight: float in (0, 1]
+        Returns:
+            e: the top num_eig eigenvalues in non-decreasing order
+        """
+        if not self.built:
+            self.build((None, self.dim_x))
+        rho_h, = self._factors()
+        rho_h = tf.reshape(rho_h, (self.dim_x * self.dim_y, self.num_eig))
+        psi = tf.reshape(psi, (-1, self.dim_x * self.dim_y))
+        e, v = eigh_update(rho_h, psi, weight, self.num_eig)
+        self.set_eig(v, e)
         return e
 
     def get_config(self):
         config = {
             "dim_x": self.dim_x,
-            "dim_y": self.dim_y
+            "dim_y": self.dim_y,
+            "output_dist": self.output_dist
         }
         base_config = super().get_config()
         return {**base_config, **config}
 
     def compute_output_shape(self, input_shape):
+        if self.output_dist:
+            return (self.dim_y,)
         return (self.dim_y, self.dim_y)
 
 class ComplexQMeasureClassifEig(tf.keras.layers.Layer):
@@ -521,10 +1313,20 @@ class ComplexQMeasureClassifEig(tf.keras.layers.Layer):
     Output shape:
         (batch_size, dim_y, dim_y)
         where dim_y is the dimension of the output state
+        or, if output_dist is True,
+        (batch_size, dim_y)
     Arguments:
         dim_x: int. the dimension of the input state
         dim_y: int. the dimension of the output state
         num_eig: Number of eigenvectors used to represent the density matrix
+        real_blocks: bool. If True V is stored as two real weights,
+            eig_vec_re and eig_vec_im, and the products are computed
+            with real matrix multiplications on the blocks
+            [[re, im], [-im, re]]. The complex weight is pinned to the
+            CPU, the real ones are not.
+        output_dist: bool. If True, returns only the (real) diagonal of
+            rho_y, i.e. the probability distribution over the output
+            states, without computing the off-diagonal terms.
     """
 
     def __init__(
@@ -532,6 +1334,8 @@ class ComplexQMeasureClassifEig(tf.keras.layers.Layer):
             dim_x: int,
             dim_y: int = 2,
             num_eig: int = 0,
+            real_blocks: bool = False,
+            output_dist: bool = False,
             **kwargs
     ):
         super().__init__(**kwargs)
@@ -540,36 +1344,56 @@ class ComplexQMeasureClassifEig(tf.keras.layers.Layer):
         if num_eig < 1:
             num_eig = dim_x * dim_y
         self.num_eig = num_eig
+        self.real_blocks = real_blocks
+        self.output_dist = output_dist
 
     def build(self, input_shape):
         if input_shape[1] != self.dim_x:
             raise ValueError(
                 f'Input dimension must be (batch_size, {self.dim_x})')
-        with tf.device('cpu:0'):
-            self.eig_vec = self.add_weight(
-                "eig_vec",
+        if self.real_blocks:
+            self.eig_vec_re = self.add_weight(
+                "eig_vec_re",
                 shape=(self.dim_x * self.dim_y, self.num_eig),
-                dtype=tf.complex64,
-                initializer=complex_initializer(tf.random_normal_initializer),
-                trainable=True)
+                initializer=tf.random_normal_initializer(),
+                trainable=True,
+                experimental_autocast=False)
+            self.eig_vec_im = self.add_weight(
+                "eig_vec_im",
+                shape=(self.dim_x * self.dim_y, self.num_eig),
+                initializer=tf.random_normal_initializer(),
+                trainable=True,
+                experimental_autocast=False)
+        else:
+            with tf.device('cpu:0'):
+                self.eig_vec = self.add_weight(
+                    "eig_vec",
+                    shape=(self.dim_x * self.dim_y, self.num_eig),
+                    dtype=_complex_dtype(self.variable_dtype),
+                    initializer=complex_initializer(
+                        tf.random_normal_initializer),
+                    trainable=True)
         self.eig_val = self.add_weight(
             "eig_val",
             shape=(self.num_eig,),
             initializer=tf.keras.initializers.random_normal(),
-            trainable=True)
+            trainable=True,
+            experimental_autocast=False)
         axes = {i: input_shape[i] for i in range(1, len(input_shape))}
         self.input_spec = tf.keras.layers.InputSpec(
             ndim=len(input_shape), axes=axes)
         self.built = True
 
     def call(self, inputs):
-        inputs = tf.cast(inputs, tf.complex64)
+        if self.real_blocks:
+            return self._call_real_blocks(inputs)
+        inputs = tf.cast(inputs, self.eig_vec.dtype)
         norms = tf.expand_dims(tf.linalg.norm(self.eig_vec, axis=0), axis=0)
         eig_vec = self.eig_vec / norms
         eig_val = tf.keras.activations.relu(self.eig_val)
         eig_val = eig_val / tf.reduce_sum(eig_val)
         rho_h = tf.matmul(eig_vec,
-            tf.cast(tf.linalg.diag(tf.sqrt(eig_val)), tf.complex64))
+            tf.cast(tf.linalg.diag(tf.sqrt(eig_val)), eig_vec.dtype))
         rho_h = tf.reshape(
             rho_h,
             (self.dim_x, self.dim_y, self.num_eig))
@@ -577,6 +1401,12 @@ class ComplexQMeasureClassifEig(tf.keras.layers.Layer):
             '...k, klm -> ...lm',
             inputs, rho_h,
             optimize='optimal')
+        if self.output_dist:
+            dist = tf.reduce_sum(
+                tf.square(tf.math.real(rho_h)) + tf.square(tf.math.imag(rho_h)),
+                axis=-1) # shape (b, ny)
+            dist = dist / tf.reduce_sum(dist, axis=-1, keepdims=True)
+            return tf.cast(dist, self.compute_dtype)
         rho_y = tf.einsum(
             '...ik, ...jk -> ...ij',
             rho_h, tf.math.conj(rho_h),
@@ -587,12 +1417,53 @@ class ComplexQMeasureClassifEig(tf.keras.layers.Layer):
         rho_y = rho_y / trace_val
         return rho_y
 
-    def set_rho(self, rho):
+    def _call_real_blocks(self, inputs):
+        in_re, in_im = _split_complex(inputs, self.eig_vec_re.dtype)
+        norms = tf.sqrt(tf.reduce_sum(
+            tf.square(self.eig_vec_re) + tf.square(self.eig_vec_im),
+            axis=0, keepdims=True))
+        eig_val = tf.keras.activations.relu(self.eig_val)
+        eig_val = eig_val / tf.reduce_sum(eig_val)
+        eig_val_sr = tf.expand_dims(tf.sqrt(eig_val), axis=0) / norms
+        v_re = tf.reshape(self.eig_vec_re * eig_val_sr,
+                          (self.dim_x, self.dim_y * self.num_eig))
+        v_im = tf.reshape(self.eig_vec_im * eig_val_sr,
+                          (self.dim_x, self.dim_y * self.num_eig))
+        # psi V as [re(psi), im(psi)] [[re(V), im(V)], [-im(V), re(V)]]
+        blocks = tf.concat((tf.concat((v_re, v_im), 1),
+                            tf.concat((-v_im, v_re), 1)), 0)
+        rho_h = tf.matmul(tf.concat((in_re, in_im), 1), blocks)
+        rho_h = tf.reshape(
+            rho_h, (-1, 2, self.dim_y, self.num_eig)) # shape (b, 2, ny, ne)
+        h_re, h_im = rho_h[:, 0], rho_h[:, 1]
+        if self.output_dist:
+            dist = tf.reduce_sum(tf.square(h_re) + tf.square(h_im),
+                                 axis=-1) # shape (b, ny)
+            dist = dist / tf.reduce_sum(dist, axis=-1, keepdims=True)
+            return tf.cast(dist, self.compute_dtype)
+        h = tf.concat((h_re, h_im), -1) # shape (b, ny, 2 ne)
+        h_rot = tf.concat((h_im, -h_re), -1)
+        rho_y = tf.matmul(tf.concat((h, h_rot), 1), h,
+                          transpose_b=True) # shape (b, 2 ny, ny)
+        rho_y_re, rho_y_im = rho_y[:, :self.dim_y], rho_y[:, self.dim_y:]
+        trace_val = tf.einsum('...ii->...', rho_y_re, optimize='optimal')
+        trace_val = tf.expand_dims(trace_val, axis=-1)
+        trace_val = tf.expand_dims(trace_val, axis=-1)
+        return tf.complex(rho_y_re / trace_val, rho_y_im / trace_val)
+
+    def set_rho(self, rho, method='eigh', tol=1e-4):
         """
         Sets the value of self.rho_h using an eigendecomposition.
 
         Arguments:
             rho: a tensor of shape (dim_x, dim_y, dim_x, dim_y)
+            method: 'eigh' for a full eigendecomposition or 'randomized'
+                for an approximation of the top num_eig eigenpairs, see
+                `randomized_eigh`
+            tol: tolerance of the 'randomized' method
+        Returns:
+            e: eigenvalues in non-decreasing order, only the top num_eig
+               for the 'randomized' method
         """
         if (len(rho.shape.as_list()) != 4 or
                 rho.shape[0] != self.dim_x or
@@ -607,24 +1478,34 @@ class ComplexQMeasureClassifEig(tf.keras.layers.Layer):
         rho_prime = tf.reshape(
             rho, 
             (self.dim_x * self.dim_y, self.dim_x * self.dim_y,))
-        e, v = tf.linalg.eigh(rho_prime)
-        self.eig_vec.assign(v[:, -self.num_eig:])
+        e, v = _eigh(rho_prime, self.num_eig, method, tol)
+        if self.real_blocks:
+            v_re, v_im = _split_complex(v[:, -self.num_eig:],
+                                        self.eig_vec_re.dtype)
+            self.eig_vec_re.assign(v_re)
+            self.eig_vec_im.assign(v_im)
+        else:
+            self.eig_vec.assign(v[:, -self.num_eig:])
         self.eig_val.assign(e[-self.num_eig:])
         return e
 
     def get_config(self):
         config = {
             "dim_x": self.dim_x,
-            "dim_y": self.dim_y
+            "dim_y": self.dim_y,
+            "real_blocks": self.real_blocks,
+            "output_dist": self.output_dist
         }
         base_config = super().get_config()
         return {**base_config, **config}
 
     def compute_output_shape(self, input_shape):
+        if self.output_dist:
+            return (self.dim_y,)
         return (self.dim_y, self.dim_y)
 
 
-class QMeasureDMClassifEig(tf.keras.layers.Layer):
+class QMeasureDMClassifEig(_FrozenFactors, tf.keras.layers.Layer):
     """Quantum measurement layer for classification.
     Receives as input a factorized density matrix represented by a set of vectors
     and values. Represents the internal density matrix using a factorization:
@@ -650,8 +1531,17 @@ class QMeasureDMClassifEig(tf.keras.layers.Layer):
     Arguments:
         dim_x: int. the dimension of the input state
         dim_y: int. the dimension of the output state
+        eig_out: int. Number of components kept in the output factorization
         num_eig: int. Number of eigenvectors used to represent
                  the density matrix
+        approx_top_k: bool. If True the output components are selected with
+                 `tf.math.approx_max_k`, which is faster on TPU but may
+                 miss some of the largest weights. The op is only available
+                 under XLA (TPU or `jit_compile=True`) and requires a static
+                 number of input components, otherwise exact top-k is used.
+
+    The normalized eigenvectors and eigenvalues can be precomputed with
+    `freeze`.
     """
 
     def __init__(
@@ -660,6 +1550,7 @@ class QMeasureDMClassifEig(tf.keras.layers.Layer):
             dim_y: int,
             eig_out: int,
             num_eig: int = 0, 
+            approx_top_k: bool = False,
             **kwargs
     ):
         super().__init__(**kwargs)
@@ -669,6 +1560,7 @@ class QMeasureDMClassifEig(tf.keras.layers.Layer):
         if num_eig < 1:
             num_eig = dim_x * dim_y
         self.num_eig = num_eig
+        self.approx_top_k = approx_top_k
 
     def build(self, input_shape):
         if (input_shape[1] and input_shape[1] != self.dim_x + 1 
@@ -686,26 +1578,39 @@ class QMeasureDMClassifEig(tf.keras.layers.Layer):
             "eig_val",
             shape=(self.num_eig,),
             initializer=tf.keras.initializers.random_normal(),
-            trainable=True)
+            trainable=True,
+            experimental_autocast=False)
         #axes = {i: input_shape[i] for i in range(1, len(input_shape))}
         #self.input_spec = tf.keras.layers.InputSpec(
         #    ndim=len(input_shape), axes=axes)
         #self.eps = tf.keras.backend.epsilon()
         self.eps = 1e-10
+        self._build_factor_cache()
         self.built = True
 
-    def call(self, inputs):
-        eig_in = tf.shape(inputs)[-1]
-        eig_out = tf.math.minimum(self.num_eig * eig_in, self.eig_out)
-        norms = tf.expand_dims(tf.linalg.norm(self.eig_vec, axis=0), axis=0)
-        eig_vec = self.eig_vec / norms
+    def _factors(self):
+        eig_vec = _high_precision(self.eig_vec)
+        norms = tf.expand_dims(tf.linalg.norm(eig_vec, axis=0), axis=0)
+        eig_vec = tf.reshape(eig_vec / norms,
+                             (self.dim_x, self.dim_y, self.num_eig))
         eig_val = tf.keras.activations.relu(self.eig_val)
         eig_val = eig_val / tf.reduce_sum(eig_val) # shape (ne)
-        eig_vec = tf.reshape(eig_vec, (self.dim_x, self.dim_y, self.num_eig))
-        in_w = inputs[:, 0, :] # shape (b, ein_in)
+        return eig_vec, eig_val
+
+    def call(self, inputs):
+        eig_in = inputs.shape[-1]
+        if eig_in is None:
+            eig_in = tf.shape(inputs)[-1]
+            eig_out = tf.math.minimum(self.num_eig * eig_in, self.eig_out)
+        else:
+            eig_out = min(self.num_eig * eig_in, self.eig_out)
+        eig_vec, eig_val = self._current_factors()
+        eig_vec = tf.cast(eig_vec, inputs.dtype)
+        in_w = _high_precision(inputs[:, 0, :]) # shape (b, ein_in)
         in_v = inputs[:, 1:, :] # shape (b, dim_x, ein_in)
         eig_vec_y = tf.einsum('...ji,jkl->...kli', in_v, eig_vec, 
                               optimize='optimal') # shape (b, dim_y, ne, ein_in)
+        eig_vec_y = _high_precision(eig_vec_y)
         eig_vec_y_norm = tf.linalg.norm(eig_vec_y, axis=1) # shape (b, ne, ein_in)
         eig_vec_y = (eig_vec_y /
                      tf.expand_dims(tf.maximum(eig_vec_y_norm, self.eps),
@@ -719,21 +1624,32 @@ class QMeasureDMClassifEig(tf.keras.layers.Layer):
         out_w = out_w / tf.expand_dims(out_w_sum, axis=1)
         out_w = tf.einsum('...j,...ij->...ij', in_w, out_w)
         out_w = tf.reshape(out_w, (-1, self.num_eig * eig_in))
-        out_w_sort_ind = tf.argsort(out_w, direction='DESCENDING', axis=1)[:, :eig_out]
-        out_w = tf.gather(out_w, out_w_sort_ind, axis=-1, batch_dims=1) # shape (b, e_out)
+        # top-k returns the selected weights directly, so only the
+        # vectors need to be gathered
+        if self.approx_top_k and isinstance(eig_out, int):
+            out_w, out_w_ind = tf.math.approx_max_k(out_w, eig_out)
+        else:
+            out_w, out_w_ind = tf.math.top_k(out_w, eig_out) # shape (b, e_out)
         out_w = out_w / tf.expand_dims(tf.reduce_sum(out_w, axis=1), axis = -1)
         out_w = tf.expand_dims(out_w, axis= 1) # shape (b, 1, e_out)
-        eig_vec_y = tf.gather(eig_vec_y, out_w_sort_ind, axis=-1, 
+        eig_vec_y = tf.gather(eig_vec_y, out_w_ind, axis=-1, 
                               batch_dims=1) # shape (b, dim_y, e_out)
         out = tf.concat((out_w, eig_vec_y), 1)
-        return out
+        return tf.cast(out, inputs.dtype)
 
-    def set_rho(self, rho):
+    def set_rho(self, rho, method='eigh', tol=1e-4):
         """
         Sets the value of self.rho_h using an eigendecomposition.
 
         Arguments:
             rho: a tensor of shape (dim_x, dim_y, dim_x, dim_y)
+            method: 'eigh' for a full eigendecomposition or 'randomized'
+                for an approximation of the top num_eig eigenpairs, see
+                `randomized_eigh`
+            tol: tolerance of the 'randomized' method
+        Returns:
+            e: eigenvalues in non-decreasing order, only the top num_eig
+               for the 'randomized' method
         """
         if (len(rho.shape.as_list()) != 4 or
                 rho.shape[0] != self.dim_x or
@@ -748,9 +1664,10 @@ class QMeasureDMClassifEig(tf.keras.layers.Layer):
         rho_prime = tf.reshape(
             rho, 
             (self.dim_x * self.dim_y, self.dim_x * self.dim_y,))
-        e, v = tf.linalg.eigh(rho_prime)
+        e, v = _eigh(rho_prime, self.num_eig, method, tol)
         self.eig_vec.assign(v[:, -self.num_eig:])
         self.eig_val.assign(e[-self.num_eig:])
+        self._refresh_factor_cache()
         return e
 
     def get_rho(self):
@@ -766,7 +1683,9 @@ class QMeasureDMClassifEig(tf.keras.layers.Layer):
         config = {
             "dim_x": self.dim_x,
             "dim_y": self.dim_y,
-            "num_eig": self.num_eig
+            "eig_out": self.eig_out,
+            "num_eig": self.num_eig,
+            "approx_top_k": self.approx_top_k
         }
         base_config = super().get_config()
         return {**base_config, **config}
@@ -774,7 +1693,7 @@ class QMeasureDMClassifEig(tf.keras.layers.Layer):
     def compute_output_shape(self, input_shape):
         return (self.dim_y + 1, self.eig_out)
 
-class QMClassifSDecompFDMatrix(tf.keras.layers.Layer):
+class QMClassifSDecompFDMatrix(_FrozenFactors, tf.keras.layers.Layer):
     """Quantum measurement layer for classification.
     Receives as input a factorized density matrix represented by a set of vectors
     and values. Represents the internal density matrix using a Schmidt decomposition.
@@ -801,6 +1720,9 @@ class QMClassifSDecompFDMatrix(tf.keras.layers.Layer):
         dim_y: int. the dimension of the output state
         n_comp: int. Number of components used to represent 
                  the train density matrix
+
+    The normalized components and weights can be precomputed with
+    `freeze`.
     """
 
     def __init__(
@@ -836,23 +1758,31 @@ class QMClassifSDecompFDMatrix(tf.keras.layers.Layer):
             "eig_val",
             shape=(self.n_comp,),
             initializer=tf.keras.initializers.constant(1./self.n_comp),
-            trainable=True) 
+            trainable=True,
+            experimental_autocast=False)
         #self.eps = tf.keras.backend.epsilon()
         self.eps = 1e-10
+        self._build_factor_cache()
         self.built = True
 
-    def call(self, inputs):
-        norms_x = tf.expand_dims(tf.linalg.norm(self.c_x, axis=0), axis=0)
-        c_x = self.c_x / norms_x
-        norms_y = tf.expand_dims(tf.linalg.norm(self.c_y, axis=0), axis=0)
-        c_y = self.c_y / norms_y
+    def _factors(self):
+        c_x = _high_precision(self.c_x)
+        norms_x = tf.expand_dims(tf.linalg.norm(c_x, axis=0), axis=0)
+        c_y = _high_precision(self.c_y)
+        norms_y = tf.expand_dims(tf.linalg.norm(c_y, axis=0), axis=0)
         eig_val = tf.abs(self.eig_val)
         eig_val = eig_val / tf.reduce_sum(eig_val) # shape (ne)
-        in_w = inputs[:, 0, :] # shape (b, n_comp_in)
+        return c_x / norms_x, c_y / norms_y, eig_val
+
+    def call(self, inputs):
+        c_x, c_y, eig_val = self._current_factors()
+        c_x = tf.cast(c_x, inputs.dtype)
+        in_w = _high_precision(inputs[:, 0, :]) # shape (b, n_comp_in)
         in_v = inputs[:, 1:, :] # shape (b, dim_x, n_comp_in)
         out_vw = tf.einsum('...mi,mj->...ij',
                            in_v, c_x,
                            optimize='optimal') # shape (b, n_comp_in, n_comp)
+        out_vw = _high_precision(out_vw)
         out_w = (tf.expand_dims(tf.expand_dims(eig_val, axis=0), axis=0) *
                  tf.square(out_vw)) # shape (b, n_comp_in, n_comp)
         out_w_sum = tf.maximum(tf.reduce_sum(out_w, axis=2), self.eps)  # shape (b, n_comp_in)
@@ -862,7 +1792,7 @@ class QMClassifSDecompFDMatrix(tf.keras.layers.Layer):
         out_y_shape = tf.shape(out_w) + tf.constant([0, self.dim_y - 1, 0])
         out_y = tf.broadcast_to(tf.expand_dims(c_y, axis=0), out_y_shape)
         out = tf.concat((out_w, out_y), 1)
-        return out
+        return tf.cast(out, inputs.dtype)
 
     def get_rho(self):
         norms_x = tf.expand_dims(tf.linalg.norm(self.c_x, axis=0), axis=0)
@@ -875,7 +1805,44 @@ class QMClassifSDecompFDMatrix(tf.keras.layers.Layer):
                         tf.math.conj(c_x), tf.math.conj(c_y))
         return rho
 
-    def set_rho(self, rho, tol=1e-2, max_iter=300, learning_rate=0.001):
+    def set_rho(self, rho, method='svd', tol=1e-2, max_iter=300,
+                learning_rate=0.001):
+        """
+        Fits c_x, c_y and eig_val to approximate a density matrix.
+
+        The 'svd' method computes an eigendecomposition of rho, splits each
+        eigenvector with a Schmidt (SVD) decomposition into product
+        components, keeps the n_comp components with the largest weight
+        and refits their weights by non-negative least squares.
+        The 'sgd' method runs Adam on the reconstruction error.
+
+        Arguments:
+            rho: a tensor of shape (dim_x, dim_y, dim_x, dim_y)
+            method: 'svd' or 'sgd'
+            tol: tolerance on the reconstruction error, only used by 'sgd'
+            max_iter: maximum number of iterations, only used by 'sgd'
+            learning_rate: learning rate, only used by 'sgd'
+        Returns:
+            'svd': the reconstruction error
+            'sgd': the number of iterations and the reconstruction error
+        """
+        if method == 'svd':
+            rho = tf.convert_to_tensor(rho, dtype=self.dtype)
+            if rho.shape != (self.dim_x, self.dim_y, self.dim_x, self.dim_y):
+                raise ValueError(
+                    f'rho shape must be ({self.dim_x}, {self.dim_y},'
+                    f' {self.dim_x}, {self.dim_y})')
+            if not self.built:
+                self.build((None, self.dim_x + 1, None))
+            c_x, c_y, eig_val, error = self._schmidt_decomp(rho)
+            self.c_x.assign(c_x)
+            self.c_y.assign(c_y)
+            self.eig_val.assign(eig_val)
+            self._refresh_factor_cache()
+            return error.numpy()
+        if method != 'sgd':
+            raise ValueError(
+                f"method must be 'svd' or 'sgd' but it is {method}")
         initializer = tf.keras.initializers.Orthogonal()
         opt = tf.keras.optimizers.Adam(learning_rate=learning_rate)
         shape = rho.shape
@@ -903,33 +1870,112 @@ class QMClassifSDecompFDMatrix(tf.keras.layers.Layer):
         self.c_x.assign(c_x_in)
         self.c_y.assign(c_y_in)
         self.eig_val.assign(eig_val)
+        self._refresh_factor_cache()
         return i, loss.numpy()
 
-    def set_rho_diag(self, rho):
+    @tf.function
+    def _schmidt_decomp(self, rho):
+        dim_x, dim_y = self.dim_x, self.dim_y
+        dim_min = min(dim_x, dim_y)
+        n_pairs = dim_x * dim_y * dim_min
+        n_sel = min(self.n_comp, n_pairs)
+        e, v = tf.linalg.eigh(tf.reshape(rho, (dim_x * dim_y, dim_x * dim_y)))
+        v = tf.reshape(tf.transpose(v), (dim_x * dim_y, dim_x, dim_y))
+        s, u_x, u_y = tf.linalg.svd(v) # shapes (k, m), (k, dx, m), (k, dy, m)
+        weights = tf.reshape(
+            tf.expand_dims(tf.nn.relu(e), axis=1) * tf.square(s), (-1,))
+        _, ind = tf.math.top_k(weights, n_sel)
+        u_x = tf.reshape(tf.transpose(u_x, (0, 2, 1)), (-1, dim_x))
+        u_y = tf.reshape(tf.transpose(u_y, (0, 2, 1)), (-1, dim_y))
+        c_x = tf.transpose(tf.gather(u_x, ind)) # shape (dx, n_sel)
+        c_y = tf.transpose(tf.gather(u_y, ind)) # shape (dy, n_sel)
+        # least squares refit of the weights of the selected components,
+        # <p_k, p_l> = <c_x_k, c_x_l> <c_y_k, c_y_l>
+        gram = tf.square(tf.matmul(c_x, c_x, transpose_a=True) *
+                         tf.matmul(c_y, c_y, transpose_a=True))
+        proj = tf.einsum('ijlm,ik,jk,lk,mk->k', rho, c_x, c_y, c_x, c_y,
+                         optimize='optimal')
+        eig_val = tf.linalg.lstsq(gram, tf.expand_dims(proj, axis=1),
+                                  fast=False)[:, 0]
+        eig_val = tf.nn.relu(eig_val)
+        eig_val = tf.math.divide_no_nan(eig_val, tf.reduce_sum(eig_val))
+        rho_out = tf.einsum('k,ik,jk,lk,mk->ijlm', eig_val, c_x, c_y,
+                            c_x, c_y, optimize='optimal')
+        error = tf.linalg.norm(rho - rho_out)
+        if self.n_comp > n_sel:
+            n_pad = self.n_comp - n_sel
+            c_x = tf.concat(
+                (c_x, tf.tile(tf.one_hot([0], dim_x, axis=0, dtype=rho.dtype),
+                              (1, n_pad))), axis=1)
+            c_y = tf.concat(
+                (c_y, tf.tile(tf.one_hot([0], dim_y, axis=0, dtype=rho.dtype),
+                              (1, n_pad))), axis=1)
+            eig_val = tf.concat((eig_val, tf.zeros((n_pad,), rho.dtype)), 0)
+        return c_x, c_y, eig_val, error
+
+    def set_rho_diag(self, rho, sparse=False):
+        """
+        Sets c_x, c_y and eig_val to represent the diagonal of rho, with
+        one product component per basis element of the joint space.
+
+        Arguments:
+            rho: a tensor or array of shape (dim_x, dim_y, dim_x, dim_y)
+            sparse: if True, only the components with non-zero diagonal
+                    mass are kept. self.n_comp must be at least
+                    `diag_support_size(rho)`, extra components get zero
+                    weight.
+        """
         shape = rho.shape
         dim_x = shape[0]
         dim_y = shape[1]
-        n_comp = dim_x * dim_y
-        if n_comp != self.n_comp:
-            raise ValueError(
-                f'self.n_comp must be {n_comp}'
-                f' but it is {self.n_comp}.'
-                )   
-        c_x_in = np.zeros(shape=(dim_x, self.n_comp))
-        c_y_in = np.zeros(shape=(dim_y, self.n_comp))
-        eig_val = np.zeros((self.n_comp))
-        comp_idx = 0
-        for i in range(dim_x):
-            for j in range(dim_y):
-                c_x_in[i, comp_idx] = 1.
-                c_y_in[j, comp_idx] = 1.
-                eig_val[comp_idx] = rho[i, j, i, j]
-                comp_idx += 1
-        self.c_x.assign(c_x_in)
-        self.c_y.assign(c_y_in)
+        rho = tf.convert_to_tensor(rho, dtype=self.dtype)
+        diag = tf.linalg.diag_part(
+            tf.reshape(rho, (dim_x * dim_y, dim_x * dim_y)))
+        if sparse:
+            comp_idx = tf.where(diag != 0)[:, 0]
+            n_comp = comp_idx.shape[0]
+            if n_comp > self.n_comp:
+                raise ValueError(
+                    f'self.n_comp must be at least {n_comp}'
+                    f' but it is {self.n_comp}.'
+                    )
+        else:
+            comp_idx = tf.range(dim_x * dim_y, dtype=tf.int64)
+            n_comp = dim_x * dim_y
+            if n_comp != self.n_comp:
+                raise ValueError(
+                    f'self.n_comp must be {n_comp}'
+                    f' but it is {self.n_comp}.'
+                    )
+        if not self.built:
+            self.build((None, dim_x + 1, None))
+        n_pad = self.n_comp - n_comp
+        eig_val = tf.concat(
+            (tf.gather(diag, comp_idx), tf.zeros((n_pad,), self.dtype)), 0)
+        comp_idx = tf.concat(
+            (comp_idx, tf.zeros((n_pad,), tf.int64)), 0)
+        self.c_x.assign(tf.one_hot(comp_idx // dim_y, dim_x, axis=0,
+                                   dtype=self.dtype))
+        self.c_y.assign(tf.one_hot(comp_idx % dim_y, dim_y, axis=0,
+                                   dtype=self.dtype))
         self.eig_val.assign(eig_val)
+        self._refresh_factor_cache()
         return 
 
+    @staticmethod
+    def diag_support_size(rho):
+        """
+        Returns the number of components with non-zero diagonal mass,
+        i.e. the n_comp needed by `set_rho_diag(rho, sparse=True)`.
+
+        Arguments:
+            rho: a tensor or array of shape (dim_x, dim_y, dim_x, dim_y)
+        """
+        shape = rho.shape
+        n = shape[0] * shape[1]
+        diag = tf.linalg.diag_part(tf.reshape(rho, (n, n)))
+        return int(tf.math.count_nonzero(diag))
+
     def get_config(self):
         config = {
             "dim_x": self.dim_x,
@@ -942,41 +1988,249 @@ class QMClassifSDecompFDMatrix(tf.keras.layers.Layer):
     def compute_output_shape(self, input_shape):
         return (self.dim_y + 1, self.n_comp)
 
-class QMeasureDensity(tf.keras.layers.Layer):
-    """Quantum measurement layer for density estimation.
+class QMeasureClassifTable(tf.keras.layers.Layer):
+    """Quantum measurement layer for classification with one-hot (basis)
+    input states given by their index.
+    When both input and output states are basis states the density matrix
+    of a closed-form fit is diagonal, so it is stored as the table
+    `table[i, j] = rho[i, j, i, j]` and the measurement reduces to
+    gathering and normalizing a row. Rows with no mass give zeros.
 
     Input shape:
-        (batch_size, dim_x)
-        where dim_x is the dimension of the input state
+        (batch_size,)
+        indices of the input basis states, e.g. the output of
+        QFeatureMapOneHot with output_index=True
     Output shape:
-        (batch_size, 1)
+        (batch_size, dim_y, dim_y), or (batch_size, dim_y) if output_dist
     Arguments:
-        dim_x: int. the dimension of the input  state
+        dim_x: int. the dimension of the input state
+        dim_y: int. the dimension of the output state
+        output_dist: bool. If True returns the diagonal of the output
+            density matrix
     """
 
     def __init__(
             self,
             dim_x: int,
+            dim_y: int,
+            output_dist: bool = False,
             **kwargs
     ):
+        super().__init__(**kwargs)
         self.dim_x = dim_x
+        self.dim_y = dim_y
+        self.output_dist = output_dist
+
+    def build(self, input_shape):
+        self.table = self.add_weight(
+            "table",
+            shape=(self.dim_x, self.dim_y),
+            initializer=tf.keras.initializers.Zeros(),
+            trainable=False)
+        self.built = True
+
+    def call(self, inputs):
+        rows = tf.gather(self.table, tf.cast(inputs, tf.int64)) # shape (b, ny)
+        rows = _high_precision(rows)
+        dist = tf.math.divide_no_nan(
+            rows, tf.reduce_sum(rows, axis=-1, keepdims=True))
+        dist = tf.cast(dist, self.compute_dtype)
+        if self.output_dist:
+            return dist
+        return tf.linalg.diag(dist)
+
+    def get_rho(self):
+        """
+        Returns the equivalent dense density matrix of shape
+        (dim_x, dim_y, dim_x, dim_y).
+        """
+        rho = tf.linalg.diag(tf.reshape(self.table, (-1,)))
+        return tf.reshape(rho, (self.dim_x, self.dim_y, self.dim_x, self.dim_y))
+
+    def get_config(self):
+        config = {
+            "dim_x": self.dim_x,
+            "dim_y": self.dim_y,
+            "output_dist": self.output_dist
+        }
+        base_config = super().get_config()
+        return {**base_config, **config}
+
+    def compute_output_shape(self, input_shape):
+        if self.output_dist:
+            return (self.dim_y,)
+        return (self.dim_y, self.dim_y)
+
+class QMeasureClassifCP(tf.keras.layers.Layer):
+    """Quantum measurement layer for classification with a product
+    (factored) input state.
+    Represents the internal density matrix as a mixture of product states
+    in CP (canonical polyadic) form,
+
+    `rho = sum_k eig_val[k] (a_1k x ... x a_nk x c_yk)(...)^T`
+
+    so the projection of an input product state phi_1 x ... x phi_n on a
+    component is prod_f <phi_f, a_fk> and the dim ** n joint state is never
+    materialized. Returns a factored density matrix in the same format as
+    `QMClassifSDecompFDMatrix`. Products are computed in log space to
+    avoid underflow with many features.
+
+    Input shape:
+        (batch_size, num_features, dim_x)
+        e.g. the output of QFeatureMapSmp or QFeatureMapOneHot with
+        factored=True
+    Output shape:
+        (batch_size, dim_y + 1, n_comp), or (batch_size, dim_y) if
+        output_dist. The weights of the output factorization for sample i
+        are [i, 0, :], and the vectors are [i, 1:dim_y + 1, :].
+    Arguments:
+        num_features: int. the number of factors of the input state
+        dim_x: int. the dimension of each factor of the input state
+        dim_y: int. the dimension of the output state
+        n_comp: int. Number of components used to represent 
+                 the train density matrix
+        output_dist: bool. If True returns the diagonal of the output
+                 density matrix, i.e. the class probabilities
+    """
+
+    def __init__(
+            self,
+            num_features: int,
+            dim_x: int,
+            dim_y: int,
+            n_comp: int,
+            output_dist: bool = False,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.num_features = num_features
+        self.dim_x = dim_x
+        self.dim_y = dim_y
+        self.n_comp = n_comp
+        self.output_dist = output_dist
+
+    def build(self, input_shape):
+        if (len(input_shape) != 3 or
+                input_shape[1] != self.num_features or
+                input_shape[2] != self.dim_x):
+            raise ValueError(
+                f'Input dimension must be (batch_size, {self.num_features},'
+                f' {self.dim_x}) but it is {input_shape}')
+        self.c_x = self.add_weight(
+            "c_x",
+            shape=(self.num_features, self.dim_x, self.n_comp),
+            initializer=tf.keras.initializers.random_uniform(0., 1.),
+            trainable=True)
+        self.c_y = self.add_weight(
+            "c_y",
+            shape=(self.dim_y, self.n_comp),
+            initializer=tf.keras.initializers.orthogonal(),
+            trainable=True)
+        self.eig_val = self.add_weight(
+            "eig_val",
+            shape=(self.n_comp,),
+            initializer=tf.keras.initializers.constant(1./self.n_comp),
+            trainable=True,
+            experimental_autocast=False)
+        self.eps = 1e-30
+        self.built = True
+
+    def call(self, inputs):
+        c_x = _high_precision(self.c_x)
+        c_x = c_x / tf.linalg.norm(c_x, axis=1, keepdims=True)
+        c_x = tf.cast(c_x, inputs.dtype)
+        c_y = _high_precision(self.c_y)
+        c_y = c_y / tf.linalg.norm(c_y, axis=0, keepdims=True)
+        eig_val = tf.abs(self.eig_val)
+        eig_val = eig_val / tf.reduce_sum(eig_val) # shape (ne)
+        proj = tf.einsum('...fi,fik->...fk', inputs, c_x,
+                         optimize='optimal') # shape (b, nf, n_comp)
+        proj = _high_precision(proj)
+        log_w = (tf.math.log(tf.maximum(eig_val, self.eps)) +
+                 tf.reduce_sum(tf.math.log(
+                     tf.maximum(tf.square(proj), self.eps)), axis=1))
+        out_w = tf.nn.softmax(log_w, axis=-1) # shape (b, n_comp)
+        if self.output_dist:
+            dist = tf.matmul(out_w, tf.square(c_y), transpose_b=True)
+            return tf.cast(dist, inputs.dtype)
+        out_w = tf.expand_dims(out_w, axis=1)
+        out_y_shape = tf.shape(out_w) + tf.constant([0, self.dim_y - 1, 0])
+        out_y = tf.broadcast_to(tf.expand_dims(c_y, axis=0), out_y_shape)
+        out = tf.concat((out_w, out_y), 1)
+        return tf.cast(out, inputs.dtype)
+
+    def get_config(self):
+        config = {
+            "num_features": self.num_features,
+            "dim_x": self.dim_x,
+            "dim_y": self.dim_y,
+            "n_comp": self.n_comp,
+            "output_dist": self.output_dist
+        }
+        base_config = super().get_config()
+        return {**base_config, **config}
+
+    def compute_output_shape(self, input_shape):
+        if self.output_dist:
+            return (self.dim_y,)
+        return (self.dim_y + 1, self.n_comp)
+
+class QMeasureDensity(tf.keras.layers.Layer):
+    """Quantum measurement layer for density estimation.
+
+    Input shape:
+        (batch_size, dim_x)
+        where dim_x is the dimension of the input state
+    Output shape:
+        (batch_size, 1)
+    Arguments:
+        dim_x: int. the dimension of the input  state
+        packed: bool. If True only the upper triangular blocks of rho are
+            stored, in the weight rho_packed, see `pack_hermitian`, and
+            the measurement reads them directly.
+        block_size: int. number of x indices per block of the packed
+            form
+    """
+
+    def __init__(
+            self,
+            dim_x: int,
+            packed: bool = False,
+            block_size: int = 256,
+            **kwargs
+    ):
+        self.dim_x = dim_x
+        self.packed = packed
+        self.block_size = block_size
         super().__init__(**kwargs)
 
     def build(self, input_shape):
         if (not input_shape[1] is None) and input_shape[1] != self.dim_x:
             raise ValueError(
                 f'Input dimension must be (batch_size, {self.dim_x})')
-        self.rho = self.add_weight(
-            "rho",
-            shape=(self.dim_x, self.dim_x),
-            initializer=tf.keras.initializers.Zeros(),
-            trainable=True)
+        if self.packed:
+            self.rho_packed = self.add_weight(
+                "rho_packed",
+                shape=packed_shape(self.dim_x, None, self.block_size),
+                initializer=tf.keras.initializers.Zeros(),
+                trainable=True)
+        else:
+            self.rho = self.add_weight(
+                "rho",
+                shape=(self.dim_x, self.dim_x),
+                initializer=tf.keras.initializers.Zeros(),
+                trainable=True)
         axes = {i: input_shape[i] for i in range(1, len(input_shape))}
         self.input_spec = tf.keras.layers.InputSpec(
             ndim=len(input_shape), axes=axes)
         self.built = True
 
     def call(self, inputs):
+        if self.packed:
+            rho_packed = self.rho_packed[:, :, tf.newaxis, :, tf.newaxis]
+            rho_res = _packed_measure(inputs, rho_packed, self.dim_x)
+            norms = tf.reduce_sum(inputs * tf.math.conj(inputs), axis=-1)
+            return rho_res[:, 0, 0] * norms # shape (b,)
         oper = tf.einsum(
             '...i,...j->...ij',
             inputs, tf.math.conj(inputs),
@@ -987,16 +2241,64 @@ class QMeasureDensity(tf.keras.layers.Layer):
             optimize='optimal')  # shape (b, nx, ny, nx, ny)
         return rho_res
 
+    def set_rho(self, rho):
+        """
+        Sets the density matrix, packing it if the layer is packed.
+
+        Arguments:
+            rho: a tensor of shape (dim_x, dim_x)
+        """
+        if not self.built:
+            self.build((None, self.dim_x))
+        if self.packed:
+            self.rho_packed.assign(
+                pack_hermitian(tf.cast(rho, self.rho_packed.dtype),
+                               self.block_size))
+        else:
+            self.rho.assign(tf.cast(rho, self.rho.dtype))
+
+    def set_rho_packed(self, rho_packed):
+        """
+        Sets the density matrix from its packed form, see
+        `pack_hermitian`.
+        """
+        if not self.built:
+            self.build((None, self.dim_x))
+        if self.packed:
+            self.rho_packed.assign(
+                tf.cast(rho_packed, self.rho_packed.dtype))
+        else:
+            self.rho.assign(unpack_hermitian(
+                tf.cast(rho_packed, self.rho.dtype), self.dim_x))
+
+    def get_rho(self):
+        """
+        Returns the density matrix, a tensor of shape (dim_x, dim_x).
+        """
+        if self.packed:
+            return unpack_hermitian(self.rho_packed, self.dim_x)
+        return tf.convert_to_tensor(self.rho)
+
+    def get_config(self):
+        config = {
+            "dim_x": self.dim_x,
+            "packed": self.packed,
+            "block_size": self.block_size
+        }
+        base_config = super().get_config()
+        return {**base_config, **config}
+
     def compute_output_shape(self, input_shape):
         return (1,)
 
-class QMeasureDensityEig(tf.keras.layers.Layer):
+class QMeasureDensityEig(_FrozenFactors, tf.keras.layers.Layer):
     """Quantum measurement layer for density estimation.
     Represents the density matrix using a factorization:
     
     `dm = tf.matmul(V, tf.transpose(V, conjugate=True))`
 
-    This rerpesentation is ameanable to gradient-based learning
+    This rerpesentation is ameanable to gradient-based learning.
+    The normalized factor can be precomputed with `freeze`.
 
     Input shape:
         (batch_size, dim_x)
@@ -1033,19 +2335,25 @@ class QMeasureDensityEig(tf.keras.layers.Layer):
             "eig_val",
             shape=(self.num_eig,),
             initializer=tf.keras.initializers.random_normal(),
-            trainable=True)
+            trainable=True,
+            experimental_autocast=False)
         axes = {i: input_shape[i] for i in range(1, len(input_shape))}
         self.input_spec = tf.keras.layers.InputSpec(
             ndim=len(input_shape), axes=axes)
+        self._build_factor_cache()
         self.built = True
 
-    def call(self, inputs):
-        norms = tf.expand_dims(tf.linalg.norm(self.eig_vec, axis=0), axis=0)
-        eig_vec = self.eig_vec / norms
+    def _factors(self):
+        eig_vec = _high_precision(self.eig_vec)
+        norms = tf.expand_dims(tf.linalg.norm(eig_vec, axis=0), axis=0)
         eig_val = tf.keras.activations.relu(self.eig_val)
         eig_val = eig_val / tf.reduce_sum(eig_val)
-        rho_h = tf.matmul(eig_vec,
-                          tf.linalg.diag(tf.sqrt(eig_val)))
+        rho_h = eig_vec / norms * tf.expand_dims(tf.sqrt(eig_val), axis=0)
+        return (rho_h,)
+
+    def call(self, inputs):
+        rho_h, = self._current_factors()
+        rho_h = tf.cast(rho_h, inputs.dtype)
         rho_h = tf.matmul(tf.math.conj(inputs), rho_h)
         rho_res = tf.einsum(
             '...i, ...i -> ...',
@@ -1053,14 +2361,19 @@ class QMeasureDensityEig(tf.keras.layers.Layer):
             optimize='optimal') # shape (b,)
         return rho_res
 
-    def set_rho(self, rho):
+    def set_rho(self, rho, method='eigh', tol=1e-4):
         """
         Sets the value of self.rho_h using an eigendecomposition.
 
         Arguments:
             rho: a tensor of shape (dim_x, dim_x)
+            method: 'eigh' for a full eigendecomposition or 'randomized'
+                for an approximation of the top num_eig eigenpairs, see
+                `randomized_eigh`
+            tol: tolerance of the 'randomized' method
         Returns:
-            e: list of eigenvalues in non-decreasing order
+            e: list of eigenvalues in non-decreasing order, only the top
+               num_eig for the 'randomized' method
         """
         if (len(rho.shape.as_list()) != 2 or
                 rho.shape[0] != self.dim_x or
@@ -1069,9 +2382,52 @@ class QMeasureDensityEig(tf.keras.layers.Layer):
                 f'rho shape must be ({self.dim_x}, {self.dim_x})')
         if not self.built:
             self.build((None, self.dim_x))        
-        e, v = tf.linalg.eigh(rho)
+        e, v = _eigh(rho, self.num_eig, method, tol)
         self.eig_vec.assign(v[:, -self.num_eig:])
         self.eig_val.assign(e[-self.num_eig:])
+        self._refresh_factor_cache()
+        return e
+
+    def set_eig(self, eig_vec, eig_val):
+        """
+        Sets the factorization from num_eig eigenpairs of the density
+        matrix, e.g. the ones computed by `nystrom_eigh`.
+
+        Arguments:
+            eig_vec: a tensor of shape (dim_x, num_eig)
+            eig_val: a tensor of shape (num_eig,)
+        """
+        if not self.built:
+            self.build((None, self.dim_x))
+        self.eig_vec.assign(tf.cast(eig_vec, self.eig_vec.dtype))
+        self.eig_val.assign(tf.cast(eig_val, self.eig_val.dtype))
+        self._refresh_factor_cache()
+
+    def update_rho(self, psi, weight):
+        """
+        Folds a batch of states into the density matrix with a truncated
+        rank num_eig update, see `eigh_update`:
+
+            rho <- (1 - weight) rho + weight mean_i psi_i psi_i^H
+
+        A constant weight forgets the past batches exponentially, with
+        factor 1 - weight per batch. weight = b / (n + b), where n is the
+        number of samples already folded in, keeps their mean instead.
+        Use weight = 1 for the first batch.
+
+        Arguments:
+            psi: a tensor of shape (batch_size, dim_x)
+            weight: float in (0, 1]
+        Returns:
+            e: the top num_eig eigenvalues in non-decreasing order
+        """
+        if not self.built:
+            self.build((None, self.dim_x))
+        rho_h, = self._factors()
+        rho_h = tf.reshape(rho_h, (self.dim_x, self.num_eig))
+        psi = tf.reshape(psi, (-1, self.dim_x))
+        e, v = eigh_update(rho_h, psi, weight, self.num_eig)
+        self.set_eig(v, e)
         return e
 
     def get_config(self):
@@ -1085,6 +2441,197 @@ class QMeasureDensityEig(tf.keras.layers.Layer):
     def compute_output_shape(self, input_shape):
         return (1,)
 
+class QMeasureMultiDensity(tf.keras.layers.Layer):
+    """Quantum measurement layer for density estimation with several
+    density matrices, e.g. one per class. The density matrices are stored
+    as a single stacked tensor and all of them are evaluated with one
+    batched contraction. The input states are assumed to be normalized.
+
+    Input shape:
+        (batch_size, dim_x)
+        where dim_x is the dimension of the input state
+    Output shape:
+        (batch_size, num_densities)
+    Arguments:
+        dim_x: int. the dimension of the input state
+        num_densities: int. the number of density matrices
+    """
+
+    def __init__(
+            self,
+            dim_x: int,
+            num_densities: int,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.dim_x = dim_x
+        self.num_densities = num_densities
+
+    def build(self, input_shape):
+        if (not input_shape[1] is None) and input_shape[1] != self.dim_x:
+            raise ValueError(
+                f'Input dimension must be (batch_size, {self.dim_x})')
+        self.rho = self.add_weight(
+            "rho",
+            shape=(self.num_densities, self.dim_x, self.dim_x),
+            initializer=tf.keras.initializers.Zeros(),
+            trainable=True)
+        axes = {i: input_shape[i] for i in range(1, len(input_shape))}
+        self.input_spec = tf.keras.layers.InputSpec(
+            ndim=len(input_shape), axes=axes)
+        self.built = True
+
+    def call(self, inputs):
+        rho_h = tf.einsum(
+            '...k, ckm -> ...cm',
+            tf.math.conj(inputs), self.rho,
+            optimize='optimal') # shape (b, nd, nx)
+        rho_res = tf.einsum(
+            '...cm, ...m -> ...c',
+            rho_h, inputs,
+            optimize='optimal') # shape (b, nd)
+        return rho_res
+
+    def set_rho(self, rho):
+        """
+        Sets the value of self.rho.
+
+        Arguments:
+            rho: a tensor of shape (num_densities, dim_x, dim_x) or a list
+                of num_densities tensors of shape (dim_x, dim_x)
+        """
+        rho = tf.convert_to_tensor(rho)
+        if rho.shape != (self.num_densities, self.dim_x, self.dim_x):
+            raise ValueError(
+                f'rho shape must be ({self.num_densities}, {self.dim_x},'
+                f' {self.dim_x})')
+        if not self.built:
+            self.build((None, self.dim_x))
+        self.rho.assign(rho)
+
+    def get_config(self):
+        config = {
+            "dim_x": self.dim_x,
+            "num_densities": self.num_densities
+        }
+        base_config = super().get_config()
+        return {**base_config, **config}
+
+    def compute_output_shape(self, input_shape):
+        return (self.num_densities,)
+
+class QMeasureMultiDensityEig(tf.keras.layers.Layer):
+    """Quantum measurement layer for density estimation with several
+    density matrices, e.g. one per class. Represents each density matrix
+    using a factorization:
+
+    `dm[c] = tf.matmul(V[c], tf.transpose(V[c], conjugate=True))`
+
+    The factors are stored as a single stacked tensor and all of them
+    are evaluated with one batched contraction. This representation is
+    amenable to gradient-based learning.
+
+    Input shape:
+        (batch_size, dim_x)
+        where dim_x is the dimension of the input state
+    Output shape:
+        (batch_size, num_densities)
+    Arguments:
+        dim_x: int. the dimension of the input state
+        num_densities: int. the number of density matrices
+        num_eig: Number of eigenvectors used to represent each density matrix
+    """
+
+    def __init__(
+            self,
+            dim_x: int,
+            num_densities: int,
+            num_eig: int = 0,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.dim_x = dim_x
+        self.num_densities = num_densities
+        if num_eig < 1:
+            num_eig = dim_x
+        self.num_eig = num_eig
+
+    def build(self, input_shape):
+        if (not input_shape[1] is None) and input_shape[1] != self.dim_x:
+            raise ValueError(
+                f'Input dimension must be (batch_size, {self.dim_x})')
+        self.eig_vec = self.add_weight(
+            "eig_vec",
+            shape=(self.num_densities, self.dim_x, self.num_eig),
+            initializer=tf.keras.initializers.random_normal(),
+            trainable=True)
+        self.eig_val = self.add_weight(
+            "eig_val",
+            shape=(self.num_densities, self.num_eig),
+            initializer=tf.keras.initializers.random_normal(),
+            trainable=True,
+            experimental_autocast=False)
+        axes = {i: input_shape[i] for i in range(1, len(input_shape))}
+        self.input_spec = tf.keras.layers.InputSpec(
+            ndim=len(input_shape), axes=axes)
+        self.built = True
+
+    def call(self, inputs):
+        eig_vec = _high_precision(self.eig_vec)
+        norms = tf.linalg.norm(eig_vec, axis=1, keepdims=True)
+        eig_vec = eig_vec / norms
+        eig_val = tf.keras.activations.relu(self.eig_val)
+        eig_val = eig_val / tf.reduce_sum(eig_val, axis=-1, keepdims=True)
+        rho_h = eig_vec * tf.expand_dims(tf.sqrt(eig_val), axis=1) # shape (nd, nx, ne)
+        rho_h = tf.cast(rho_h, inputs.dtype)
+        rho_h = tf.einsum(
+            '...k, cke -> ...ce',
+            tf.math.conj(inputs), rho_h,
+            optimize='optimal') # shape (b, nd, ne)
+        rho_res = tf.reduce_sum(rho_h * tf.math.conj(rho_h), axis=-1) # shape (b, nd)
+        return rho_res
+
+    def set_rho(self, rho, method='eigh', tol=1e-4):
+        """
+        Sets the value of self.rho_h using an eigendecomposition of 
+        each density matrix.
+
+        Arguments:
+            rho: a tensor of shape (num_densities, dim_x, dim_x) or a list
+                of num_densities tensors of shape (dim_x, dim_x)
+            method: 'eigh' for a full eigendecomposition or 'randomized'
+                for an approximation of the top num_eig eigenpairs, see
+                `randomized_eigh`
+            tol: tolerance of the 'randomized' method
+        Returns:
+            e: eigenvalues in non-decreasing order, shape 
+               (num_densities, dim_x), or (num_densities, num_eig) for
+               the 'randomized' method
+        """
+        rho = tf.convert_to_tensor(rho)
+        if rho.shape != (self.num_densities, self.dim_x, self.dim_x):
+            raise ValueError(
+                f'rho shape must be ({self.num_densities}, {self.dim_x},'
+                f' {self.dim_x})')
+        if not self.built:
+            self.build((None, self.dim_x))
+        e, v = _eigh(rho, self.num_eig, method, tol)
+        self.eig_vec.assign(v[:, :, -self.num_eig:])
+        self.eig_val.assign(e[:, -self.num_eig:])
+        return e
+
+    def get_config(self):
+        config = {
+            "dim_x": self.dim_x,
+            "num_densities": self.num_densities,
+            "num_eig": self.num_eig
+        }
+        base_config = super().get_config()
+        return {**base_config, **config}
+
+    def compute_output_shape(self, input_shape):
+        return (self.num_densities,)
+
 def complex_initializer(base_initializer):
     """
     Complex Initializer to use in ComplexQMeasureDensityEig
@@ -1108,49 +2655,168 @@ class ComplexQMeasureDensity(tf.keras.layers.Layer):
         (batch_size, 1)
     Arguments:
         dim_x: int. the dimension of the input  state
+        real_blocks: bool. If True rho is stored as two real weights,
+            rho_re and rho_im, and the measurement is computed with a
+            real matrix multiplication on the blocks
+            [[re, im], [-im, re]]. The complex weight is pinned to the
+            CPU, the real ones are not.
+        packed: bool. If True only the upper triangular blocks of rho are
+            stored, in the weight rho_packed, see `pack_hermitian`, and
+            the measurement reads them directly. It cannot be combined
+            with real_blocks.
+        block_size: int. number of x indices per block of the packed
+            form
     """
 
     def __init__(
             self,
             dim_x: int,
+            real_blocks: bool = False,
+            packed: bool = False,
+            block_size: int = 256,
             **kwargs
     ):
+        if real_blocks and packed:
+            raise ValueError('real_blocks and packed cannot be both True')
         self.dim_x = dim_x
+        self.real_blocks = real_blocks
+        self.packed = packed
+        self.block_size = block_size
         super().__init__(**kwargs)
 
     def build(self, input_shape):
         if (not input_shape[1] is None) and input_shape[1] != self.dim_x:
             raise ValueError(
                 f'Input dimension must be (batch_size, {self.dim_x})')
-        with tf.device('cpu:0'):
-            self.rho = self.add_weight(
-                "rho",
+        if self.real_blocks:
+            self.rho_re = self.add_weight(
+                "rho_re",
                 shape=(self.dim_x, self.dim_x),
-                dtype=tf.complex64,
-                initializer=complex_initializer(tf.keras.initializers.Zeros),
-                trainable=True)
+                initializer=tf.keras.initializers.Zeros(),
+                trainable=True,
+                experimental_autocast=False)
+            self.rho_im = self.add_weight(
+                "rho_im",
+                shape=(self.dim_x, self.dim_x),
+                initializer=tf.keras.initializers.Zeros(),
+                trainable=True,
+                experimental_autocast=False)
+        elif self.packed:
+            with tf.device('cpu:0'):
+                self.rho_packed = self.add_weight(
+                    "rho_packed",
+                    shape=packed_shape(self.dim_x, None, self.block_size),
+                    dtype=_complex_dtype(self.variable_dtype),
+                    initializer=complex_initializer(
+                        tf.keras.initializers.Zeros),
+                    trainable=True)
+        else:
+            with tf.device('cpu:0'):
+                self.rho = self.add_weight(
+                    "rho",
+                    shape=(self.dim_x, self.dim_x),
+                    dtype=_complex_dtype(self.variable_dtype),
+                    initializer=complex_initializer(
+                        tf.keras.initializers.Zeros),
+                    trainable=True)
         axes = {i: input_shape[i] for i in range(1, len(input_shape))}
         self.input_spec = tf.keras.layers.InputSpec(
             ndim=len(input_shape), axes=axes)
         self.built = True
 
     def call(self, inputs):
+        if self.real_blocks:
+            return self._call_real_blocks(inputs)
+        if self.packed:
+            rho_packed = self.rho_packed[:, :, tf.newaxis, :, tf.newaxis]
+            rho_res = _packed_measure(inputs, rho_packed, self.dim_x)
+            return rho_res[:, 0, 0] # shape (b,)
         rho_res = tf.einsum(
             '...k, km, ...m -> ...',
             tf.math.conj(inputs), self.rho, inputs,
             optimize='optimal')  # shape (b,)
         return rho_res
 
+    def _call_real_blocks(self, inputs):
+        in_re, in_im = _split_complex(inputs, self.rho_re.dtype)
+        psi = tf.concat((in_re, in_im), 1) # shape (b, 2 nx)
+        # psi rho^T as [re(psi), im(psi)] [[re(rho)^T, im(rho)^T],
+        #                                  [-im(rho)^T, re(rho)^T]]
+        rho_re_t = tf.transpose(self.rho_re)
+        rho_im_t = tf.transpose(self.rho_im)
+        blocks = tf.concat((tf.concat((rho_re_t, rho_im_t), 1),
+                            tf.concat((-rho_im_t, rho_re_t), 1)), 0)
+        v = tf.matmul(psi, blocks) # shape (b, 2 nx)
+        v_re, v_im = v[:, :self.dim_x], v[:, self.dim_x:]
+        res_re = tf.reduce_sum(psi * v, axis=-1)
+        res_im = tf.reduce_sum(in_re * v_im - in_im * v_re, axis=-1)
+        return tf.complex(res_re, res_im) # shape (b,)
+
+    def set_rho(self, rho):
+        """
+        Sets the value of self.rho.
+
+        Arguments:
+            rho: a tensor of shape (dim_x, dim_x)
+        """
+        if not self.built:
+            self.build((None, self.dim_x))
+        if self.real_blocks:
+            rho_re, rho_im = _split_complex(rho, self.rho_re.dtype)
+            self.rho_re.assign(rho_re)
+            self.rho_im.assign(rho_im)
+        elif self.packed:
+            self.rho_packed.assign(
+                pack_hermitian(tf.cast(rho, self.rho_packed.dtype),
+                               self.block_size))
+        else:
+            self.rho.assign(tf.cast(rho, self.rho.dtype))
+
+    def set_rho_packed(self, rho_packed):
+        """
+        Sets the density matrix from its packed form, see
+        `pack_hermitian`.
+        """
+        if self.packed:
+            if not self.built:
+                self.build((None, self.dim_x))
+            self.rho_packed.assign(
+                tf.cast(rho_packed, self.rho_packed.dtype))
+        else:
+            self.set_rho(unpack_hermitian(rho_packed, self.dim_x))
+
+    def get_rho(self):
+        """
+        Returns the density matrix as a complex tensor of shape
+        (dim_x, dim_x).
+        """
+        if self.real_blocks:
+            return tf.complex(self.rho_re, self.rho_im)
+        if self.packed:
+            return unpack_hermitian(self.rho_packed, self.dim_x)
+        return tf.convert_to_tensor(self.rho)
+
+    def get_config(self):
+        config = {
+            "dim_x": self.dim_x,
+            "real_blocks": self.real_blocks,
+            "packed": self.packed,
+            "block_size": self.block_size
+        }
+        base_config = super().get_config()
+        return {**base_config, **config}
+
     def compute_output_shape(self, input_shape):
         return (1,)
 
-class ComplexQMeasureDensityEig(tf.keras.layers.Layer):
+class ComplexQMeasureDensityEig(_FrozenFactors, tf.keras.layers.Layer):
     """Quantum measurement layer for density estimation with complex terms.
     Represents the density matrix using a factorization:
 
     `dm = tf.matmul(V, tf.transpose(V, conjugate=True))`
 
-    This rerpesentation is ameanable to gradient-based learning
+    This rerpesentation is ameanable to gradient-based learning.
+    The normalized factor can be precomputed with `freeze`.
 
     Input shape:
         (batch_size, dim_x)
@@ -1160,12 +2826,18 @@ class ComplexQMeasureDensityEig(tf.keras.layers.Layer):
     Arguments:
         dim_x: int. the dimension of the input state
         num_eig: Number of eigenvectors used to represent the density matrix
+        real_blocks: bool. If True V is stored as two real weights,
+            eig_vec_re and eig_vec_im, and the products are computed
+            with real matrix multiplications on the blocks
+            [[re, im], [im, -re]]. The complex weight is pinned to the
+            CPU, the real ones are not.
     """
 
     def __init__(
             self,
             dim_x: int,
             num_eig: int =0,
+            real_blocks: bool = False,
             **kwargs
     ):
         super().__init__(**kwargs)
@@ -1173,53 +2845,96 @@ class ComplexQMeasureDensityEig(tf.keras.layers.Layer):
         if num_eig < 1:
             num_eig = dim_x
         self.num_eig = num_eig
+        self.real_blocks = real_blocks
 
     def build(self, input_shape):
         if (not input_shape[1] is None) and input_shape[1] != self.dim_x:
             raise ValueError(
                 f'Input dimension must be (batch_size, {self.dim_x})')
-        with tf.device('cpu:0'):
-            self.eig_vec = self.add_weight(
-                "eig_vec",
+        if self.real_blocks:
+            self.eig_vec_re = self.add_weight(
+                "eig_vec_re",
                 shape=(self.dim_x, self.num_eig),
-                dtype=tf.complex64,
-                initializer=complex_initializer(tf.random_normal_initializer),
-                trainable=True)
+                initializer=tf.random_normal_initializer(),
+                trainable=True,
+                experimental_autocast=False)
+            self.eig_vec_im = self.add_weight(
+                "eig_vec_im",
+                shape=(self.dim_x, self.num_eig),
+                initializer=tf.random_normal_initializer(),
+                trainable=True,
+                experimental_autocast=False)
+        else:
+            with tf.device('cpu:0'):
+                self.eig_vec = self.add_weight(
+                    "eig_vec",
+                    shape=(self.dim_x, self.num_eig),
+                    dtype=_complex_dtype(self.variable_dtype),
+                    initializer=complex_initializer(
+                        tf.random_normal_initializer),
+                    trainable=True)
         self.eig_val = self.add_weight(
             "eig_val",
             shape=(self.num_eig,),
             initializer=tf.keras.initializers.random_normal(),
-            trainable=True)
+            trainable=True,
+            experimental_autocast=False)
         axes = {i: input_shape[i] for i in range(1, len(input_shape))}
         self.input_spec = tf.keras.layers.InputSpec(
             ndim=len(input_shape), axes=axes)
+        self._build_factor_cache()
         self.built = True
 
-    def call(self, inputs):
-        inputs = tf.cast(inputs, tf.complex64)
-        norms = tf.expand_dims(tf.linalg.norm(self.eig_vec, axis=0), axis=0)
-        eig_vec = self.eig_vec / norms
+    def _factors(self):
         eig_val = tf.keras.activations.relu(self.eig_val)
         eig_val = eig_val / tf.reduce_sum(eig_val)
-        rho_h = tf.matmul(eig_vec,
-                          tf.cast(tf.linalg.diag(tf.sqrt(eig_val)), 
-                                  tf.complex64))
+        eig_val_sr = tf.expand_dims(tf.sqrt(eig_val), axis=0)
+        if self.real_blocks:
+            norms = tf.sqrt(tf.reduce_sum(
+                tf.square(self.eig_vec_re) + tf.square(self.eig_vec_im),
+                axis=0, keepdims=True))
+            v_re = self.eig_vec_re * (eig_val_sr / norms)
+            v_im = self.eig_vec_im * (eig_val_sr / norms)
+            # conj(psi) V as [re(psi), im(psi)] [[re(V), im(V)], [im(V), -re(V)]]
+            blocks = tf.concat((tf.concat((v_re, v_im), 1),
+                                tf.concat((v_im, -v_re), 1)), 0)
+            return (blocks,)
+        norms = tf.expand_dims(tf.linalg.norm(self.eig_vec, axis=0), axis=0)
+        rho_h = self.eig_vec / norms * tf.cast(eig_val_sr, self.eig_vec.dtype)
+        return (rho_h,)
+
+    def call(self, inputs):
+        rho_h, = self._current_factors()
+        if self.real_blocks:
+            return self._call_real_blocks(inputs, rho_h)
+        inputs = tf.cast(inputs, rho_h.dtype)
         rho_h = tf.matmul(tf.math.conj(inputs), rho_h)
         rho_res = tf.einsum(
             '...i, ...i -> ...',
             rho_h, tf.math.conj(rho_h), 
             optimize='optimal') # shape (b,)
-        rho_res = tf.cast(rho_res, tf.float32)
+        rho_res = tf.cast(tf.math.real(rho_res), self.compute_dtype)
         return rho_res
 
-    def set_rho(self, rho):
+    def _call_real_blocks(self, inputs, blocks):
+        in_re, in_im = _split_complex(inputs, blocks.dtype)
+        rho_h = tf.matmul(tf.concat((in_re, in_im), 1), blocks) # shape (b, 2 ne)
+        rho_res = tf.reduce_sum(tf.square(rho_h), axis=-1) # shape (b,)
+        return tf.cast(rho_res, self.compute_dtype)
+
+    def set_rho(self, rho, method='eigh', tol=1e-4):
         """
         Sets the value of self.rho_h using an eigendecomposition.
 
         Arguments:
             rho: a tensor of shape (dim_x, dim_x)
+            method: 'eigh' for a full eigendecomposition or 'randomized'
+                for an approximation of the top num_eig eigenpairs, see
+                `randomized_eigh`
+            tol: tolerance of the 'randomized' method
         Returns:
-            e: list of eigenvalues in non-decreasing order
+            e: list of eigenvalues in non-decreasing order, only the top
+               num_eig for the 'randomized' method
         """
         if (len(rho.shape.as_list()) != 2 or
                 rho.shape[0] != self.dim_x or
@@ -1228,15 +2943,23 @@ class ComplexQMeasureDensityEig(tf.keras.layers.Layer):
                 f'rho shape must be ({self.dim_x}, {self.dim_x})')
         if not self.built:
             self.build((None, self.dim_x))        
-        e, v = tf.linalg.eigh(rho)
-        self.eig_vec.assign(v[:, -self.num_eig:])
+        e, v = _eigh(rho, self.num_eig, method, tol)
+        if self.real_blocks:
+            v_re, v_im = _split_complex(v[:, -self.num_eig:],
+                                        self.eig_vec_re.dtype)
+            self.eig_vec_re.assign(v_re)
+            self.eig_vec_im.assign(v_im)
+        else:
+            self.eig_vec.assign(v[:, -self.num_eig:])
         self.eig_val.assign(e[-self.num_eig:])
+        self._refresh_factor_cache()
         return e
 
     def get_config(self):
         config = {
             "dim_x": self.dim_x,
-            "num_eig ": self.num_eig
+            "num_eig ": self.num_eig,
+            "real_blocks": self.real_blocks
         }
         base_config = super().get_config()
         return {**base_config, **config}
@@ -1287,11 +3010,13 @@ class QuantumDenseLayer(tf.keras.layers.Layer):
         self.built = True
 
     def call(self, inputs):
-        norms = tf.expand_dims(tf.linalg.norm(self.eig_vec, axis=1), axis=1)
-        eig_vec = self.eig_vec / norms
+        eig_vec = _high_precision(self.eig_vec)
+        norms = tf.expand_dims(tf.linalg.norm(eig_vec, axis=1), axis=1)
+        eig_vec = tf.cast(eig_vec / norms, inputs.dtype)
         psy_out = tf.einsum('ij,...j->...i', eig_vec, inputs, optimize='optimal') # shape (b, n_out)
+        psy_out = _high_precision(psy_out)
         norms_psy_out = tf.expand_dims(tf.linalg.norm(psy_out, axis=1), axis=1)
-        psy_out = psy_out/norms_psy_out
+        psy_out = tf.cast(psy_out/norms_psy_out, inputs.dtype)
         if self.last_layer == True:
           prob_out = tf.math.square(psy_out)
           return prob_out
@@ -1335,7 +3060,7 @@ class Vector2DensityMatrix(tf.keras.layers.Layer):
         self.built = True
 
     def call(self, inputs):
-        ones = tf.fill((tf.shape(inputs)[0], 1), 1.0)
+        ones = tf.ones((tf.shape(inputs)[0], 1), dtype=inputs.dtype)
         rho = tf.keras.layers.concatenate((ones, inputs), axis=1)
         rho = tf.expand_dims(rho, axis=-1)
         return rho
@@ -1434,6 +3159,175 @@ class CrossProduct(tf.keras.layers.Layer):
     def compute_output_shape(self, input_shape):
         return (input_shape[0][1], input_shape[1][1])
 
+class GramMatrix(tf.keras.layers.Layer):
+    """Calculates the sum over the batch of the outer products of the
+    input states with their conjugates, sum_i psi_i psi_i^H, using a single
+    matrix product instead of materializing the per-sample outer products.
+    If a tensor of weights w is also given, it calculates one weighted sum
+    per column of w, sum_i w_ik psi_i psi_i^H, with a single one-hot
+    (segment) matrix product.
+
+    Input shape:
+        A tensor psi with shape (batch_size, n_1, ..., n_k), or
+        a list of 2 tensors [psi, w] with shapes 
+        (batch_size, n_1, ..., n_k) and (batch_size, m)
+    Output shape:
+        (n_1, ..., n_k, n_1, ..., n_k), or
+        (m, n_1, ..., n_k, n_1, ..., n_k) if w is given, or
+        the packed form of `pack_hermitian` if packed is True
+    Arguments:
+        packed: bool. If True, psi must have shape (batch_size, dim_x) or
+            (batch_size, dim_x, dim_y), w is not supported, and only the
+            upper triangular blocks are computed, see `packed_gram`.
+        block_size: int. number of x indices per block of the packed
+            form
+    """
+
+    def __init__(
+            self,
+            packed: bool = False,
+            block_size: int = 256,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.packed = packed
+        self.block_size = block_size
+
+
+    def build(self, input_shape):
+        if isinstance(input_shape, (list, tuple)) and (
+                isinstance(input_shape[0], (list, tuple, tf.TensorShape))):
+            if len(input_shape) != 2 or len(input_shape[1]) != 2:
+                raise ValueError('A `GramMatrix` layer should be called '
+                                 'on a tensor or on a list [psi, w] where '
+                                 'w has shape (batch_size, m).')
+            if self.packed:
+                raise ValueError('A packed `GramMatrix` layer does not '
+                                 'support weights.')
+            psi_shape = input_shape[0]
+        else:
+            psi_shape = input_shape
+            if self.packed and len(psi_shape) not in (2, 3):
+                raise ValueError('A packed `GramMatrix` layer should be '
+                                 'called on a tensor of shape '
+                                 '(batch_size, dim_x) or '
+                                 '(batch_size, dim_x, dim_y)')
+        if len(psi_shape) < 2:
+            raise ValueError('A `GramMatrix` layer should be called '
+                             'on a tensor of shape (batch_size, ...)')
+        self.built = True
+
+    def call(self, inputs):
+        if isinstance(inputs, (list, tuple)):
+            psi, w = inputs
+        else:
+            psi, w = inputs, None
+        if self.packed:
+            return packed_gram(psi, self.block_size)
+        state_shape = psi.shape[1:]
+        if state_shape.is_fully_defined():
+            state_shape = tuple(state_shape)
+            dim = int(np.prod(state_shape))
+        else:
+            # e.g. feature maps that build the state with dynamic reshapes
+            state_shape = tf.shape(psi)[1:]
+            dim = tf.reduce_prod(state_shape)
+        psi = tf.reshape(psi, (-1, dim)) # shape (b, n)
+        if w is None:
+            gram = tf.matmul(psi, tf.math.conj(psi), transpose_a=True) # shape (n, n)
+            return tf.reshape(gram, tf.concat((state_shape, state_shape), 0))
+        w = tf.cast(w, psi.dtype)
+        num_w = w.shape[1]
+        w_psi = tf.einsum('...k,...i->...ki', w, psi, optimize='optimal')
+        w_psi = tf.reshape(w_psi, (-1, num_w * dim)) # shape (b, m * n)
+        gram = tf.matmul(w_psi, tf.math.conj(psi), transpose_a=True) # shape (m * n, n)
+        return tf.reshape(
+            gram, tf.concat(([num_w], state_shape, state_shape), 0))
+
+    def get_config(self):
+        config = {
+            "packed": self.packed,
+            "block_size": self.block_size
+        }
+        base_config = super().get_config()
+        return {**base_config, **config}
+
+    def compute_output_shape(self, input_shape):
+        if self.packed:
+            dim_y = input_shape[2] if len(input_shape) == 3 else None
+            return packed_shape(input_shape[1], dim_y, self.block_size)
+        if isinstance(input_shape, (list, tuple)) and (
+                isinstance(input_shape[0], (list, tuple, tf.TensorShape))):
+            return ((input_shape[1][1],) + tuple(input_shape[0][1:]) + 
+                    tuple(input_shape[0][1:]))
+        return tuple(input_shape[1:]) + tuple(input_shape[1:])
+
+class GramSketch(tf.keras.layers.Layer):
+    """Calculates a randomized sketch of the sum over the batch of the
+    outer products of the input states with their conjugates,
+    (sum_i psi_i psi_i^H) omega, where omega is a fixed random matrix
+    with orthonormal columns. It takes O(b n l) flops and O(n l) memory,
+    without forming the (n, n) matrix. Like the Gram matrix, the sketch
+    is a sum over the samples, and its top eigenpairs are recovered with
+    `nystrom_eigh`.
+
+    Input shape:
+        (batch_size, n_1, ..., n_k)
+    Output shape:
+        (n, sketch_size), where n = n_1 * ... * n_k
+    Arguments:
+        dim: int. n, the dimension of the flattened input state
+        sketch_size: int. number of columns of omega
+        random_state: random_state of omega. Sketches are only summable
+            if they share it.
+    """
+
+    def __init__(
+            self,
+            dim: int,
+            sketch_size: int,
+            random_state=None,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.dim = dim
+        self.sketch_size = min(sketch_size, dim)
+        self.random_state = random_state
+
+    def build(self, input_shape):
+        if (len(input_shape) < 2 or
+                int(np.prod(input_shape[1:])) != self.dim):
+            raise ValueError('A `GramSketch` layer should be called '
+                             f'on a tensor with {self.dim} values per '
+                             'sample')
+        rng = check_random_state(self.random_state)
+        omega, _ = np.linalg.qr(
+            rng.normal(size=(self.dim, self.sketch_size)))
+        self.omega = self.add_weight(
+            "omega",
+            shape=(self.dim, self.sketch_size),
+            initializer=tf.constant_initializer(omega),
+            trainable=False)
+        self.built = True
+
+    def call(self, inputs):
+        psi = tf.reshape(inputs, (-1, self.dim)) # shape (b, n)
+        omega = tf.cast(self.omega, psi.dtype)
+        psi_omega = tf.matmul(tf.math.conj(psi), omega) # shape (b, l)
+        return tf.matmul(psi, psi_omega, transpose_a=True) # shape (n, l)
+
+    def get_config(self):
+        config = {
+            "dim": self.dim,
+            "sketch_size": self.sketch_size,
+            "random_state": self.random_state
+        }
+        base_config = super().get_config()
+        return {**base_config, **config}
+
+    def compute_output_shape(self, input_shape):
+        return (self.dim, self.sketch_size)
+
 class DensityMatrix2Dist(tf.keras.layers.Layer):
     """Extracts a probability distribution from a density matrix.
 
@@ -1499,7 +3393,7 @@ class ComplexDensityMatrix2Dist(tf.keras.layers.Layer):
                              'called with a tensor of shape '
                              '(batch_size, n, n)')
         cp = tf.einsum('...ii->...i', inputs, optimize='optimal')
-        cp = tf.cast(cp, tf.float32)
+        cp = tf.cast(tf.math.real(cp), self.compute_dtype)
         return cp
 
     def compute_output_shape(self, input_shape):
@@ -1510,10 +3404,12 @@ class DensityMatrixRegression(tf.keras.layers.Layer):
     """
     Calculates the expected value and variance of a measure on a
     density matrix. The measure associates evenly distributed values
-    between 0 and 1 to the different n basis states.
+    between 0 and 1 to the different n basis states. Since only the
+    diagonal of the density matrix is used, the input can also be
+    the probability distribution given by that diagonal.
 
     Input shape:
-        A tensor with shape (batch_size, n, n)
+        A tensor with shape (batch_size, n, n) or (batch_size, n)
     Output shape:
         (batch_size, n, 2)
     Arguments:
@@ -1527,26 +3423,38 @@ class DensityMatrixRegression(tf.keras.layers.Layer):
 
 
     def build(self, input_shape):
-        if len(input_shape) != 3 or input_shape[1] != input_shape[2]:
-            raise ValueError('A `DensityMatrix2Dist` layer should be '
+        if not (len(input_shape) == 2 or 
+                len(input_shape) == 3 and input_shape[1] == input_shape[2]):
+            raise ValueError('A `DensityMatrixRegression` layer should be '
                              'called with a tensor of shape '
-                             '(batch_size, n, n)')
+                             '(batch_size, n, n) or (batch_size, n)')
         self.vals = tf.constant(tf.linspace(0., 1., input_shape[1]),
                                 dtype=tf.float32)
         self.vals2 = self.vals ** 2
         self.built = True
 
     def call(self, inputs):
+        dtype = inputs.dtype
+        inputs = _high_precision(inputs)
+        vals = tf.cast(self.vals, inputs.dtype)
+        vals2 = tf.cast(self.vals2, inputs.dtype)
+        if len(inputs.shape) == 2:
+            mean = tf.einsum('...i,i->...', inputs, 
+                             vals, optimize='optimal')
+            mean2 = tf.einsum('...i,i->...', inputs, 
+                              vals2, optimize='optimal')
+            var = mean2 - mean ** 2
+            return tf.cast(tf.stack([mean, var], axis = -1), dtype)
         if len(inputs.shape) != 3 or inputs.shape[1] != inputs.shape[2]:
-            raise ValueError('A `DensityMatrix2Dist` layer should be '
+            raise ValueError('A `DensityMatrixRegression` layer should be '
                              'called with a tensor of shape '
-                             '(batch_size, n, n)')
+                             '(batch_size, n, n) or (batch_size, n)')
         mean = tf.einsum('...ii,i->...', inputs, 
-                         self.vals, optimize='optimal')
+                         vals, optimize='optimal')
         mean2 = tf.einsum('...ii,i->...', inputs, 
-                          self.vals2, optimize='optimal')
+                          vals2, optimize='optimal')
         var = mean2 - mean ** 2
-        return tf.stack([mean, var], axis = -1)
+        return tf.cast(tf.stack([mean, var], axis = -1), dtype)
 
     def compute_output_shape(self, input_shape):
         return (input_shape[1], 2)
@@ -1577,7 +3485,8 @@ class ComplexDensityMatrixRegression(tf.keras.layers.Layer):
                              'called with a tensor of shape '
                              '(batch_size, n, n)')
         self.vals = tf.cast(tf.constant(tf.linspace(0., 1., input_shape[1]), 
-                            dtype=tf.float32), tf.complex64)
+                            dtype=tf.float32), 
+                            _complex_dtype(self.variable_dtype))
         self.vals2 = self.vals ** 2
         self.built = True
 
@@ -1586,13 +3495,15 @@ class ComplexDensityMatrixRegression(tf.keras.layers.Layer):
             raise ValueError('A `DensityMatrix2Dist` layer should be '
                              'called with a tensor of shape '
                              '(batch_size, n, n)')
-        mean = tf.einsum('...ii,i->...', inputs, self.vals, optimize='optimal')
-        mean2 = tf.einsum('...ii,i->...', inputs, self.vals2,
+        vals = tf.cast(self.vals, inputs.dtype)
+        vals2 = tf.cast(self.vals2, inputs.dtype)
+        mean = tf.einsum('...ii,i->...', inputs, vals, optimize='optimal')
+        mean2 = tf.einsum('...ii,i->...', inputs, vals2,
             optimize='optimal')
-        mean = tf.cast(mean, tf.float32)
-        mean2 = tf.cast(mean2, tf.float32)
+        mean = tf.math.real(mean)
+        mean2 = tf.math.real(mean2)
         var = mean2 - mean ** 2
-        return tf.stack([mean, var], axis = -1)
+        return tf.cast(tf.stack([mean, var], axis = -1), self.compute_dtype)
 
     def compute_output_shape(self, input_shape):
         return (input_shape[1], 2)
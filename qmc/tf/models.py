@@ -2,12 +2,361 @@
 Quantum Measurement Classfiication Models
 '''
 
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 import tensorflow as tf
 from tensorflow.python.keras.engine import data_adapter
 import numpy as np
 from . import layers
 
-class QMClassifier(tf.keras.Model):
+
+def _as_chunk(value):
+    """
+    Converts a chunk read from an array or iterator to a numpy array, using
+    the Keras float type for floating point data. Sparse chunks, scipy
+    sparse matrices or `tf.SparseTensor`, are converted to `tf.SparseTensor`.
+    """
+    if hasattr(value, 'tocoo'):
+        value = layers._sparse_from_scipy(value)
+    if isinstance(value, tf.SparseTensor):
+        if value.dtype.is_floating:
+            value = tf.cast(value, tf.keras.backend.floatx())
+        return value
+    value = np.asarray(value)
+    if np.issubdtype(value.dtype, np.floating):
+        value = value.astype(tf.keras.backend.floatx())
+    return value
+
+def _chunk_spec(value):
+    if isinstance(value, tf.SparseTensor):
+        return tf.SparseTensorSpec(shape=(None,) + tuple(value.shape[1:]),
+                                   dtype=value.dtype)
+    return tf.TensorSpec(shape=(None,) + value.shape[1:],
+                         dtype=tf.as_dtype(value.dtype))
+
+def make_stream(x, y=None, chunk_size=1024, prefetch=2):
+    """
+    Builds a `tf.data.Dataset` that streams a dataset in chunks without
+    loading it in memory.
+
+    Arguments:
+        x: one of
+            - a numpy array, `np.memmap` or scipy sparse matrix (chunks
+              are sliced on the fly),
+            - a path to a `.npy` file (opened as a read-only memmap),
+            - a `tf.data.Dataset` yielding batches `x` or `(x, y)`,
+            - an iterable of chunks `x` or `(x, y)`.
+        y: outputs, for array or path inputs. An array, memmap or path.
+        chunk_size: int. Number of samples per chunk for array inputs.
+        prefetch: int. Number of chunks prepared in the background while
+            the current one is processed.
+    Returns:
+        A `tf.data.Dataset` yielding chunks `x` or `(x, y)`.
+    """
+    if isinstance(x, tf.data.Dataset):
+        if y is not None:
+            raise ValueError('y must be None when x is a tf.data.Dataset')
+        return x.prefetch(prefetch)
+    if isinstance(x, str):
+        x = np.load(x, mmap_mode='r')
+    if isinstance(y, str):
+        y = np.load(y, mmap_mode='r')
+    if hasattr(x, 'shape') and hasattr(x, '__getitem__'):
+        num_rows = x.shape[0]
+        if y is not None and y.shape[0] != num_rows:
+            raise ValueError(
+                f'x and y must have the same number of rows but they have'
+                f' {num_rows} and {y.shape[0]}')
+        def generator():
+            for i in range(0, num_rows, chunk_size):
+                if y is None:
+                    yield _as_chunk(x[i:i + chunk_size])
+                else:
+                    yield (_as_chunk(x[i:i + chunk_size]),
+                           _as_chunk(y[i:i + chunk_size]))
+        if y is None:
+            signature = _chunk_spec(_as_chunk(x[:1]))
+        else:
+            signature = (_chunk_spec(_as_chunk(x[:1])),
+                         _chunk_spec(_as_chunk(y[:1])))
+    else:
+        if y is not None:
+            raise ValueError('y must be None when x is an iterable of chunks')
+        def convert(chunk):
+            if isinstance(chunk, tuple):
+                return tuple(_as_chunk(c) for c in chunk)
+            return _as_chunk(chunk)
+        chunks = iter(x)
+        try:
+            head = convert(next(chunks))
+        except StopIteration:
+            raise ValueError('x must yield at least one chunk') from None
+        def generator():
+            yield head
+            for chunk in chunks:
+                yield convert(chunk)
+        if isinstance(head, tuple):
+            signature = tuple(_chunk_spec(c) for c in head)
+        else:
+            signature = _chunk_spec(head)
+    dataset = tf.data.Dataset.from_generator(
+        generator, output_signature=signature)
+    return dataset.prefetch(prefetch)
+
+def merge_states(states):
+    """
+    Merges the states of closed-form models fitted on separate shards of
+    a dataset. Since the accumulators are sums over the samples, the
+    merged state is exactly the state of a model fitted on all shards.
+
+    Arguments:
+        states: a list of dicts as returned by `ClosedFormModel.get_state`.
+    Returns:
+        state: a dict with the summed accumulators.
+    """
+    states = list(states)
+    if not states:
+        raise ValueError('states must not be empty')
+    names = set(states[0])
+    for state in states[1:]:
+        if set(state) != names:
+            raise ValueError('All the states must have the same accumulators')
+    return {name: sum(state[name] for state in states) for name in names}
+
+def _init_shard_worker(num_threads):
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def _fit_shard(build_fn, shard, chunk_size):
+    model = build_fn()
+    if isinstance(shard, tuple):
+        model.fit_stream(*shard, chunk_size=chunk_size)
+    else:
+        model.fit_stream(shard, chunk_size=chunk_size)
+    return model.get_state()
+
+def fit_shards(build_fn, shards, processes=None, chunk_size=1024):
+    """
+    Fits a closed-form model on several shards of a dataset in parallel,
+    one process per shard, and merges the results.
+
+    Arguments:
+        build_fn: a picklable function (e.g. defined at module level) with
+            no arguments that returns a new, unfitted model. All the models
+            must share the same feature maps, e.g. by fixing random_state.
+        shards: a list of shards `x` or `(x, y)`, where `x` and `y` are
+            paths to `.npy` files or arrays, see `make_stream`. Paths
+            avoid copying the data to the worker processes.
+        processes: int. Number of worker processes. Defaults to the
+            number of CPUs.
+        chunk_size: int. Number of samples per chunk in each worker.
+    Returns:
+        model: a model built with `build_fn` with the merged state.
+    """
+    model = build_fn()
+    if not model.mergeable:
+        raise ValueError(
+            f'The state of a {type(model).__name__} model cannot be merged,'
+            ' see its mergeable property')
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(shards)))
+    num_threads = max(1, (os.cpu_count() or 1) // processes)
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                             initializer=_init_shard_worker,
+                             initargs=(num_threads,)) as executor:
+        futures = [executor.submit(_fit_shard, build_fn, shard, chunk_size)
+                   for shard in shards]
+        states = [future.result() for future in futures]
+    model.set_state(merge_states(states))
+    return model
+
+
+class ClosedFormModel(tf.keras.Model):
+    """
+    Base class of the models that are fitted in closed form, in a single
+    pass that accumulates sums over the training samples.
+
+    The unnormalized sums are kept in non-trainable accumulators, separate
+    from the density matrices used by the model, so the model can be
+    fitted incrementally and its state saved and restored.
+
+    The accumulators are sync-on-read variables. Under a `tf.distribute`
+    strategy each replica accumulates its own partial sums, which are
+    reduced only once, when they are read to update the density matrices
+    at the end of the fit.
+
+    Subclasses implement `train_step`, which adds a batch to the
+    accumulators, `_accumulators`, which returns them by name, and
+    `_update_rho`, which sets the density matrices of the model from them.
+    Subclasses whose accumulators are not plain sums, or only summable
+    under some configuration, set or override `mergeable`.
+    """
+
+    mergeable = True
+
+    def fit(self, *args, **kwargs):
+        result = super(ClosedFormModel, self).fit(*args, **kwargs)
+        self._update_rho()
+        return result
+
+    def fit_stream(self, x, y=None, chunk_size=1024, prefetch=2):
+        """
+        Fits the model streaming the data in chunks, without going through
+        `fit`. Memory use depends only on `chunk_size` and `prefetch`,
+        so it can be used with datasets larger than memory.
+
+        Arguments:
+            x: inputs. A numpy array, `np.memmap`, path to a `.npy` file,
+                `tf.data.Dataset` or iterable of chunks, see `make_stream`.
+            y: outputs, for array or path inputs.
+            chunk_size: int. Number of samples per chunk for array inputs.
+            prefetch: int. Number of chunks prepared in the background.
+        """
+        dataset = make_stream(x, y, chunk_size=chunk_size, prefetch=prefetch)
+        self._fit_dataset(dataset)
+
+    def partial_fit(self, x, y=None, refresh=True):
+        """
+        Adds a batch of samples to the accumulators and, if refresh is
+        True, updates the density matrices of the model. The step is
+        traced once per input signature, with a free batch size, so
+        adding a batch costs O(batch). Updating the density matrices
+        costs O(D^2) for dense models, or an eigendecomposition of the
+        sketch for the sketch models, whatever the batch size. To add
+        many small batches, pass refresh=False and call `refresh_rho`
+        when the model is queried.
+
+        Arguments:
+            x: inputs batch.
+            y: outputs batch.
+            refresh: bool. Whether to update the density matrices.
+        """
+        data = x if y is None else (x, y)
+        data = tf.nest.map_structure(_as_chunk, data)
+        strategy = self.distribute_strategy
+        if strategy.num_replicas_in_sync > 1:
+            # the batch has to be split among the replicas
+            self._fit_dataset(tf.data.Dataset.from_tensors(data),
+                              refresh=refresh)
+            return
+        # a single traced step per input signature, with a free batch size
+        signature = tf.nest.map_structure(_chunk_spec, data)
+        cached = getattr(self, '_partial_fit_fn', None)
+        if cached is None or cached[0] != signature:
+            def partial_step(data):
+                strategy.run(self.train_step, args=(data,))
+            cached = (signature, tf.function(partial_step,
+                                             input_signature=[signature]))
+            self._partial_fit_fn = cached
+        cached[1](data)
+        if refresh:
+            self._update_rho()
+
+    def refresh_rho(self):
+        """
+        Updates the density matrices of the model from the accumulators,
+        e.g. after calls to `partial_fit` with refresh=False.
+        """
+        self._update_rho()
+
+    def _fit_dataset(self, dataset, refresh=True):
+        strategy = self.distribute_strategy
+        if getattr(self, '_stream_step_fn', None) is None:
+            # the batch is read inside the function, as in Keras fit, so it
+            # keeps the static shapes of the dataset (a SparseTensor passed
+            # as an argument would lose them)
+            def stream_step(iterator):
+                data = iterator.get_next_as_optional()
+                if data.has_value():
+                    strategy.run(self.train_step, args=(data.get_value(),))
+                return data.has_value()
+            self._stream_step_fn = tf.function(stream_step)
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = (
+            tf.data.experimental.AutoShardPolicy.DATA)
+        dataset = dataset.with_options(options)
+        iterator = iter(strategy.experimental_distribute_dataset(dataset))
+        while self._stream_step_fn(iterator):
+            pass
+        if refresh:
+            self._update_rho()
+
+    def merge_state(self, state):
+        """
+        Adds the accumulators of a model fitted on another shard of the
+        data and updates the density matrices.
+
+        Arguments:
+            state: a dict of arrays as returned by `get_state`.
+        """
+        if not self.mergeable:
+            raise ValueError(
+                f'The state of a {type(self).__name__} model cannot be '
+                'merged, see its mergeable property')
+        self.set_state(merge_states([self.get_state(), state]))
+
+    def reset_accumulators(self):
+        """
+        Sets all the accumulators to zero.
+        """
+        for acc in self._accumulators().values():
+            acc.assign(tf.zeros_like(acc))
+
+    def get_state(self):
+        """
+        Returns the accumulators of the model.
+
+        Returns:
+            state: a dict of numpy arrays with the unnormalized sums
+                and the number of samples.
+        """
+        return {name: acc.numpy() for name, acc in self._accumulators().items()}
+
+    def set_state(self, state):
+        """
+        Sets the accumulators of the model and updates its density matrices.
+
+        Arguments:
+            state: a dict of arrays as returned by `get_state`.
+        """
+        accumulators = self._accumulators()
+        if set(state) != set(accumulators):
+            raise ValueError(
+                f'state must have the keys {sorted(accumulators)} but it has'
+                f' {sorted(state)}')
+        for name, acc in accumulators.items():
+            acc.assign(tf.cast(state[name], acc.dtype))
+        self._update_rho()
+
+    def save_state(self, path):
+        """
+        Saves the accumulators of the model to a `.npz` file.
+        """
+        np.savez(path, **self.get_state())
+
+    def load_state(self, path):
+        """
+        Loads the accumulators of the model from a `.npz` file saved by
+        `save_state`.
+        """
+        with np.load(path) as state:
+            self.set_state(dict(state))
+
+    def _accumulators(self):
+        raise NotImplementedError(
+            f'{type(self).__name__} must implement _accumulators, which '
+            'returns a dict with its accumulator variables by name')
+
+    def _update_rho(self):
+        raise NotImplementedError(
+            f'{type(self).__name__} must implement _update_rho, which sets '
+            'its density matrices from the accumulators')
+
+
+class QMClassifier(ClosedFormModel):
     """
     A Quantum Measurement Classifier model.
     Arguments:
@@ -15,24 +364,45 @@ class QMClassifier(tf.keras.Model):
         fm_y: Quantum feature map layer for outputs
         dim_x: dimension of the input quantum feature map
         dim_y: dimension of the output representation
+        packed: bool. If True the density matrix and its accumulator
+            keep only the upper triangular blocks, see
+            `layers.pack_hermitian`
+        block_size: number of input indices per packed block
     """
-    def __init__(self, fm_x, fm_y, dim_x, dim_y):
+    def __init__(self, fm_x, fm_y, dim_x, dim_y, packed=False,
+                 block_size=256):
         super(QMClassifier, self).__init__()
         self.fm_x = fm_x
         self.fm_y = fm_y
-        self.qm = layers.QMeasureClassif(dim_x=dim_x, dim_y=dim_y)
-        self.dm2dist = layers.DensityMatrix2Dist()
+        self.dim_x = dim_x
+        self.dim_y = dim_y
+        self.packed = packed
+        self.block_size = block_size
+        self.qm = layers.QMeasureClassif(dim_x=dim_x, dim_y=dim_y,
+                                         output_dist=True, packed=packed,
+                                         block_size=block_size)
         self.cp1 = layers.CrossProduct()
-        self.cp2 = layers.CrossProduct()
+        self.gram = layers.GramMatrix(packed=packed, block_size=block_size)
         self.num_samples = tf.Variable(
             initial_value=0.,
-            trainable=False     
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+        if packed:
+            rho_shape = layers.packed_shape(dim_x, dim_y, block_size)
+        else:
+            rho_shape = (dim_x, dim_y, dim_x, dim_y)
+        self.rho_sum = tf.Variable(
+            initial_value=tf.zeros(rho_shape),
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
             )
 
     def call(self, inputs):
         psi_x = self.fm_x(inputs)
-        rho_y = self.qm(psi_x)
-        probs = self.dm2dist(rho_y)
+        probs = self.qm(psi_x)
         return probs
 
     # @tf.function
@@ -41,10 +411,9 @@ class QMClassifier(tf.keras.Model):
             self.call(x)
         psi_x = self.fm_x(x)
         psi_y = self.fm_y(y)
-        psi = self.cp1([psi_x, psi_y])
-        rho = self.cp2([psi, tf.math.conj(psi)])
-        num_samples = tf.cast(tf.shape(x)[0], rho.dtype)
-        rho = tf.reduce_sum(rho, axis=0)
+        psi = self.cp1([psi_x, psi_y]) # shape (bs, dim_x, dim_y)
+        rho = self.gram(psi) # shape (dim_x, dim_y, dim_x, dim_y) or packed
+        num_samples = tf.cast(tf.shape(x)[0], self.num_samples.dtype)
         self.num_samples.assign_add(num_samples)
         return rho
 
@@ -53,17 +422,104 @@ class QMClassifier(tf.keras.Model):
         x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
         if x.shape[1] is not None:
             rho = self.call_train(x, y)
-            self.qm.weights[0].assign_add(rho)
+            self.rho_sum.assign_add(tf.cast(rho, self.rho_sum.dtype))
         return {'loss': 0.0}
 
-    def fit(self, *args, **kwargs):
-        result = super(QMClassifier, self).fit(*args, **kwargs)
-        self.qm.weights[0].assign(self.qm.weights[0] / self.num_samples)
-        return result
+    def _accumulators(self):
+        return {'rho_sum': self.rho_sum, 'num_samples': self.num_samples}
+
+    def _update_rho(self):
+        if not self.qm.built:
+            self.qm.build((None, self.dim_x))
+        rho = tf.math.divide_no_nan(self.rho_sum, self.num_samples)
+        if self.packed:
+            self.qm.set_rho_packed(rho)
+        else:
+            self.qm.set_rho(rho)
 
     def get_rho(self):
+        if self.packed:
+            return self.qm.get_rho()
         return self.qm.rho
 
+    def get_config(self):
+        config = {
+            "dim_x": self.dim_x,
+            "dim_y": self.dim_y,
+            "packed": self.packed,
+            "block_size": self.block_size
+        }
+        base_config = super().get_config()
+        return {**base_config, **config}
+
+
+class QMClassifierTable(ClosedFormModel):
+    """
+    A Quantum Measurement Classifier model for categorical inputs.
+    Equivalent to QMClassifier with one-hot feature maps, but works with
+    the indices of the basis states, accumulating counts by scatter-add
+    and predicting by gathering rows, see QMeasureClassifTable.
+    Arguments:
+        fm_x: QFeatureMapOneHot layer with output_index=True for inputs
+        fm_y: QFeatureMapOneHot layer with output_index=True for outputs
+        dim_x: dimension of the input quantum feature map
+        dim_y: dimension of the output representation
+    """
+    def __init__(self, fm_x, fm_y, dim_x, dim_y):
+        super(QMClassifierTable, self).__init__()
+        self.fm_x = fm_x
+        self.fm_y = fm_y
+        self.dim_x = dim_x
+        self.dim_y = dim_y
+        self.qm = layers.QMeasureClassifTable(dim_x=dim_x, dim_y=dim_y,
+                                              output_dist=True)
+        self.num_samples = tf.Variable(
+            initial_value=0.,
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+        self.counts_sum = tf.Variable(
+            initial_value=tf.zeros((dim_x, dim_y)),
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+
+    def call(self, inputs):
+        idx_x = self.fm_x(inputs)
+        probs = self.qm(idx_x)
+        return probs
+
+    def train_step(self, data):
+        data =  data_adapter.expand_1d(data)
+        x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
+        if x.shape[1] is not None:
+            idx = tf.stack([self.fm_x(x), self.fm_y(y)], axis=1)
+            counts = tf.ones((tf.shape(idx)[0],), self.counts_sum.dtype)
+            if tf.distribute.has_strategy():
+                # distributed sync-on-read variables do not support
+                # scatter updates, add a dense per-batch table instead
+                self.counts_sum.assign_add(
+                    tf.scatter_nd(idx, counts, self.counts_sum.shape))
+            else:
+                self.counts_sum.scatter_nd_add(idx, counts)
+            self.num_samples.assign_add(tf.reduce_sum(counts))
+        return {'loss': 0.0}
+
+    def _accumulators(self):
+        return {'counts_sum': self.counts_sum,
+                'num_samples': self.num_samples}
+
+    def _update_rho(self):
+        if not self.qm.built:
+            self.qm.build((None,))
+        self.qm.table.assign(
+            tf.math.divide_no_nan(self.counts_sum, self.num_samples))
+
+    def get_rho(self):
+        return self.qm.get_rho()
+
     def get_config(self):
         config = {
             "dim_x": self.dim_x,
@@ -73,6 +529,105 @@ class QMClassifier(tf.keras.Model):
         return {**base_config, **config}
 
 
+class QMClassifierSketch(ClosedFormModel):
+    """
+    A Quantum Measurement Classifier model fitted in closed form from a
+    randomized sketch of the training density matrix, see
+    `layers.GramSketch`, instead of the full matrix. It keeps
+    O(dim_x dim_y num_eig) values and represents the density matrix
+    with its top num_eig eigenpairs, as `QMClassifierSGD` does.
+    Arguments:
+        fm_x: Quantum feature map layer for inputs
+        fm_y: Quantum feature map layer for outputs
+        dim_x: dimension of the input quantum feature map
+        dim_y: dimension of the output representation
+        num_eig: number of eigenvectors of the density matrix
+        oversample: extra columns of the sketch
+        random_state: random_state of the sketch. Models whose states are
+            merged must share it, so it must be an int for the state to
+            be mergeable, e.g. by `fit_shards` or `merge_state`.
+    """
+    def __init__(self, fm_x, fm_y, dim_x, dim_y, num_eig, oversample=10,
+                 random_state=None):
+        super(QMClassifierSketch, self).__init__()
+        self.fm_x = fm_x
+        self.fm_y = fm_y
+        self.dim_x = dim_x
+        self.dim_y = dim_y
+        self.num_eig = num_eig
+        self.oversample = oversample
+        self.random_state = random_state
+        self.qm = layers.QMeasureClassifEig(dim_x=dim_x, dim_y=dim_y,
+                                            num_eig=num_eig,
+                                            output_dist=True)
+        self.cp1 = layers.CrossProduct()
+        self.gram = layers.GramSketch(dim_x * dim_y, num_eig + oversample,
+                                      random_state=random_state)
+        self.num_samples = tf.Variable(
+            initial_value=0.,
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+        self.sketch = tf.Variable(
+            initial_value=tf.zeros((dim_x * dim_y, self.gram.sketch_size)),
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+
+    @property
+    def mergeable(self):
+        # sketches are only summable if they share omega
+        return isinstance(self.random_state, (int, np.integer))
+
+    def call(self, inputs):
+        psi_x = self.fm_x(inputs)
+        probs = self.qm(psi_x)
+        return probs
+
+    @tf.function
+    def call_train(self, x, y):
+        if not self.qm.built:
+            self.call(x)
+        psi_x = self.fm_x(x)
+        psi_y = self.fm_y(y)
+        psi = self.cp1([psi_x, psi_y]) # shape (bs, dim_x, dim_y)
+        sketch = self.gram(psi) # shape (dim_x * dim_y, sketch_size)
+        num_samples = tf.cast(tf.shape(x)[0], self.num_samples.dtype)
+        self.num_samples.assign_add(num_samples)
+        return sketch
+
+    def train_step(self, data):
+        data =  data_adapter.expand_1d(data)
+        x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
+        if x.shape[1] is not None:
+            sketch = self.call_train(x, y)
+            self.sketch.assign_add(tf.cast(sketch, self.sketch.dtype))
+        return {'loss': 0.0}
+
+    def _accumulators(self):
+        return {'sketch': self.sketch, 'num_samples': self.num_samples}
+
+    def _update_rho(self):
+        if not self.gram.built:
+            self.gram.build((None, self.dim_x, self.dim_y))
+        sketch = tf.math.divide_no_nan(self.sketch, self.num_samples)
+        e, v = layers.nystrom_eigh(sketch, self.gram.omega, self.num_eig)
+        self.qm.set_eig(v, e)
+
+    def get_config(self):
+        config = {
+            "dim_x": self.dim_x,
+            "dim_y": self.dim_y,
+            "num_eig": self.num_eig,
+            "oversample": self.oversample,
+            "random_state": self.random_state
+        }
+        base_config = super().get_config()
+        return {**base_config, **config}
+
+
 class QMClassifierSGD(tf.keras.Model):
     """
     A Quantum Measurement Classifier model trainable using
@@ -92,8 +647,8 @@ class QMClassifierSGD(tf.keras.Model):
         self.fm_x = layers.QFeatureMapRFF(
             input_dim=input_dim,
             dim=dim_x, gamma=gamma, random_state=random_state)
-        self.qm = layers.QMeasureClassifEig(dim_x=dim_x, dim_y=dim_y, num_eig=num_eig)
-        self.dm2dist = layers.DensityMatrix2Dist()
+        self.qm = layers.QMeasureClassifEig(dim_x=dim_x, dim_y=dim_y, num_eig=num_eig,
+                                            output_dist=True)
         self.dim_x = dim_x
         self.dim_y = dim_y
         self.gamma = gamma
@@ -101,12 +656,27 @@ class QMClassifierSGD(tf.keras.Model):
 
     def call(self, inputs):
         psi_x = self.fm_x(inputs)
-        rho_y = self.qm(psi_x)
-        probs = self.dm2dist(rho_y)
+        probs = self.qm(psi_x)
         return probs
 
-    def set_rho(self, rho):
-        return self.qm.set_rho(rho)
+    def set_rho(self, rho, method='eigh', tol=1e-4):
+        return self.qm.set_rho(rho, method=method, tol=tol)
+
+    def update_rho(self, x, y, weight):
+        """
+        Folds a batch of samples into the density matrix with a truncated
+        rank num_eig update, see `layers.QMeasureClassifEig.update_rho`.
+
+        Arguments:
+            x: inputs batch
+            y: output states batch, shape (batch_size, dim_y), e.g.
+               one-hot labels
+            weight: float in (0, 1]. weight of the batch
+        """
+        psi_x = self.fm_x(x)
+        psi = tf.einsum('...i,...j->...ij', psi_x,
+                        tf.cast(y, psi_x.dtype)) # shape (b, dim_x, dim_y)
+        return self.qm.update_rho(psi, weight)
 
     def get_config(self):
         config = {
@@ -132,14 +702,19 @@ class ComplexQMClassifierSGD(tf.keras.Model):
                  a value of 0 or less implies num_eig = dim_x * dim_y
         gamma: float. Gamma parameter of the RBF kernel to be approximated.
         random_state: random number generator seed.
+        real_blocks: bool. If True the density matrix is stored and
+                 computed as real and imaginary blocks, see
+                 `layers.ComplexQMeasureClassifEig`
     """
-    def __init__(self, input_dim, dim_x, dim_y, num_eig=0, gamma=1, random_state=None, train_ffs = True):
+    def __init__(self, input_dim, dim_x, dim_y, num_eig=0, gamma=1, random_state=None, train_ffs = True,
+                 real_blocks=False):
         super(ComplexQMClassifierSGD, self).__init__()
         self.fm_x = layers.QFeatureMapComplexRFF(
             input_dim=input_dim,
             dim=dim_x, gamma=gamma, random_state=random_state, train_ffs = train_ffs)
-        self.qm = layers.ComplexQMeasureClassifEig(dim_x=dim_x, dim_y=dim_y, num_eig=num_eig)
-        self.dm2dist = layers.ComplexDensityMatrix2Dist()
+        self.qm = layers.ComplexQMeasureClassifEig(dim_x=dim_x, dim_y=dim_y, num_eig=num_eig,
+                                                   real_blocks=real_blocks,
+                                                   output_dist=True)
         self.dim_x = dim_x
         self.dim_y = dim_y
         self.gamma = gamma
@@ -147,12 +722,11 @@ class ComplexQMClassifierSGD(tf.keras.Model):
 
     def call(self, inputs):
         psi_x = self.fm_x(inputs)
-        rho_y = self.qm(psi_x)
-        probs = self.dm2dist(rho_y)
+        probs = self.qm(psi_x)
         return probs
 
-    def set_rho(self, rho):
-        return self.qm.set_rho(rho)
+    def set_rho(self, rho, method='eigh', tol=1e-4):
+        return self.qm.set_rho(rho, method=method, tol=tol)
 
     def get_config(self):
         config = {
@@ -165,22 +739,41 @@ class ComplexQMClassifierSGD(tf.keras.Model):
         base_config = super().get_config()
         return {**base_config, **config}
 
-class QMDensity(tf.keras.Model):
+class QMDensity(ClosedFormModel):
     """
     A Quantum Measurement Density Estimation model.
     Arguments:
         fm_x: Quantum feature map layer for inputs
         dim_x: dimension of the input quantum feature map
+        packed: bool. If True the density matrix and its accumulator
+            keep only the upper triangular blocks, see
+            `layers.pack_hermitian`
+        block_size: number of input indices per packed block
     """
-    def __init__(self, fm_x, dim_x):
+    def __init__(self, fm_x, dim_x, packed=False, block_size=256):
         super(QMDensity, self).__init__()
         self.fm_x = fm_x
         self.dim_x = dim_x
-        self.qmd = layers.QMeasureDensity(dim_x)
-        self.cp = layers.CrossProduct()
+        self.packed = packed
+        self.block_size = block_size
+        self.qmd = layers.QMeasureDensity(dim_x, packed=packed,
+                                          block_size=block_size)
+        self.gram = layers.GramMatrix(packed=packed, block_size=block_size)
         self.num_samples = tf.Variable(
             initial_value=0.,
-            trainable=False     
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+        if packed:
+            rho_shape = layers.packed_shape(dim_x, None, block_size)
+        else:
+            rho_shape = (dim_x, dim_x)
+        self.rho_sum = tf.Variable(
+            initial_value=tf.zeros(rho_shape),
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
             )
 
     def call(self, inputs):
@@ -193,9 +786,8 @@ class QMDensity(tf.keras.Model):
         if not self.qmd.built:
             self.call(x)
         psi = self.fm_x(x)
-        rho = self.cp([psi, tf.math.conj(psi)])
-        num_samples = tf.cast(tf.shape(x)[0], rho.dtype)
-        rho = tf.reduce_sum(rho, axis=0)
+        rho = self.gram(psi) # shape (dim_x, dim_x) or packed
+        num_samples = tf.cast(tf.shape(x)[0], self.num_samples.dtype)
         self.num_samples.assign_add(num_samples)
         return rho
 
@@ -204,34 +796,73 @@ class QMDensity(tf.keras.Model):
         x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
         if x.shape[1] is not None:
             rho = self.call_train(x)
-            self.qmd.weights[0].assign_add(rho)
+            self.rho_sum.assign_add(tf.cast(rho, self.rho_sum.dtype))
         return {}
 
-    def fit(self, *args, **kwargs):
-        result = super(QMDensity, self).fit(*args, **kwargs)
-        self.qmd.weights[0].assign(self.qmd.weights[0] / self.num_samples)
-        return result
+    def _accumulators(self):
+        return {'rho_sum': self.rho_sum, 'num_samples': self.num_samples}
+
+    def _update_rho(self):
+        if not self.qmd.built:
+            self.qmd.build((None, self.dim_x))
+        rho = tf.math.divide_no_nan(self.rho_sum, self.num_samples)
+        if self.packed:
+            self.qmd.set_rho_packed(rho)
+        else:
+            self.qmd.set_rho(rho)
+
+    def get_rho(self):
+        return self.qmd.get_rho()
 
     def get_config(self):
+        config = {
+            "packed": self.packed,
+            "block_size": self.block_size
+        }
         base_config = super().get_config()
-        return {**base_config}
+        return {**base_config, **config}
     
-class ComplexQMDensity(tf.keras.Model):
+class ComplexQMDensity(ClosedFormModel):
     """
     A Quantum Measurement Density Estimation model.
     Arguments:
         fm_x: Quantum feature map layer for inputs
         dim_x: dimension of the input quantum feature map
+        real_blocks: bool. If True the density matrix is stored and
+            computed as real and imaginary blocks, see
+            `layers.ComplexQMeasureDensity`
+        packed: bool. If True the density matrix and its accumulator
+            keep only the upper triangular blocks, see
+            `layers.pack_hermitian`
+        block_size: number of input indices per packed block
     """
-    def __init__(self, fm_x, dim_x):
+    def __init__(self, fm_x, dim_x, real_blocks=False, packed=False,
+                 block_size=256):
         super(ComplexQMDensity, self).__init__()
         self.fm_x = fm_x
         self.dim_x = dim_x
-        self.qmd = layers.ComplexQMeasureDensity(dim_x)
-        self.cp = layers.CrossProduct()
+        self.packed = packed
+        self.block_size = block_size
+        self.qmd = layers.ComplexQMeasureDensity(dim_x,
+                                                 real_blocks=real_blocks,
+                                                 packed=packed,
+                                                 block_size=block_size)
+        self.gram = layers.GramMatrix(packed=packed, block_size=block_size)
         self.num_samples = tf.Variable(
             initial_value=0.,
-            trainable=False     
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+        if packed:
+            rho_shape = layers.packed_shape(dim_x, None, block_size)
+        else:
+            rho_shape = (dim_x, dim_x)
+        self.rho_sum = tf.Variable(
+            initial_value=tf.zeros(rho_shape, dtype=tf.complex64),
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
             )
 
     def call(self, inputs):
@@ -244,9 +875,8 @@ class ComplexQMDensity(tf.keras.Model):
         if not self.qmd.built:
             self.call(x)
         psi = self.fm_x(x)
-        rho = self.cp([psi, tf.math.conj(psi)])
+        rho = self.gram(psi) # shape (dim_x, dim_x) or packed
         num_samples = tf.cast(tf.shape(x)[0], tf.float32)
-        rho = tf.reduce_sum(rho, axis=0)
         self.num_samples.assign_add(num_samples)
         return rho
 
@@ -255,18 +885,267 @@ class ComplexQMDensity(tf.keras.Model):
         x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
         if x.shape[1] is not None:
             rho = self.call_train(x)
-            self.qmd.weights[0].assign_add(rho)
+            self.rho_sum.assign_add(tf.cast(rho, self.rho_sum.dtype))
         return {}
 
-    def fit(self, *args, **kwargs):
-        result = super(ComplexQMDensity, self).fit(*args, **kwargs)
-        self.num_samples = tf.cast(self.num_samples, tf.complex64)
-        self.qmd.weights[0].assign(self.qmd.weights[0] / self.num_samples)
-        return result
+    def _accumulators(self):
+        return {'rho_sum': self.rho_sum, 'num_samples': self.num_samples}
+
+    def _update_rho(self):
+        if not self.qmd.built:
+            self.qmd.build((None, self.dim_x))
+        num_samples = tf.cast(self.num_samples, tf.complex64)
+        rho = tf.math.divide_no_nan(self.rho_sum, num_samples)
+        if self.packed:
+            self.qmd.set_rho_packed(rho)
+        else:
+            self.qmd.set_rho(rho)
+
+    def get_rho(self):
+        return self.qmd.get_rho()
 
     def get_config(self):
+        config = {
+            "packed": self.packed,
+            "block_size": self.block_size
+        }
         base_config = super().get_config()
-        return {**base_config}
+        return {**base_config, **config}
+
+class QMDensitySketch(ClosedFormModel):
+    """
+    A Quantum Measurement Density Estimation model fitted in closed form
+    from a randomized sketch of the training density matrix, see
+    `layers.GramSketch`. It keeps O(dim_x num_eig) values and represents
+    the density matrix with its top num_eig eigenpairs, as
+    `QMDensitySGD` does.
+    Arguments:
+        fm_x: Quantum feature map layer for inputs
+        dim_x: dimension of the input quantum feature map
+        num_eig: number of eigenvectors of the density matrix
+        oversample: extra columns of the sketch
+        random_state: random_state of the sketch. Models whose states are
+            merged must share it, so it must be an int for the state to
+            be mergeable, e.g. by `fit_shards` or `merge_state`.
+    """
+    def __init__(self, fm_x, dim_x, num_eig, oversample=10,
+                 random_state=None):
+        super(QMDensitySketch, self).__init__()
+        self.fm_x = fm_x
+        self.dim_x = dim_x
+        self.num_eig = num_eig
+        self.oversample = oversample
+        self.random_state = random_state
+        self.qmd = layers.QMeasureDensityEig(dim_x, num_eig)
+        self.gram = layers.GramSketch(dim_x, num_eig + oversample,
+                                      random_state=random_state)
+        self.num_samples = tf.Variable(
+            initial_value=0.,
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+        self.sketch = tf.Variable(
+            initial_value=tf.zeros((dim_x, self.gram.sketch_size)),
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+
+    @property
+    def mergeable(self):
+        # sketches are only summable if they share omega
+        return isinstance(self.random_state, (int, np.integer))
+
+    def call(self, inputs):
+        psi_x = self.fm_x(inputs)
+        probs = self.qmd(psi_x)
+        return probs
+
+    @tf.function
+    def call_train(self, x):
+        if not self.qmd.built:
+            self.call(x)
+        psi = self.fm_x(x)
+        sketch = self.gram(psi) # shape (dim_x, sketch_size)
+        num_samples = tf.cast(tf.shape(x)[0], self.num_samples.dtype)
+        self.num_samples.assign_add(num_samples)
+        return sketch
+
+    def train_step(self, data):
+        data =  data_adapter.expand_1d(data)
+        x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
+        if x.shape[1] is not None:
+            sketch = self.call_train(x)
+            self.sketch.assign_add(tf.cast(sketch, self.sketch.dtype))
+        return {}
+
+    def _accumulators(self):
+        return {'sketch': self.sketch, 'num_samples': self.num_samples}
+
+    def _update_rho(self):
+        if not self.gram.built:
+            self.gram.build((None, self.dim_x))
+        sketch = tf.math.divide_no_nan(self.sketch, self.num_samples)
+        e, v = layers.nystrom_eigh(sketch, self.gram.omega, self.num_eig)
+        self.qmd.set_eig(v, e)
+
+    def get_config(self):
+        config = {
+            "dim_x": self.dim_x,
+            "num_eig": self.num_eig,
+            "oversample": self.oversample,
+            "random_state": self.random_state
+        }
+        base_config = super().get_config()
+        return {**base_config, **config}
+
+class QMDensityStream(ClosedFormModel):
+    """
+    A Quantum Measurement Density Estimation model for streams, whose
+    density matrix only reflects the recent samples. The samples are
+    accumulated either in a ring buffer of num_windows windows of
+    window_size samples, the oldest one being dropped when a new one
+    starts, or, if decay is given, in a single sum where the weight of
+    each sample decays by that factor with every newer sample.
+
+    Every batch costs the same and the density matrix is updated after
+    each `partial_fit`, so it can be queried at any time, e.g. with
+    `score`. Windows are closed at batch boundaries, so a window may hold
+    up to one batch more than window_size samples.
+
+    The accumulators are ordered in time, so the state of the model
+    cannot be merged with the state of another one, e.g. by
+    `fit_shards`, and they are not replica-aware: the model must be used
+    without a multi-replica `tf.distribute` strategy.
+    Arguments:
+        fm_x: Quantum feature map layer for inputs
+        dim_x: dimension of the input quantum feature map
+        num_windows: number of windows of the ring buffer
+        window_size: number of samples per window
+        decay: float in (0, 1). If given, the exponential decay per
+            sample used instead of the windows
+    """
+    mergeable = False
+
+    def __init__(self, fm_x, dim_x, num_windows=8, window_size=1024,
+                 decay=None):
+        super(QMDensityStream, self).__init__()
+        if (tf.distribute.has_strategy() and
+                tf.distribute.get_strategy().num_replicas_in_sync > 1):
+            raise ValueError('QMDensityStream does not support '
+                             'multi-replica strategies')
+        self.fm_x = fm_x
+        self.dim_x = dim_x
+        self.num_windows = num_windows
+        self.window_size = window_size
+        self.decay = decay
+        self.qmd = layers.QMeasureDensity(dim_x)
+        self.gram = layers.GramMatrix()
+        num_sums = 1 if decay is not None else num_windows
+        self.rho_sums = tf.Variable(
+            initial_value=tf.zeros((num_sums, dim_x, dim_x)),
+            trainable=False)
+        self.num_samples = tf.Variable(
+            initial_value=tf.zeros((num_sums,)),
+            trainable=False)
+        self.window = tf.Variable(
+            initial_value=0,
+            trainable=False,
+            dtype=tf.int64)
+
+    def call(self, inputs):
+        psi_x = self.fm_x(inputs)
+        probs = self.qmd(psi_x)
+        return probs
+
+    @tf.function(reduce_retracing=True)
+    def score(self, x):
+        """
+        Returns the density of a batch of samples according to the
+        current density matrix.
+        """
+        return self.call(x)
+
+    def call_train(self, x):
+        if not self.qmd.built:
+            self.call(x)
+        psi = self.fm_x(x)
+        if self.decay is None:
+            rho = self.gram(psi) # shape (dim_x, dim_x)
+            num_samples = tf.cast(tf.shape(x)[0], self.num_samples.dtype)
+            return rho, num_samples
+        # the i-th of b samples has weight decay^(b - 1 - i)
+        age = tf.range(tf.shape(x)[0] - 1, -1, -1)
+        weights = tf.pow(tf.cast(self.decay, self.num_samples.dtype),
+                         tf.cast(age, self.num_samples.dtype))
+        rho = self.gram([psi, weights[:, tf.newaxis]])[0] # shape (dim_x, dim_x)
+        return rho, tf.reduce_sum(weights)
+
+    def train_step(self, data):
+        data =  data_adapter.expand_1d(data)
+        x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
+        if x.shape[1] is not None:
+            rho, num_samples = self.call_train(x)
+            rho = tf.cast(rho, self.rho_sums.dtype)
+            if self.decay is not None:
+                batch_size = tf.cast(tf.shape(x)[0], num_samples.dtype)
+                weight = tf.pow(tf.cast(self.decay, num_samples.dtype),
+                                batch_size)
+                self.rho_sums.assign(self.rho_sums * weight + rho)
+                self.num_samples.assign(self.num_samples * weight +
+                                        num_samples)
+            else:
+                self._add_to_window(rho, num_samples)
+        return {}
+
+    def _add_to_window(self, rho, num_samples):
+        window = self.window.read_value()
+        self.rho_sums.scatter_add(
+            tf.IndexedSlices(rho[tf.newaxis], window[tf.newaxis]))
+        self.num_samples.scatter_add(
+            tf.IndexedSlices(num_samples[tf.newaxis], window[tf.newaxis]))
+
+        def next_window():
+            # clears the oldest window, which becomes the current one
+            new_window = (window + 1) % self.num_windows
+            self.rho_sums.scatter_update(
+                tf.IndexedSlices(tf.zeros_like(rho)[tf.newaxis],
+                                 new_window[tf.newaxis]))
+            self.num_samples.scatter_update(
+                tf.IndexedSlices(tf.zeros((1,), self.num_samples.dtype),
+                                 new_window[tf.newaxis]))
+            return new_window
+
+        # tf.cond, since Keras runs train_step in graph mode without
+        # autograph
+        window = tf.cond(self.num_samples[window] >= self.window_size,
+                         next_window, lambda: window)
+        self.window.assign(window)
+
+    def _accumulators(self):
+        return {'rho_sums': self.rho_sums, 'num_samples': self.num_samples,
+                'window': self.window}
+
+    def _update_rho(self):
+        if not self.qmd.built:
+            self.qmd.build((None, self.dim_x))
+        self.qmd.set_rho(tf.math.divide_no_nan(
+            tf.reduce_sum(self.rho_sums, axis=0),
+            tf.reduce_sum(self.num_samples)))
+
+    def get_rho(self):
+        return self.qmd.get_rho()
+
+    def get_config(self):
+        config = {
+            "dim_x": self.dim_x,
+            "num_windows": self.num_windows,
+            "window_size": self.window_size,
+            "decay": self.decay
+        }
+        base_config = super().get_config()
+        return {**base_config, **config}
 
 class QMDensitySGD(tf.keras.Model):
     """
@@ -297,8 +1176,19 @@ class QMDensitySGD(tf.keras.Model):
         self.add_loss(-tf.reduce_sum(tf.math.log(probs)))
         return probs
 
-    def set_rho(self, rho):
-        return self.qmd.set_rho(rho)
+    def set_rho(self, rho, method='eigh', tol=1e-4):
+        return self.qmd.set_rho(rho, method=method, tol=tol)
+
+    def update_rho(self, x, weight):
+        """
+        Folds a batch of samples into the density matrix with a truncated
+        rank num_eig update, see `layers.QMeasureDensityEig.update_rho`.
+
+        Arguments:
+            x: inputs batch
+            weight: float in (0, 1]. weight of the batch
+        """
+        return self.qmd.update_rho(self.fm_x(x), weight)
 
     def get_config(self):
         config = {
@@ -309,7 +1199,7 @@ class QMDensitySGD(tf.keras.Model):
         base_config = super().get_config()
         return {**base_config, **config}
 
-class DMKDClassifier(tf.keras.Model):
+class DMKDClassifier(ClosedFormModel):
     """
     A Quantum Measurement Kernel Density Classifier model.
     Arguments:
@@ -322,38 +1212,37 @@ class DMKDClassifier(tf.keras.Model):
         self.fm_x = fm_x
         self.dim_x = dim_x
         self.num_classes = num_classes
-        self.qmd = []
-        for _ in range(num_classes):
-            self.qmd.append(layers.QMeasureDensity(dim_x))
-        self.cp = layers.CrossProduct()
+        self.qmd = layers.QMeasureMultiDensity(dim_x, num_classes)
+        self.gram = layers.GramMatrix()
         self.num_samples = tf.Variable(
             initial_value=tf.zeros((num_classes,)),
-            trainable=False
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+        self.rhos_sum = tf.Variable(
+            initial_value=tf.zeros((num_classes, dim_x, dim_x)),
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
             )
 
     def call(self, inputs):
         psi_x = self.fm_x(inputs)
-        probs = []
-        for i in range(self.num_classes):
-            probs.append(self.qmd[i](psi_x))
-        posteriors = tf.stack(probs, axis=-1)
+        posteriors = self.qmd(psi_x) # shape (bs, num_classes)
         posteriors = (posteriors / 
             tf.expand_dims(tf.reduce_sum(posteriors, axis=-1), axis=-1))
         return posteriors
 
     @tf.function
     def call_train(self, x, y):
-        if not self.qmd[0].built:
+        if not self.qmd.built:
             self.call(x)
         psi = self.fm_x(x) # shape (bs, dim_x)
-        rho = self.cp([psi, tf.math.conj(psi)]) # shape (bs, dim_x, dim_x)
         ohy = tf.keras.backend.one_hot(y, self.num_classes)
-        ohy = tf.reshape(ohy, (-1, self.num_classes))
+        ohy = tf.reshape(ohy, (-1, self.num_classes)) # shape (bs, num_classes)
         num_samples = tf.squeeze(tf.reduce_sum(ohy, axis=0))
-        ohy = tf.expand_dims(ohy, axis=-1) 
-        ohy = tf.expand_dims(ohy, axis=-1) # shape (bs, num_classes, 1, 1)
-        rhos = ohy * tf.expand_dims(rho, axis=1) # shape (bs, num_classes, dim_x, dim_x)
-        rhos = tf.reduce_sum(rhos, axis=0) # shape (num_classes, dim_x, dim_x)
+        rhos = self.gram([psi, ohy]) # shape (num_classes, dim_x, dim_x)
         self.num_samples.assign_add(num_samples)
         return rhos
 
@@ -362,20 +1251,23 @@ class DMKDClassifier(tf.keras.Model):
         x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
         if x.shape[1] is not None:
             rhos = self.call_train(x, y)
-            for i in range(self.num_classes):
-                self.qmd[i].weights[0].assign_add(rhos[i])
+            self.rhos_sum.assign_add(tf.cast(rhos, self.rhos_sum.dtype))
         return {}
 
-    def fit(self, *args, **kwargs):
-        result = super(DMKDClassifier, self).fit(*args, **kwargs)
-        for i in range(self.num_classes):
-            self.qmd[i].weights[0].assign(self.qmd[i].weights[0] /
-                                          self.num_samples[i])
-        return result
+    def _accumulators(self):
+        return {'rhos_sum': self.rhos_sum, 'num_samples': self.num_samples}
+
+    def _update_rho(self):
+        num_samples = tf.reshape(self.num_samples, (-1, 1, 1))
+        self.qmd.set_rho(tf.math.divide_no_nan(self.rhos_sum, num_samples))
 
     def get_rhos(self):
-        weights = [qmd.weights[0] for qmd in self.qmd]
-        return weights
+        """
+        Returns the density matrix of each class. The matrices are slices
+        of the stacked weight of `layers.QMeasureMultiDensity`, so they
+        can be assigned in place, e.g. `model.get_rhos()[0].assign(rho)`.
+        """
+        return [self.qmd.rho[i] for i in range(self.num_classes)]
 
     def get_config(self):
         config = {
@@ -385,26 +1277,40 @@ class DMKDClassifier(tf.keras.Model):
         base_config = super().get_config()
         return {**base_config, **config}
 
-class ComplexDMKDClassifier(tf.keras.Model):
+class ComplexDMKDClassifier(ClosedFormModel):
     """
     A Quantum Measurement Kernel Density Classifier model with complex terms.
     Arguments:
         fm_x: Quantum feature map layer for inputs
         dim_x: dimension of the input quantum feature map
         num_classes: int number of classes
+        real_blocks: bool. If True the density matrices are stored and
+            computed as real and imaginary blocks, see
+            `layers.ComplexQMeasureDensity`
     """
-    def __init__(self, fm_x, dim_x, num_classes=2):
+    def __init__(self, fm_x, dim_x, num_classes=2, real_blocks=False):
         super(ComplexDMKDClassifier, self).__init__()
         self.fm_x = fm_x
         self.dim_x = dim_x
         self.num_classes = num_classes
+        self.real_blocks = real_blocks
         self.qmd = []
         for _ in range(num_classes):
-            self.qmd.append(layers.ComplexQMeasureDensity(dim_x))
-        self.cp = layers.CrossProduct()
+            self.qmd.append(layers.ComplexQMeasureDensity(
+                dim_x, real_blocks=real_blocks))
+        self.gram = layers.GramMatrix()
         self.num_samples = tf.Variable(
             initial_value=tf.zeros((num_classes,)),
-            trainable=False
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+        self.rhos_sum = tf.Variable(
+            initial_value=tf.zeros((num_classes, dim_x, dim_x),
+                                   dtype=tf.complex64),
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
             )
 
     def call(self, inputs):
@@ -421,41 +1327,48 @@ class ComplexDMKDClassifier(tf.keras.Model):
         if not self.qmd[0].built:
             self.call(x)
         psi = self.fm_x(x) # shape (bs, dim_x)
-        rho = self.cp([psi, tf.math.conj(psi)]) # shape (bs, dim_x, dim_x)
         ohy = tf.keras.backend.one_hot(y, self.num_classes)
-        ohy = tf.reshape(ohy, (-1, self.num_classes))
+        ohy = tf.reshape(ohy, (-1, self.num_classes)) # shape (bs, num_classes)
         num_samples = tf.squeeze(tf.reduce_sum(ohy, axis=0))
-        ohy = tf.expand_dims(ohy, axis=-1) 
-        ohy = tf.expand_dims(ohy, axis=-1) # shape (bs, num_classes, 1, 1)
-        rhos = tf.cast(ohy, tf.complex64) * tf.expand_dims(rho, axis=1) # shape (bs, num_classes, dim_x, dim_x)
-        rhos = tf.reduce_sum(rhos, axis=0) # shape (num_classes, dim_x, dim_x)
+        rhos = self.gram([psi, ohy]) # shape (num_classes, dim_x, dim_x)
         self.num_samples.assign_add(num_samples)
         return rhos
 
     def train_step(self, data):
         data =  data_adapter.expand_1d(data)
         x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
-        rhos = self.call_train(x, y)
         if x.shape[1] is not None:
-            for i in range(self.num_classes):
-                self.qmd[i].weights[0].assign_add(rhos[i])
+            rhos = self.call_train(x, y)
+            self.rhos_sum.assign_add(tf.cast(rhos, self.rhos_sum.dtype))
         return {}
 
-    def fit(self, *args, **kwargs):
-        result = super(ComplexDMKDClassifier, self).fit(*args, **kwargs)
+    def _accumulators(self):
+        return {'rhos_sum': self.rhos_sum, 'num_samples': self.num_samples}
+
+    def _update_rho(self):
+        num_samples = tf.cast(self.num_samples, tf.complex64)
         for i in range(self.num_classes):
-            self.qmd[i].weights[0].assign(self.qmd[i].weights[0] /
-                                          tf.cast(self.num_samples[i], tf.complex64))
-        return result
+            if not self.qmd[i].built:
+                self.qmd[i].build((None, self.dim_x))
+            self.qmd[i].set_rho(
+                tf.math.divide_no_nan(self.rhos_sum[i], num_samples[i]))
 
     def get_rhos(self):
-        weights = [qmd.weights[0] for qmd in self.qmd]
-        return weights
+        """
+        Returns the density matrix of each class, the rho variables of
+        the layers, which can be assigned in place. With real_blocks the
+        matrices are built from the real and imaginary weights, so they
+        are read-only tensors; use `set_rho` of the layers to change them.
+        """
+        if self.real_blocks:
+            return [qmd.get_rho() for qmd in self.qmd]
+        return [qmd.rho for qmd in self.qmd]
 
     def get_config(self):
         config = {
             "dim_x": self.dim_x,
-            "num_classes": self.num_classes
+            "num_classes": self.num_classes,
+            "real_blocks": self.real_blocks
         }
         base_config = super().get_config()
         return {**base_config, **config}
@@ -481,26 +1394,20 @@ class DMKDClassifierSGD(tf.keras.Model):
             dim=dim_x, gamma=gamma, random_state=random_state)
         self.dim_x = dim_x
         self.num_classes = num_classes
-        self.qmd = []
-        for _ in range(num_classes):
-            self.qmd.append(layers.QMeasureDensityEig(dim_x, num_eig))
+        self.num_eig = num_eig
+        self.qmd = layers.QMeasureMultiDensityEig(dim_x, num_classes, num_eig)
         self.gamma = gamma
         self.random_state = random_state
 
     def call(self, inputs):
         psi_x = self.fm_x(inputs)
-        probs = []
-        for i in range(self.num_classes):
-            probs.append(self.qmd[i](psi_x))
-        posteriors = tf.stack(probs, axis=-1)
+        posteriors = self.qmd(psi_x) # shape (bs, num_classes)
         posteriors = (posteriors / 
                       tf.expand_dims(tf.reduce_sum(posteriors, axis=-1), axis=-1))
         return posteriors
 
-    def set_rhos(self, rhos):
-        for i in range(self.num_classes):
-            self.qmd[i].set_rho(rhos[i])
-        return
+    def set_rhos(self, rhos, method='eigh', tol=1e-4):
+        return self.qmd.set_rho(rhos, method=method, tol=tol)
 
     def get_config(self):
         config = {
@@ -526,9 +1433,12 @@ class ComplexDMKDClassifierSGD(tf.keras.Model):
                  a value of 0 or less implies num_eig = dim_x 
         gamma: float. Gamma parameter of the RBF kernel to be approximated
         random_state: random number generator seed
+        real_blocks: bool. If True the density matrices are stored and
+                 computed as real and imaginary blocks, see
+                 `layers.ComplexQMeasureDensityEig`
     """
     def __init__(self, input_dim, dim_x, num_classes, 
-                 num_eig=0, gamma=1, random_state=None):
+                 num_eig=0, gamma=1, random_state=None, real_blocks=False):
         super(ComplexDMKDClassifierSGD, self).__init__()
         self.fm_x = layers.QFeatureMapComplexRFF(
             input_dim=input_dim,
@@ -537,7 +1447,8 @@ class ComplexDMKDClassifierSGD(tf.keras.Model):
         self.num_classes = num_classes
         self.qmd = []
         for _ in range(num_classes):
-            self.qmd.append(layers.ComplexQMeasureDensityEig(dim_x, num_eig))
+            self.qmd.append(layers.ComplexQMeasureDensityEig(
+                dim_x, num_eig, real_blocks=real_blocks))
         self.gamma = gamma
         self.random_state = random_state
 
@@ -551,9 +1462,9 @@ class ComplexDMKDClassifierSGD(tf.keras.Model):
                       tf.expand_dims(tf.reduce_sum(posteriors, axis=-1), axis=-1))
         return posteriors
 
-    def set_rhos(self, rhos):
+    def set_rhos(self, rhos, method='eigh', tol=1e-4):
         for i in range(self.num_classes):
-            self.qmd[i].set_rho(rhos[i])
+            self.qmd[i].set_rho(rhos[i], method=method, tol=tol)
         return
 
     def get_config(self):
@@ -567,24 +1478,42 @@ class ComplexDMKDClassifierSGD(tf.keras.Model):
         base_config = super().get_config()
         return {**base_config, **config}
 
-class ComplexDMKDRegressor(tf.keras.Model):
+class ComplexDMKDRegressor(ClosedFormModel):
     """
     A Quantum Measurement Kernel Density Regressor model.
     Arguments:
         fm_x: Quantum feature map layer for inputs
         dim_x: dimension of the input quantum feature map
+        real_blocks: bool. If True the density matrices are stored and
+            computed as real and imaginary blocks, see
+            `layers.ComplexQMeasureDensity`
     """
-    def __init__(self, fm_x, dim_x):
+    def __init__(self, fm_x, dim_x, real_blocks=False):
         super(ComplexDMKDRegressor, self).__init__()
         self.fm_x = fm_x
         self.dim_x = dim_x
-        self.qmd = layers.ComplexQMeasureDensity(dim_x)
-        self.qmr = layers.ComplexQMeasureDensity(dim_x)
-        self.cpd = layers.CrossProduct()
-        self.cpr = layers.CrossProduct()
+        self.qmd = layers.ComplexQMeasureDensity(dim_x,
+                                                 real_blocks=real_blocks)
+        self.qmr = layers.ComplexQMeasureDensity(dim_x,
+                                                 real_blocks=real_blocks)
+        self.gram = layers.GramMatrix()
         self.num_samples = tf.Variable(
             initial_value=0.,
-            trainable=False
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+        self.rho_de_sum = tf.Variable(
+            initial_value=tf.zeros((dim_x, dim_x), dtype=tf.complex64),
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+        self.rho_reg_sum = tf.Variable(
+            initial_value=tf.zeros((dim_x, dim_x), dtype=tf.complex64),
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
             )
 
     def call(self, inputs):
@@ -596,44 +1525,38 @@ class ComplexDMKDRegressor(tf.keras.Model):
         return probs
 
     @tf.function
-    def call_train_de(self, x):
+    def call_train(self, x, y):
         if not self.qmd.built:
             self.call(x)
-        psi = self.fm_x(x)
-        rho_de = self.cpd([psi, tf.math.conj(psi)])
-        num_samples = tf.cast(tf.shape(x)[0], tf.float32)
-        rho_de = tf.reduce_sum(rho_de, axis=0)
-        self.num_samples.assign_add(num_samples)
-        return rho_de
-
-    @tf.function
-    def call_train_reg(self, x, y):
-        if not self.qmr.built:
-            self.call(x)
-        psi = self.fm_x(x)
-        y = tf.cast(tf.expand_dims(y, axis=-1), tf.complex64)
-        rho_reg = y*self.cpr([psi, tf.math.conj(psi)])
+        psi = self.fm_x(x) # shape (bs, dim_x)
+        y = tf.cast(tf.reshape(y, (-1, 1)), tf.float32)
+        w = tf.concat((tf.ones_like(y), y), axis=1) # shape (bs, 2)
+        rhos = self.gram([psi, w]) # shape (2, dim_x, dim_x)
         num_samples = tf.cast(tf.shape(x)[0], tf.float32)
-        rho_reg = tf.reduce_sum(rho_reg, axis=0)
         self.num_samples.assign_add(num_samples)
-        return rho_reg
+        return rhos[0], rhos[1]
 
     def train_step(self, data):
         data =  data_adapter.expand_1d(data)
         x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
         if x.shape[1] is not None:
-            rho_de = self.call_train_de(x)
-            rho_reg = self.call_train_reg(x, y)
-            self.qmd.weights[0].assign_add(rho_de)
-            self.qmr.weights[0].assign_add(rho_reg)
+            rho_de, rho_reg = self.call_train(x, y)
+            self.rho_de_sum.assign_add(tf.cast(rho_de, self.rho_de_sum.dtype))
+            self.rho_reg_sum.assign_add(tf.cast(rho_reg, self.rho_reg_sum.dtype))
         return {}
 
-    def fit(self, *args, **kwargs):
-        result = super(ComplexDMKDRegressor, self).fit(*args, **kwargs)
-        self.num_samples = tf.cast(self.num_samples, tf.complex64)
-        self.qmd.weights[0].assign(self.qmd.weights[0] / self.num_samples)
-        self.qmr.weights[0].assign(self.qmr.weights[0] / self.num_samples)
-        return result
+    def _accumulators(self):
+        return {'rho_de_sum': self.rho_de_sum,
+                'rho_reg_sum': self.rho_reg_sum,
+                'num_samples': self.num_samples}
+
+    def _update_rho(self):
+        if not self.qmd.built:
+            self.qmd.build((None, self.dim_x))
+            self.qmr.build((None, self.dim_x))
+        num_samples = tf.cast(self.num_samples, tf.complex64)
+        self.qmd.set_rho(tf.math.divide_no_nan(self.rho_de_sum, num_samples))
+        self.qmr.set_rho(tf.math.divide_no_nan(self.rho_reg_sum, num_samples))
 
     def get_config(self):
         base_config = super().get_config()
@@ -646,14 +1569,15 @@ class ComplexDMKDRegressorSGD:
 
     Args:
         auto_compile: A boolean to autocompile the model using default settings. (Default True).
+        real_blocks: A boolean to store the complex density matrix as real and imaginary blocks. (Default False).
 
     Returns:
         An instantiated model ready to train with ad-hoc data.
 
     """
-    def __init__(self, input_dim, num_ffs, y_min, y_max, num_eig=0, gamma=1, batch_size = 16, learning_rate = 0.0005, random_state=None, train_ffs = True, auto_compile=True):
+    def __init__(self, input_dim, num_ffs, y_min, y_max, num_eig=0, gamma=1, batch_size = 16, learning_rate = 0.0005, random_state=None, train_ffs = True, auto_compile=True, real_blocks=False):
 
-        self.model = ComplexQMClassifierSGD(input_dim = input_dim, dim_x = num_ffs, dim_y = 2, num_eig=num_eig, gamma=gamma, random_state=random_state, train_ffs = train_ffs)
+        self.model = ComplexQMClassifierSGD(input_dim = input_dim, dim_x = num_ffs, dim_y = 2, num_eig=num_eig, gamma=gamma, random_state=random_state, train_ffs = train_ffs, real_blocks=real_blocks)
         self.num_ffs = num_ffs
         self.gamma = gamma
         self.y_min = y_min
@@ -736,7 +1660,7 @@ class ComplexDMKDRegressorSGD:
       """
       return ((self.y_max - self.y_min)*self.model.predict(x_test) + self.y_min)[:, 0]
 
-class QMRegressor(tf.keras.Model):
+class QMRegressor(ClosedFormModel):
     """
     A Quantum Measurement Regression model.
     Arguments:
@@ -744,24 +1668,47 @@ class QMRegressor(tf.keras.Model):
         fm_y: Quantum feature map layer for outputs
         dim_x: dimension of the input quantum feature map
         dim_y: dimension of the output quantum feature map
+        packed: bool. If True the density matrix and its accumulator
+            keep only the upper triangular blocks, see
+            `layers.pack_hermitian`
+        block_size: number of input indices per packed block
     """
-    def __init__(self, fm_x, fm_y, dim_x, dim_y):
+    def __init__(self, fm_x, fm_y, dim_x, dim_y, packed=False,
+                 block_size=256):
         super(QMRegressor, self).__init__()
         self.fm_x = fm_x
         self.fm_y = fm_y
-        self.qm = layers.QMeasureClassif(dim_x=dim_x, dim_y=dim_y)
+        self.dim_x = dim_x
+        self.dim_y = dim_y
+        self.packed = packed
+        self.block_size = block_size
+        self.qm = layers.QMeasureClassif(dim_x=dim_x, dim_y=dim_y,
+                                         output_dist=True, packed=packed,
+                                         block_size=block_size)
         self.dmregress = layers.DensityMatrixRegression()
         self.cp1 = layers.CrossProduct()
-        self.cp2 = layers.CrossProduct()
+        self.gram = layers.GramMatrix(packed=packed, block_size=block_size)
         self.num_samples = tf.Variable(
             initial_value=0.,
-            trainable=False     
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
+            )
+        if packed:
+            rho_shape = layers.packed_shape(dim_x, dim_y, block_size)
+        else:
+            rho_shape = (dim_x, dim_y, dim_x, dim_y)
+        self.rho_sum = tf.Variable(
+            initial_value=tf.zeros(rho_shape),
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM
             )
 
     def call(self, inputs):
         psi_x = self.fm_x(inputs)
-        rho_y = self.qm(psi_x)
-        mean_var = self.dmregress(rho_y)
+        probs = self.qm(psi_x)
+        mean_var = self.dmregress(probs)
         return mean_var
 
     @tf.function
@@ -770,10 +1717,9 @@ class QMRegressor(tf.keras.Model):
             self.call(x)
         psi_x = self.fm_x(x)
         psi_y = self.fm_y(y)
-        psi = self.cp1([psi_x, psi_y])
-        rho = self.cp2([psi, tf.math.conj(psi)])
-        num_samples = tf.cast(tf.shape(x)[0], rho.dtype)
-        rho = tf.reduce_sum(rho, axis=0)
+        psi = self.cp1([psi_x, psi_y]) # shape (bs, dim_x, dim_y)
+        rho = self.gram(psi) # shape (dim_x, dim_y, dim_x, dim_y) or packed
+        num_samples = tf.cast(tf.shape(x)[0], self.num_samples.dtype)
         self.num_samples.assign_add(num_samples)
         return rho
 
@@ -782,21 +1728,32 @@ class QMRegressor(tf.keras.Model):
         x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
         if x.shape[1] is not None:
             rho = self.call_train(x, y)
-            self.qm.weights[0].assign_add(rho)
+            self.rho_sum.assign_add(tf.cast(rho, self.rho_sum.dtype))
         return {}
 
-    def fit(self, *args, **kwargs):
-        result = super(QMRegressor, self).fit(*args, **kwargs)
-        self.qm.weights[0].assign(self.qm.weights[0] / self.num_samples)
-        return result
+    def _accumulators(self):
+        return {'rho_sum': self.rho_sum, 'num_samples': self.num_samples}
+
+    def _update_rho(self):
+        if not self.qm.built:
+            self.qm.build((None, self.dim_x))
+        rho = tf.math.divide_no_nan(self.rho_sum, self.num_samples)
+        if self.packed:
+            self.qm.set_rho_packed(rho)
+        else:
+            self.qm.set_rho(rho)
 
     def get_rho(self):
-        return self.weights[2]
+        if self.packed:
+            return self.qm.get_rho()
+        return self.qm.rho
 
     def get_config(self):
         config = {
             "dim_x": self.dim_x,
-            "dim_y": self.dim_y
+            "dim_y": self.dim_y,
+            "packed": self.packed,
+            "block_size": self.block_size
         }
         base_config = super().get_config()
         return {**base_config, **config}
@@ -820,7 +1777,8 @@ class QMRegressorSGD(tf.keras.Model):
         self.fm_x = layers.QFeatureMapRFF(
             input_dim=input_dim,
             dim=dim_x, gamma=gamma, random_state=random_state)
-        self.qm = layers.QMeasureClassifEig(dim_x=dim_x, dim_y=dim_y, num_eig=num_eig)
+        self.qm = layers.QMeasureClassifEig(dim_x=dim_x, dim_y=dim_y, num_eig=num_eig,
+                                            output_dist=True)
         self.dmregress = layers.DensityMatrixRegression()
         self.dim_x = dim_x
         self.dim_y = dim_y
@@ -829,12 +1787,12 @@ class QMRegressorSGD(tf.keras.Model):
 
     def call(self, inputs):
         psi_x = self.fm_x(inputs)
-        rho_y = self.qm(psi_x)
-        mean_var = self.dmregress(rho_y)
+        probs = self.qm(psi_x)
+        mean_var = self.dmregress(probs)
         return mean_var
 
-    def set_rho(self, rho):
-        return self.qm.set_rho(rho)
+    def set_rho(self, rho, method='eigh', tol=1e-4):
+        return self.qm.set_rho(rho, method=method, tol=tol)
 
     def get_config(self):
         config = {
@@ -860,14 +1818,20 @@ class ComplexQMRegressorSGD(tf.keras.Model):
                  a value of 0 or less implies num_eig = dim_x
         gamma: float. Gamma parameter of the RBF kernel to be approximated.
         random_state: random number generator seed.
+        real_blocks: bool. If True the density matrix is stored and
+                 computed as real and imaginary blocks, see
+                 `layers.ComplexQMeasureClassifEig`
     """
-    def __init__(self, input_dim, dim_x, dim_y, num_eig=0, gamma=1, random_state=None):
+    def __init__(self, input_dim, dim_x, dim_y, num_eig=0, gamma=1, random_state=None,
+                 real_blocks=False):
         super(ComplexQMRegressorSGD, self).__init__()
         self.fm_x = layers.QFeatureMapComplexRFF(
             input_dim=input_dim,
             dim=dim_x, gamma=gamma, random_state=random_state)
-        self.qm = layers.ComplexQMeasureClassifEig(dim_x=dim_x, dim_y=dim_y, num_eig=num_eig)
-        self.dmregress = layers.ComplexDensityMatrixRegression()
+        self.qm = layers.ComplexQMeasureClassifEig(dim_x=dim_x, dim_y=dim_y, num_eig=num_eig,
+                                                   real_blocks=real_blocks,
+                                                   output_dist=True)
+        self.dmregress = layers.DensityMatrixRegression()
         self.dim_x = dim_x
         self.dim_y = dim_y
         self.gamma = gamma
@@ -875,12 +1839,12 @@ class ComplexQMRegressorSGD(tf.keras.Model):
 
     def call(self, inputs):
         psi_x = self.fm_x(inputs)
-        rho_y = self.qm(psi_x)
-        mean_var = self.dmregress(rho_y)
+        probs = self.qm(psi_x)
+        mean_var = self.dmregress(probs)
         return mean_var
 
-    def set_rho(self, rho):
-        return self.qm.set_rho(rho)
+    def set_rho(self, rho, method='eigh', tol=1e-4):
+        return self.qm.set_rho(rho, method=method, tol=tol)
 
     def get_config(self):
         config = {
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from qmc.tf import layers, models
+
+NUM_SAMPLES = 120
+BATCH_SIZE = 20
+DIM_X = 16
+
+
+def _data():
+    rng = np.random.RandomState(0)
+    return rng.uniform(size=(NUM_SAMPLES, 2)).astype(np.float32)
+
+
+def _build(decay):
+    fm_x = layers.QFeatureMapRFF(input_dim=2, dim=DIM_X, gamma=1,
+                                 random_state=0)
+    return models.QMDensityStream(fm_x, DIM_X, num_windows=2,
+                                  window_size=40, decay=decay)
+
+
+def _windowed_rho(psi, num_windows, window_size):
+    sums = np.zeros((num_windows, DIM_X, DIM_X))
+    counts = np.zeros(num_windows)
+    window = 0
+    for start in range(0, len(psi), BATCH_SIZE):
+        batch = psi[start:start + BATCH_SIZE]
+        sums[window] += batch.T @ batch
+        counts[window] += len(batch)
+        if counts[window] >= window_size:
+            window = (window + 1) % num_windows
+            sums[window] = 0
+            counts[window] = 0
+    return sums.sum(axis=0) / counts.sum()
+
+
+def _decayed_rho(psi, decay):
+    weights = decay ** np.arange(len(psi) - 1, -1, -1)
+    return (psi.T * weights) @ psi / weights.sum()
+
+
+def _fit(model, x, method):
+    if method == 'fit':
+        model.compile()
+        model.fit(x, batch_size=BATCH_SIZE, epochs=1, shuffle=False,
+                  verbose=0)
+    elif method == 'fit_stream':
+        model.fit_stream(x, chunk_size=BATCH_SIZE)
+    else:
+        for start in range(0, len(x), BATCH_SIZE):
+            model.partial_fit(x[start:start + BATCH_SIZE])
+
+
+@pytest.mark.parametrize('method', ['fit', 'fit_stream', 'partial_fit'])
+@pytest.mark.parametrize('decay', [None, 0.98])
+def test_stream_rho(method, decay):
+    x = _data()
+    model = _build(decay)
+    _fit(model, x, method)
+    psi = model.fm_x(x).numpy().astype(np.float64)
+    if decay is None:
+        expected = _windowed_rho(psi, model.num_windows, model.window_size)
+    else:
+        expected = _decayed_rho(psi, decay)
+    np.testing.assert_allclose(model.get_rho().numpy(), expected,
+                               rtol=1e-4, atol=1e-6)